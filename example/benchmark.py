@@ -0,0 +1,65 @@
+"""Compare the throughput of the futures and dynamic managers against a simulated slow relay.
+
+Usage: python example/benchmark.py [messages] [latency]
+"""
+
+import sys
+import time
+import logging
+
+from marrow.mailer import Message, Mailer
+from marrow.mailer.manager.futures import FuturesManager
+from marrow.mailer.manager.dynamic import DynamicManager
+
+logging.basicConfig(level=logging.WARNING)
+
+
+class SlowTransport(object):
+    """Pretends each delivery spends ``latency`` seconds waiting on the network."""
+
+    latency = 0.01
+
+    def __init__(self, config):
+        pass
+
+    def startup(self):
+        pass
+
+    def deliver(self, message):
+        time.sleep(self.latency)
+
+    def shutdown(self):
+        pass
+
+
+def run(manager, count, **config):
+    config['use'] = manager
+    mail = Mailer(dict(manager=config, transport=dict(use=SlowTransport)))
+    message = Message('author@example.com', 'recipient@example.com', "Benchmark.", plain="Testing!")
+
+    started = time.time()
+    mail.start()
+
+    for receipt in [mail.send(message) for i in range(count)]:
+        receipt.result()
+
+    # Allow idle workers to be released, then submit a second, smaller burst.
+    time.sleep(0.5)
+
+    for receipt in [mail.send(message) for i in range(count // 10)]:
+        receipt.result()
+
+    mail.stop()
+
+    duration = time.time() - started - 0.5
+    print("%-32s %8.1f messages/second" % (config.get('label', manager.__name__), (count + count // 10) / duration))
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    SlowTransport.latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.01
+
+    run(FuturesManager, count, workers=10, label="futures (10 threads)")
+    run(DynamicManager, count, workers=10, label="dynamic (0-10 threads)")
+    run(DynamicManager, count, workers=10, minimum=2, timeout=0.1, label="dynamic (2-10, 0.1s idle)")
+    run(DynamicManager, count, workers=10, latency='', label="dynamic (queue depth only)")
@@ -0,0 +1,62 @@
+"""Measure the per-message overhead of the framework: constructing messages using Mailer.new and handing them to
+the immediate manager, compared against constructing messages and calling a transport which does nothing directly.
+
+Usage: python example/overhead.py [messages]
+"""
+
+import sys
+import time
+import logging
+
+from marrow.mailer import Message, Mailer
+
+logging.basicConfig(level=logging.WARNING)
+
+
+class NullTransport(object):
+    """Accepts every message without so much as rendering it."""
+
+    def __init__(self, config):
+        pass
+
+    def startup(self):
+        pass
+
+    def deliver(self, message):
+        return True
+
+    def shutdown(self):
+        pass
+
+
+def baseline(count):
+    transport = NullTransport({})
+    started = time.time()
+
+    for i in range(count):
+        transport.deliver(Message('author@example.com', 'recipient@example.com', "Benchmark.", plain="Testing!"))
+
+    return time.time() - started
+
+
+def framework(count):
+    mail = Mailer(dict(manager=dict(use='immediate'), transport=dict(use=NullTransport),
+                       message=dict(author='author@example.com', plain="Testing!"))).start()
+    started = time.time()
+
+    for i in range(count):
+        mail.send(mail.new(to='recipient@example.com', subject="Benchmark."))
+
+    duration = time.time() - started
+    mail.stop()
+    return duration
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    direct, managed = baseline(count), framework(count)
+
+    print("%-32s %8.2f microseconds/message" % ("direct", direct / count * 1e6))
+    print("%-32s %8.2f microseconds/message" % ("Mailer.new + Mailer.send", managed / count * 1e6))
+    print("%-32s %8.2f microseconds/message" % ("overhead", (managed - direct) / count * 1e6))
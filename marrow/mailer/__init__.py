@@ -3,23 +3,32 @@
 """marrow.mailer mail delivery framework and MIME message abstraction."""
 
 
+import logging
 import warnings
+import threading
 import pkg_resources
 
 from email import charset
 from functools import partial
+from itertools import islice, chain
+from concurrent import futures
 
 from marrow.mailer.message import Message
-from marrow.mailer.exc import MailerNotRunning
+from marrow.mailer.template import MessageTemplate
+from marrow.mailer.exc import MailerNotRunning, MailConfigurationException
+from marrow.mailer.manager.util import BatchResult
+from marrow.mailer.result import DeliveryResult
+from marrow.mailer.manager.routing import DomainRouter
 
 from marrow.util.compat import basestring
+from marrow.util.convert import boolean
 from marrow.util.bunch import Bunch
 from marrow.util.object import load_object
 
 
-__all__ = ['Mailer', 'Delivery', 'Message']
+__all__ = ['Mailer', 'Delivery', 'Message', 'MessageTemplate']
 
-log = __import__('logging').getLogger(__name__)
+log = logging.getLogger(__name__)
 
 
 class Mailer(object):
@@ -36,6 +45,7 @@ class Mailer(object):
 	
 	def __init__(self, config, prefix=None):
 		self.manager, self.Manager = None, None
+		self.router = None
 		self.Transport = None
 		self.running = False
 		self.config = config = Bunch(config)
@@ -76,6 +86,9 @@ class Mailer(object):
 				self.message_config = Bunch.partial('message', config)
 		except (AttributeError, ValueError):
 			self.message_config = Bunch()
+		
+		# Messages are constructed by ``new`` from these defaults without copying the configuration each time.
+		self.factory = partial(Message, mailer=self, **self.message_config)
 
 		self.Manager = Manager = self._load(manager_config.use if 'use' in manager_config else 'immediate', 'marrow.mailer.manager')
 		
@@ -96,6 +109,13 @@ class Mailer(object):
 		#	raise TypeError("Chosen transport does not conform to the transport API.")
 		
 		self.manager = Manager(manager_config, partial(Transport, transport_config))
+		self.router = DomainRouter.from_config(self.manager, manager_config)
+		self.batch = int(manager_config.get('batch', 100))
+		self.split = boolean(manager_config.get('split', False))
+		self.render = manager_config.get('render', 'lazy')
+		
+		if self.render not in ('lazy', 'worker', 'submit'):
+			raise MailConfigurationException("Unknown render directive: %s" % (self.render, ))
 	
 	@staticmethod
 	def _load(spec, group):
@@ -119,6 +139,10 @@ class Mailer(object):
 		log.info("Mail delivery service starting.")
 		
 		self.manager.startup()
+		
+		if self.router:
+			self.router.startup()
+		
 		self.running = True
 		
 		log.info("Mail delivery service started.")
@@ -132,6 +156,9 @@ class Mailer(object):
 		
 		log.info("Mail delivery service stopping.")
 		
+		if self.router:
+			self.router.shutdown()
+		
 		self.manager.shutdown()
 		self.running = False
 		
@@ -143,22 +170,161 @@ class Mailer(object):
 		if not self.running:
 			raise MailerNotRunning("Mail service not running.")
 		
-		log.info("Attempting delivery of message %s.", message.id)
+		if self.split:
+			parts = message.split()
+			
+			if len(parts) > 1:
+				if log.isEnabledFor(logging.INFO):
+					log.info("Attempting delivery of message %s to %d domains.", message.id, len(parts))
+				
+				return self._send_parts(message, parts)
+		
+		# Checked first, as determining the identifier of a message may be costly; see ``Message.id``.
+		if log.isEnabledFor(logging.INFO):
+			log.info("Attempting delivery of message %s.", message.id)
 		
 		try:
-			result = self.manager.deliver(message)
+			if self.render == 'submit':
+				message.segments  # Render and cache within the calling thread.
+			
+			result = (self.router or self.manager).deliver(message)
 		
 		except:
 			log.error("Delivery of message %s failed.", message.id)
 			raise
 		
-		log.debug("Message %s delivered.", message.id)
+		if log.isEnabledFor(logging.DEBUG):
+			log.debug("Message %s delivered.", message.id)
+		
 		return result
 	
-	def new(self, author=None, to=None, subject=None, **kw):
-		data = dict(self.message_config)
-		data['mailer'] = self
+	def deliver(self, message):
+		"""Deliver a message from within a coroutine: ``message, result = await mailer.deliver(message)``.
+		
+		The asyncio manager's deliveries run on the current event loop; those of any other manager are
+		handed to the loop's default executor so that a blocking manager never stalls the loop.  A message
+		split across several domains (see the ``split`` directive) resolves once every part has been
+		delivered, with the results of the parts combined; see ``combine``.
+		"""
+		
+		import asyncio
+		
+		if not getattr(self.manager, 'asynchronous', False):
+			return asyncio.get_event_loop().run_in_executor(None, self._send_and_wait, message)
+		
+		return asyncio.ensure_future(self.send(message))
+	
+	def _send_parts(self, message, parts):
+		"""Deliver each part of a split message, returning a single receipt for the message as a whole.
+		
+		As with an unsplit message, the receipt is the ``(message, result)`` tuple itself for blocking managers, or
+		a future resolving to it otherwise; the result combines those of the parts (see ``combine``).
+		"""
+		
+		if getattr(self.manager, 'asynchronous', False):
+			from marrow.mailer.manager.aio import running_loop
+			
+			if running_loop() is not None:
+				return self._gather_parts(message, parts)
+		
+		receipt = aggregate(message, self._deliver_each(parts, self.router or self.manager))
+		
+		if getattr(self.manager, 'blocking', False) or getattr(self.manager, 'asynchronous', False):
+			return receipt.result()
+		
+		return receipt
+	
+	def _gather_parts(self, message, parts):
+		import asyncio
+		
+		receipt = asyncio.Future()
+		
+		def complete(outcome):
+			if outcome.cancelled():
+				receipt.cancel()
+			
+			elif outcome.exception() is not None:
+				receipt.set_exception(outcome.exception())
+			
+			else:
+				receipt.set_result((message, combine([result for part, result in outcome.result()])))
+		
+		asyncio.gather(*[asyncio.ensure_future(self.manager.deliver(part)) for part in parts]).add_done_callback(complete)
+		return receipt
+	
+	def _send_and_wait(self, message):
+		result = self.send(message)
+		return result.result() if isinstance(result, futures.Future) else result
+	
+	def send_many(self, messages, batch=None):
+		"""Deliver an iterable of messages, handing them to the manager in batches.
+		
+		The iterable is consumed lazily, ``batch`` messages at a time (defaulting to the ``batch``
+		manager directive).  Returns a ``BatchResult`` tracking the outcome of every message; with the ``split``
+		directive, the receipt of a message split across several domains combines those of its parts.
+		"""
+		
+		if not self.running:
+			raise MailerNotRunning("Mail service not running.")
 		
+		size = int(batch or self.batch)
+		messages = iter(messages)
+		result = BatchResult()
+		deliver = getattr(self.manager, 'deliver_many', None) or self._deliver_each
+		
+		if self.router:
+			deliver = partial(self.router.deliver_many, deliver=deliver)
+		
+		while True:
+			chunk = list(islice(messages, size))
+			
+			if not chunk:
+				break
+			
+			log.info("Attempting delivery of a batch of %d messages.", len(chunk))
+			
+			groups = [message.split() for message in chunk] if self.split else None
+			parts = list(chain.from_iterable(groups)) if self.split else chunk
+			
+			if self.render == 'submit':
+				for message in parts:
+					message.segments
+			
+			receipts = deliver(parts)
+			
+			if self.split:
+				receipts = iter(receipts)
+				receipts = [aggregate(message, list(islice(receipts, len(group)))) if len(group) > 1 else next(receipts)
+						for message, group in zip(chunk, groups)]
+			
+			result.extend(chunk, receipts)
+		
+		log.debug("Handed off %d messages for delivery.", len(result))
+		return result
+	
+	def _deliver_each(self, messages, manager=None):
+		"""Fallback batch delivery for managers lacking a ``deliver_many`` method."""
+		
+		receipts = []
+		deliver = (manager or self.manager).deliver
+		
+		for message in messages:
+			try:
+				outcome = deliver(message)
+			
+			except Exception as e:
+				outcome = futures.Future()
+				outcome.set_exception(e)
+			
+			if not isinstance(outcome, futures.Future):
+				receipt, outcome = outcome, futures.Future()
+				outcome.set_result(receipt)
+			
+			receipts.append(outcome)
+		
+		return receipts
+	
+	def new(self, author=None, to=None, subject=None, **kw):
 		if author:
 			kw['author'] = author
 		if to:
@@ -166,9 +332,60 @@ class Mailer(object):
 		if subject:
 			kw['subject'] = subject
 		
-		data.update(kw)
+		return self.factory(**kw)
+
+
+def combine(results):
+	"""Combine the results of delivering each part of a split message.
+	
+	Per-recipient results (see ``DeliveryResult``) are merged into one; any other results are returned as
+	a list, in the order of the parts.
+	"""
+	
+	if not all(isinstance(result, DeliveryResult) for result in results):
+		return list(results)
+	
+	combined = DeliveryResult()
+	
+	for result in results:
+		combined = combined.combine(result)
+	
+	return combined
+
+
+def aggregate(message, receipts):
+	"""Return a future resolving to ``(message, result)`` once every receipt for the parts of a split message has.
+	
+	The result combines those of the parts; see ``combine``.  Should any part fail, the exception of the first to
+	have failed (in the order of the parts) is raised instead.
+	"""
+	
+	receipt = futures.Future()
+	pending = set(receipts)
+	lock = threading.Lock()
+	
+	def complete(part):
+		with lock:
+			pending.discard(part)
+			
+			if pending:
+				return
+		
+		for part in receipts:
+			if part.cancelled():
+				receipt.cancel()
+				return
+			
+			if part.exception() is not None:
+				receipt.set_exception(part.exception())
+				return
 		
-		return Message(**data)
+		receipt.set_result((message, combine([part.result()[1] for part in receipts])))
+	
+	for part in receipts:
+		part.add_done_callback(complete)
+	
+	return receipt
 
 
 class Delivery(Mailer):
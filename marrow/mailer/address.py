@@ -5,13 +5,102 @@
 from __future__ import unicode_literals
 import sys
 
+from collections import OrderedDict
+from threading import Lock
+try:
+	from collections.abc import MutableSequence
+except ImportError:  # pragma: no cover
+	from collections import MutableSequence
 from email.utils import formataddr, parseaddr
 from email.header import Header
 
 from marrow.mailer.validator import EmailValidator
 from marrow.util.compat import basestring, unicode, unicodestr, native
 
-__all__ = ['Address', 'AddressList']
+__all__ = ['Address', 'AddressList', 'CompactAddressList', 'LRUCache', 'ValidationCache']
+
+
+class LRUCache(object):
+	"""A bounded, thread-safe, least-recently-used cache of the results of a single-argument function.
+
+	Calling the instance returns the same value as calling the wrapped function.  The ``hits`` and
+	``misses`` counters may be inspected to judge the effectiveness of the cache."""
+
+	__slots__ = ('function', 'size', 'hits', 'misses', '_results', '_lock')
+
+	def __init__(self, function, size=4096):
+		self.function = function
+		self.size = size
+		self.hits = 0
+		self.misses = 0
+		self._results = OrderedDict()
+		self._lock = Lock()
+
+	def __repr__(self):
+		return "{0}(size={1}, entries={2}, hits={3}, misses={4})".format(
+				self.__class__.__name__, self.size, len(self._results), self.hits, self.misses)
+
+	def __len__(self):
+		return len(self._results)
+
+	def __call__(self, key):
+		results = self._results
+
+		with self._lock:
+			try:
+				result = results.pop(key)
+
+			except KeyError:
+				pass
+
+			else:
+				self.hits += 1
+				results[key] = result  # Re-insert as the most recently used.
+				return result
+
+		# Calculate outside of the lock; cached functions are pure and a duplicated miss is harmless.
+		result = self.function(key)
+
+		with self._lock:
+			self.misses += 1
+			results[key] = result
+
+			while len(results) > self.size:
+				results.popitem(False)
+
+		return result
+
+	def clear(self):
+		with self._lock:
+			self._results.clear()
+			self.hits = self.misses = 0
+
+
+class ValidationCache(LRUCache):
+	"""A least-recently-used cache of e-mail address validation results.
+
+	Calling the instance with an address returns the same ``(email, error)`` tuple as the wrapped
+	validator's ``validate_email`` method."""
+
+	__slots__ = ('validator', )
+
+	def __init__(self, validator, size=4096):
+		super(ValidationCache, self).__init__(validator.validate_email, size)
+		self.validator = validator
+
+
+# A single validator is shared by all Address instances, rather than compiling its expressions per address.
+validate = ValidationCache(EmailValidator())
+
+# Encoding internationalized domains to punycode is comparatively expensive and domains repeat heavily.
+idna = LRUCache(lambda domain: domain.encode('idna').decode(), 4096)
+
+
+def punycode(address):
+	"""Return the given bare e-mail address with its domain IDNA-encoded, for use in an SMTP envelope."""
+
+	localpart, domain = address.split('@', 1)
+	return '@'.join((localpart, idna(domain)))
 
 
 class Address(object):
@@ -24,6 +113,8 @@ class Address(object):
 	The AddressList unit tests provide comprehensive testing of this class as
 	well."""
 
+	__slots__ = ('name', 'address', 'encoding')
+
 	def __init__(self, name_or_email, email=None, encoding='utf-8'):
 		self.encoding = encoding
 
@@ -52,7 +143,7 @@ class Address(object):
 			self.name = unicodestr(name_or_email, encoding)
 			self.address = unicodestr(email, encoding)
 
-		email, err = EmailValidator().validate_email(self.address)
+		email, err = validate(self.address)
 
 		if err:
 			raise ValueError('"{0}" is not a valid e-mail address: {1}'.format(email, err))
@@ -111,19 +202,19 @@ class Address(object):
 			name_string = Header(self.name, encoding).encode()
 		
 		# Encode punycode for internationalized domains.
-		localpart, domain = self.address.split('@', 1)
-		domain = domain.encode('idna').decode()
-		address = '@'.join((localpart, domain))
+		address = punycode(self.address)
 
 		return formataddr((name_string, address)).replace('\n', '').encode(encoding)
 
 	@property
 	def valid(self):
-		email, err = EmailValidator().validate_email(self.address)
+		email, err = validate(self.address)
 		return False if err else True
 
 
 class AddressList(list):
+	__slots__ = ('encoding', )
+
 	def __init__(self, addresses=None, encoding="utf-8"):
 		super(AddressList, self).__init__()
 
@@ -139,6 +230,9 @@ class AddressList(list):
 			self.append(Address(addresses, encoding=encoding))
 			return
 
+		elif isinstance(addresses, CompactAddressList):
+			addresses = list(addresses)
+
 		if not isinstance(addresses, list):
 			raise ValueError("Invalid value for AddressList: {0}".format(repr(addresses)))
 
@@ -194,20 +288,170 @@ class AddressList(list):
 		"""Return a list of string representations of the addresses suitable
 		for usage in an SMTP transaction."""
 		
-		if not encoding:
-			encoding = self.encoding
-		
-		# We need the punycode goodness.
-		return [Address(i.address).encode(encoding).decode(encoding) for i in self]
+		# We need the punycode goodness; the addresses were validated on the way in.
+		return [punycode(i.address) for i in self]
+
+
+class CompactAddressList(MutableSequence):
+	"""A memory-efficient alternative to AddressList for very large recipient lists.
+
+	Rather than holding one Address instance per entry, names and addresses are stored as strings in
+	two parallel lists.  Values are validated as they are added, exactly as with AddressList, and
+	Address instances are produced on access without re-validation.
+	"""
+
+	__slots__ = ('encoding', '_names', '_addresses')
+
+	def __init__(self, addresses=None, encoding="utf-8"):
+		self.encoding = encoding
+		self._names = []
+		self._addresses = []
+
+		if addresses is None:
+			return
+
+		if isinstance(addresses, CompactAddressList):
+			self._names.extend(addresses._names)
+			self._addresses.extend(addresses._addresses)
+			return
+
+		if isinstance(addresses, basestring):
+			addresses = addresses.split(',')
+
+		elif isinstance(addresses, tuple):
+			addresses = [addresses]
+
+		elif not isinstance(addresses, list):
+			raise ValueError("Invalid value for CompactAddressList: {0}".format(repr(addresses)))
+
+		self.extend(addresses)
+
+	@staticmethod
+	def _parse(values):
+		"""Validate the given values, returning parallel lists of names and addresses."""
+
+		values = [Address(val) if not isinstance(val, Address) else val for val in values]
+		return [i.name for i in values], [i.address for i in values]
+
+	def _address(self, name, address):
+		instance = Address.__new__(Address)
+		instance.name = name
+		instance.address = address
+		instance.encoding = self.encoding
+		return instance
+
+	def __len__(self):
+		return len(self._addresses)
+
+	def __iter__(self):
+		for name, address in zip(self._names, self._addresses):
+			yield self._address(name, address)
+
+	def __getitem__(self, k):
+		if isinstance(k, slice):
+			result = self.__class__(encoding=self.encoding)
+			result._names = self._names[k]
+			result._addresses = self._addresses[k]
+			return result
+
+		return self._address(self._names[k], self._addresses[k])
+
+	def __setitem__(self, k, value):
+		if isinstance(k, slice):
+			self._names[k], self._addresses[k] = self._parse(value)
+			return
+
+		(self._names[k], ), (self._addresses[k], ) = self._parse([value])
+
+	def __delitem__(self, k):
+		del self._names[k]
+		del self._addresses[k]
+
+	def insert(self, i, value):
+		(name, ), (address, ) = self._parse([value])
+		self._names.insert(i, name)
+		self._addresses.insert(i, address)
+
+	def extend(self, sequence):
+		names, addresses = self._parse(sequence)
+		self._names.extend(names)
+		self._addresses.extend(addresses)
+
+	def append(self, value):
+		self.extend([value])
+
+	def __eq__(self, other):
+		if isinstance(other, CompactAddressList):
+			return (self._names, self._addresses) == (other._names, other._addresses)
+
+		if not isinstance(other, list):
+			return NotImplemented
+
+		return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+	def __ne__(self, other):
+		result = self.__eq__(other)
+		return result if result is NotImplemented else not result
+
+	__hash__ = None
+
+	def __add__(self, other):
+		result = self.__class__(self, encoding=self.encoding)
+		result.extend(other)
+		return result
+
+	def __radd__(self, other):
+		result = self.__class__(encoding=self.encoding)
+		result.extend(other)
+		result._names.extend(self._names)
+		result._addresses.extend(self._addresses)
+		return result
+
+	def __repr__(self):
+		if not self:
+			return "CompactAddressList()"
+
+		return "CompactAddressList(\"{0}\")".format(", ".join([str(i) for i in self]))
+
+	def __bytes__(self):
+		return self.encode()
+
+	def __unicode__(self):
+		return ", ".join(unicode(i) for i in self)
+
+	if sys.version_info < (3, 0):
+		__str__ = __bytes__
+
+	else:  # pragma: no cover
+		__str__ = __unicode__
+
+	def encode(self, encoding=None):
+		encoding = encoding if encoding else self.encoding
+		return b", ".join([a.encode(encoding) for a in self])
+
+	@property
+	def addresses(self):
+		result = self.__class__(encoding=self.encoding)
+		result._names = [''] * len(self._addresses)
+		result._addresses = list(self._addresses)
+		return result
+
+	@property
+	def string_addresses(self, encoding=None):
+		"""Return a list of string representations of the addresses suitable
+		for usage in an SMTP transaction."""
+
+		return [punycode(i) for i in self._addresses]
 
 
 class AutoConverter(object):
 	"""Automatically converts an assigned value to the given type."""
 
-	def __init__(self, attr, cls, can=True):
+	def __init__(self, attr, cls, can=True, accept=None):
 		self.cls = cls
 		self.can = can
 		self.attr = native(attr)
+		self.accept = accept or cls  # Types which are stored as-is, without conversion.
 
 	def __get__(self, instance, owner):
 		value = getattr(instance, self.attr, None)
@@ -218,7 +462,7 @@ class AutoConverter(object):
 		return value
 
 	def __set__(self, instance, value):
-		if not isinstance(value, self.cls):
+		if not isinstance(value, self.accept):
 			value = self.cls(value)
 
 		setattr(instance, self.attr, value)
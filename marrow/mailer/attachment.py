@@ -0,0 +1,138 @@
+# encoding: utf-8
+
+"""Attachments encoded only as needed: file-backed ones as the message containing them is streamed, and those read
+into memory as the message is rendered."""
+
+import os
+import mmap
+import threading
+
+from binascii import b2a_base64
+from uuid import uuid4
+from weakref import WeakValueDictionary
+from email.mime.nonmultipart import MIMENonMultipart
+
+
+__all__ = ['SharedFile', 'StreamedPart', 'MemoryPart', 'share']
+
+
+_files = WeakValueDictionary()  # Open files by absolute path, for as long as an attachment refers to them.
+_lock = threading.Lock()
+
+
+
+def share(path):
+	"""Return the ``SharedFile`` for the given path, opening it only if no current copy is already open.
+
+	A file altered (its size or modification time differing) since it was opened is opened anew; messages
+	already referring to the previous copy continue to use it.
+	"""
+
+	path = os.path.abspath(path)
+	stat = os.stat(path)
+
+	with _lock:
+		shared = _files.get(path)
+
+		if shared is None or (shared.size, shared.mtime) != (stat.st_size, stat.st_mtime):
+			shared = _files[path] = SharedFile(path)
+
+	return shared
+
+
+class SharedFile(object):
+	"""A read-only view of a file on disk, shared by every attachment of that file.
+
+	The file is memory mapped where possible, so its pages are held by the operating system's cache
+	rather than copied into each message; otherwise it is read from disk as needed.  It must not be
+	truncated while messages attaching it await delivery.  Pickles as its path.
+	"""
+
+	__slots__ = ('path', 'size', 'mtime', 'map', '__weakref__')
+
+	def __init__(self, path):
+		self.path = path
+		self.map = None
+
+		with open(path, 'rb') as fh:
+			stat = os.fstat(fh.fileno())
+			self.size, self.mtime = stat.st_size, stat.st_mtime
+
+			if self.size:
+				try:
+					self.map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+				except (EnvironmentError, ValueError):  # pragma: no cover
+					pass
+
+	def __repr__(self):
+		return "SharedFile(%r)" % (self.path, )
+
+	def __reduce__(self):
+		return share, (self.path, )
+
+	def read(self, offset, size):
+		if self.map is not None:
+			return self.map[offset:offset + size]
+
+		with open(self.path, 'rb') as fh:  # pragma: no cover
+			fh.seek(offset)
+			return fh.read(size)
+
+
+class StreamedPart(MIMENonMultipart):
+	"""A base64-encoded MIME part standing in for the content of a shared file.
+
+	Its payload is a unique token; the rendered message is split on these tokens and the encoded file
+	content substituted, ``chunk`` bytes of the file at a time, as the message is streamed.  The encoding
+	is identical to that of an attachment read into memory.
+	"""
+
+	chunk = 57 * 1024  # The number of bytes read per chunk; a multiple of the 57 encoded per line.
+
+	def __init__(self, maintype, subtype, source, **params):
+		MIMENonMultipart.__init__(self, maintype, subtype, **params)
+		self.source = source
+		self.token = 'stream' + uuid4().hex
+		self.set_payload(self.token)
+
+	@property
+	def length(self):
+		"""The length of the encoded content, in bytes."""
+
+		lines, remainder = divmod(self.source.size, 57)
+		return lines * 77 + ((remainder + 2) // 3 * 4 + 1 if remainder else 0)
+
+	def encode(self, size=None):
+		"""Yield the encoded content of the file, reading roughly ``size`` bytes at a time."""
+
+		size = max(57, (size or self.chunk) // 57 * 57)
+
+		for offset in range(0, self.source.size, size):
+			data = memoryview(self.source.read(offset, size))
+			yield b''.join(b2a_base64(data[i:i + 57]) for i in range(0, len(data), 57))
+
+
+class MemoryPart(MIMENonMultipart):
+	"""A base64-encoded MIME part holding the content of an attachment read into memory.
+
+	The content is only encoded once the payload is first requested, i.e. as the message is rendered.  Until then
+	the part pickles as the raw content, a quarter smaller than its encoding, so that a message handed to a worker
+	process is encoded there rather than by the sender.
+	"""
+
+	def __init__(self, maintype, subtype, content, **params):
+		MIMENonMultipart.__init__(self, maintype, subtype, **params)
+		self.content = content
+
+	def get_payload(self, i=None, decode=False):
+		content = self.content
+
+		if content is not None:
+			if decode:
+				return content
+
+			self.set_payload(b''.join(b2a_base64(content[offset:offset + 57]) for offset in range(0, len(content), 57)))
+			self.content = None  # Retain only the encoded form.
+
+		return MIMENonMultipart.get_payload(self, i, decode)
@@ -5,12 +5,19 @@
 
 __all__ = [
         'MailException',
+        'DeliveryException',
+        'DeliveryFailedException',
+        'DeliveryDeferredException',
+        'MailerNotRunning',
         'MailConfigurationException',
         'TransportException',
         'TransportFailedException',
+        'RecipientsDeferredException',
         'MessageFailedException',
         'TransportExhaustedException',
-        'ManagerException'
+        'ManagerException',
+        'PoolTimeoutException',
+        'QueueFullException'
     ]
 
 
@@ -40,6 +47,13 @@ class DeliveryFailedException(DeliveryException):
         super(DeliveryFailedException, self).__init__(message, reason)
 
 
+class DeliveryDeferredException(DeliveryFailedException):
+    """Delivery of the message stored in args[0] was deferred by a transport
+    failure and the manager was stopped before it could be retried."""
+    
+    pass
+
+
 # Internal Exceptions
 
 class MailerNotRunning(MailException):
@@ -67,6 +81,17 @@ class TransportFailedException(TransportException):
     pass
 
 
+class RecipientsDeferredException(TransportFailedException):
+    """Some recipients temporarily refused the message.  The envelope recipients
+    of the message have been narrowed to them, for delivery to be retried; the
+    transport may still be re-used.
+
+    The ``DeliveryResult`` of every attempt so far is the first argument.
+    """
+
+    pass
+
+
 class MessageFailedException(TransportException):
     """The transport has failed to deliver the message due to a problem with
     the message itself, and no attempt should be made to retry delivery of
@@ -89,3 +114,17 @@ class TransportExhaustedException(TransportException):
 class ManagerException(MailException):
     """The base for all marrow.mailer Manager exceptions."""
     pass
+
+
+class PoolTimeoutException(ManagerException):
+    """A transport could not be acquired from a size-limited pool before the
+    configured timeout elapsed."""
+    
+    pass
+
+
+class QueueFullException(ManagerException):
+    """A message could not be queued for delivery as the manager's bounded
+    queue was full, and its policy is to reject or to stop waiting."""
+    
+    pass
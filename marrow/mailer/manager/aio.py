@@ -0,0 +1,303 @@
+# encoding: utf-8
+
+"""An asyncio delivery manager driving many concurrent transports from a single event loop.
+
+Requires Python 3.5 or later and a transport whose ``startup``, ``deliver``, and ``shutdown`` methods
+are coroutines, such as ``aiosmtp``.
+"""
+
+import asyncio
+
+from marrow.mailer.exc import TransportFailedException, TransportExhaustedException, MessageFailedException, DeliveryFailedException, RecipientsDeferredException
+from marrow.mailer.manager.util import RetryPolicy, clock, settle, conclude
+
+
+__all__ = ['AsyncTransportPool', 'AsyncManager', 'deliver_once', 'running_loop']
+
+log = __import__('logging').getLogger(__name__)
+
+
+
+def running_loop():
+    """Return the event loop running within the current thread, or None; unlike ``get_event_loop`` none is created."""
+
+    try:
+        return asyncio.get_running_loop()
+
+    except AttributeError:  # pragma: no cover; Python 3.6 and earlier.
+        return asyncio._get_running_loop()
+
+    except RuntimeError:
+        return None
+
+
+class AsyncTransportPool(object):
+    """The coroutine counterpart to ``TransportPool``.
+
+    No locking is required: transports are only ever handed out and returned from the event loop.
+
+    With ``prewarm`` given, ``refill()`` starts transports in the background until that many are idle; it is
+    called again as each is checked out, unless the previous attempt failed to start any.
+    """
+
+    __slots__ = ('factory', 'render', 'prewarm', 'transports', 'warming', 'failed', 'tasks')
+
+    def __init__(self, factory, render=False, prewarm=0):
+        self.factory = factory
+        self.render = render
+        self.prewarm = prewarm or 0
+        self.transports = []
+        self.warming = 0  # Transports being started by ``warm``.
+        self.failed = False  # Whether the last attempt to warm the pool started nothing.
+        self.tasks = set()
+
+    def startup(self):
+        self.failed = False
+
+    def refill(self):
+        """Schedule the warming of the pool within the running event loop, if it is short of idle transports."""
+
+        if self.prewarm and not self.failed and len(self.transports) + self.warming < self.prewarm:
+            task = asyncio.ensure_future(self.warm())
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def warm(self):
+        """Start transports, concurrently, until ``prewarm`` are idle; returns the number started."""
+
+        count = max(0, self.prewarm - len(self.transports) - self.warming)
+
+        if not count:
+            return 0
+
+        self.warming += count
+
+        try:
+            started = sum(await asyncio.gather(*[self._warm() for i in range(count)]))
+
+        finally:
+            self.warming -= count
+
+        self.failed = not started
+        return started
+
+    async def _warm(self):
+        transport = self.factory()
+
+        try:
+            await transport.startup()
+
+        except Exception:
+            log.warning("Unable to start a transport in advance of use.", exc_info=True)
+            return 0
+
+        self.transports.insert(0, transport)  # Behind any transports already proven in use.
+        return 1
+
+    async def shutdown(self):
+        if self.tasks:
+            await asyncio.wait(list(self.tasks))
+
+        transports, self.transports = self.transports, []
+
+        for transport in transports:
+            await transport.shutdown()
+
+    class Context(object):
+        __slots__ = ('pool', 'transport')
+
+        def __init__(self, pool):
+            self.pool = pool
+            self.transport = None
+
+        async def __aenter__(self):
+            pool = self.pool
+
+            if pool.transports:
+                log.debug("Acquired existing transport instance.")
+                transport = pool.transports.pop()
+                pool.refill()
+
+            else:
+                log.debug("Unable to acquire existing transport, initalizing new instance.")
+                transport = pool.factory()
+                await transport.startup()
+                pool.failed = False  # Worth warming again.
+
+            self.transport = transport
+            return transport
+
+        async def __aexit__(self, type, value, traceback):
+            transport = self.transport
+            ephemeral = getattr(transport, 'ephemeral', False)
+
+            if type is not None:
+                log.error("Shutting down transport due to unhandled exception.", exc_info=(type, value, traceback))
+                await transport.shutdown()
+                return
+
+            if not ephemeral:
+                log.debug("Scheduling transport instance for re-use.")
+                self.pool.transports.append(transport)
+
+            else:
+                log.debug("Transport marked as ephemeral, shutting down instance.")
+                await transport.shutdown()
+
+    def __call__(self):
+        return self.Context(self)
+
+
+
+async def deliver_once(pool, message):
+    # Mirrors marrow.mailer.manager.util:deliver_once.
+    failure = None
+
+    if pool.render:
+        message.segments  # Render and cache prior to checking out a transport.
+
+    async with pool() as transport:
+        try:
+            result = await transport.deliver(message)
+
+        except MessageFailedException as e:
+            raise DeliveryFailedException(message, e.args[0] if e.args else "No reason given.")
+
+        except RecipientsDeferredException as e:
+            failure = e  # The transport remains usable.
+
+        except TransportFailedException as e:
+            # The transport has suffered an internal error or has otherwise
+            # requested to not be recycled.
+            transport.ephemeral = True
+            failure = e
+
+        except TransportExhaustedException as e:
+            # The transport sent the message, but pre-emptively
+            # informed us that future attempts will not be successful.
+            transport.ephemeral = True
+            result = e.args[0] if e.args else None
+
+    if failure is not None:
+        raise failure
+
+    return message, settle(message, result)
+
+
+
+class AsyncManager(object):
+    """Deliver messages as asyncio tasks, with at most ``concurrency`` deliveries in flight.
+
+    Called from within a running event loop ``deliver()`` returns an ``asyncio.Task`` which may be
+    awaited for the ``(message, result)`` tuple.  Called from outside of one (e.g. from synchronous
+    code) the manager's loop, the loop it was last used within or else one of its own, is run until
+    delivery completes and the tuple is returned directly, as per the immediate manager.  Should that
+    loop be running within another thread, the delivery is submitted to it and waited for.
+    """
+
+    __slots__ = ('concurrency', 'transport', 'retry', 'semaphore', 'tasks', 'loop', 'owned')
+
+    asynchronous = True
+
+    def __init__(self, config, transport):
+        self.concurrency = int(config.get('concurrency', 100))
+
+        prewarm = config.get('pool.prewarm', None)
+        self.transport = AsyncTransportPool(transport, config.get('render', None) == 'worker', int(prewarm or 0))
+        self.retry = RetryPolicy.from_config(config)
+        self.semaphore = None
+        self.tasks = set()
+        self.loop = None  # The loop deliveries are made within.
+        self.owned = False  # Whether that loop was created, and so is to be closed, by the manager.
+
+        super(AsyncManager, self).__init__()
+
+    def startup(self):
+        log.info("Asynchronous delivery manager starting.")
+
+        log.debug("Initializing transport queue.")
+        self.transport.startup()
+
+        # Bound to the event loop on first use, as the loop may not exist yet.
+        self.semaphore = None
+
+        if running_loop() is not None:
+            self.transport.refill()  # Otherwise, upon first use; transports are bound to the loop they start within.
+
+        log.info("Asynchronous delivery manager ready.")
+
+    async def deliver_async(self, message):
+        """Coroutine delivering a message, returning the ``(message, result)`` tuple."""
+
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+            self.transport.refill()
+
+        started, limit, attempt = clock(), self.retry.limit(message), 0
+
+        while True:
+            if attempt:
+                # Wait out the backoff without occupying a delivery slot.
+                delay = self.retry.next(attempt, started, limit)
+
+                if delay is None:
+                    log.error("%s ABANDONED after %d attempts.", message.id, attempt)
+                    conclude(message)
+                    raise DeliveryFailedException(message, "Delivery abandoned after %d attempts." % (attempt, ))
+
+                log.info("%s DEFERRED %.2f seconds.", message.id, delay)
+                await asyncio.sleep(delay)
+
+            async with self.semaphore:
+                try:
+                    return await deliver_once(self.transport, message)
+
+                except TransportFailedException:
+                    attempt += 1
+
+                except Exception:
+                    conclude(message)
+                    raise
+
+    def deliver(self, message):
+        return self._run(self.deliver_async(message))
+
+    async def shutdown_async(self, pending=()):
+        if pending:
+            log.debug("Waiting for %d deliveries to complete.", len(pending))
+            await asyncio.wait(pending)
+
+        log.debug("Draining transport queue.")
+        await self.transport.shutdown()
+
+        log.info("Asynchronous delivery manager stopped.")
+
+    def shutdown(self):
+        log.info("Asynchronous delivery manager stopping.")
+        result = self._run(self.shutdown_async(list(self.tasks)))
+
+        if self.owned and not self.loop.is_running():
+            self.loop.close()
+            self.loop, self.owned = None, False
+
+        return result
+
+    def _run(self, coroutine):
+        loop = running_loop()
+
+        if loop is not None:
+            self.loop = loop
+
+            task = asyncio.ensure_future(coroutine)
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+            return task
+
+        if self.loop is None or self.loop.is_closed():
+            self.loop, self.owned = asyncio.new_event_loop(), True
+
+        if self.loop.is_running():  # Within another thread.
+            return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+        return self.loop.run_until_complete(coroutine)
@@ -3,13 +3,22 @@
 import atexit
 import threading
 import weakref
+import os
 import sys
 import math
+import time
 
+from itertools import count
 from functools import partial
+from collections import deque
 
-from marrow.mailer.manager.futures import worker
-from marrow.mailer.manager.util import TransportPool
+from marrow.mailer.exc import MailConfigurationException, QueueFullException
+from marrow.mailer.manager.util import TransportPool, RetryPolicy, RetryScheduler, deliver_batch, clock
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 try:
     import queue
@@ -22,40 +31,80 @@ except ImportError:  # pragma: no cover
     raise ImportError("You must install the futures package to use background delivery.")
 
 
-__all__ = ['DynamicManager']
+__all__ = ['DynamicManager', 'PriorityQueue', 'Spill', 'priority']
 
 log = __import__('logging').getLogger(__name__)
 
 
-def thread_worker(executor, jobs, timeout, maximum):
-    i = maximum + 1
+# The share of workers given to each X-Priority level (1 being the highest) while several are waiting.
+WEIGHTS = {1: 16, 2: 8, 3: 4, 4: 2, 5: 1}
+
+
+def priority(message, default=None):
+    """Return the numeric priority of a message, from its ``priority`` (X-Priority) attribute.
+
+    Accepts integers as well as the string forms commonly used, e.g. ``"1 (Highest)"``.
+    """
+
+    value = getattr(message, 'priority', None)
+
+    if value is None:
+        return default
 
     try:
-        while i:
-            i -= 1
+        return int(str(value).split(None, 1)[0])
+
+    except (ValueError, IndexError):
+        return default
+
 
+def thread_worker(executor, jobs, timeout, maximum=None):
+    """Run work items until shut down, starved, or (if a ``maximum`` number of jobs is given) exhausted.
+
+    A worker only starves once it has waited ``timeout`` seconds for work while the pool is larger
+    than its minimum size.
+    """
+
+    i = 0
+
+    try:
+        while not maximum or i < maximum:
             try:
                 work = jobs.get(True, timeout)
 
-                if work is None:
-                    runner = executor()
+            except queue.Empty:
+                runner = executor()
 
-                    if runner is None or runner._shutdown:
-                        log.debug("Worker instructed to shut down.")
-                        break
+                if runner is None or runner._retire():
+                    log.debug("Worker death from starvation.")
+                    break
 
-                    # Can't think of a test case for this; best to be safe.
-                    del runner  # pragma: no cover
-                    continue  # pragma: no cover
+                del runner
+                continue
 
-            except queue.Empty:  # pragma: no cover
-                log.debug("Worker death from starvation.")
-                break
+            if work is None:
+                runner = executor()
 
-            else:
-                work.run()
+                if runner is None or runner._shutdown:
+                    log.debug("Worker instructed to shut down.")
+                    break
+
+                # Can't think of a test case for this; best to be safe.
+                del runner  # pragma: no cover
+                continue  # pragma: no cover
+
+            work.run()
+            del work
+            i += 1
+
+            runner = executor()
+
+            if runner is not None:
+                runner._adjust_thread_count()  # The remaining work may have waited too long.
+
+            del runner
 
-        else:  # pragma: no cover
+        else:
             log.debug("Worker death from exhaustion.")
 
     except:  # pragma: no cover
@@ -63,7 +112,24 @@ def thread_worker(executor, jobs, timeout, maximum):
 
     runner = executor()
     if runner:
-        runner._threads.discard(threading.current_thread())
+        runner._retire(True)
+
+
+def latency_monitor(executor, interval, stopped):
+    """Re-evaluate the size of the pool every ``interval`` seconds until ``stopped`` is set.
+
+    Otherwise work left waiting beyond the executor's ``latency`` only gains a thread as other
+    work is submitted or completed, which may be never while every worker is occupied.
+    """
+
+    while not stopped.wait(interval):
+        runner = executor()
+
+        if runner is None:
+            break
+
+        runner._adjust_thread_count()
+        del runner
 
 
 class WorkItem(object):
@@ -90,28 +156,218 @@ class WorkItem(object):
             self.future.set_result(result)
 
 
+class PriorityQueue(object):
+    """A work queue for the scaling executor with a FIFO queue per priority level.
+
+    Levels are served by stride scheduling: while several levels have work waiting each is given a
+    share of dequeues proportional to its weight, so bulk traffic can neither starve nor be starved
+    by more urgent mail.  A level accrues no credit while idle.  Shutdown sentinels (``None``) are
+    only returned once every level is empty.
+
+    If ``maxsize`` is non-zero, producers may ``reserve()`` room for an item before putting it, waiting
+    while ``maxsize`` items are queued.  Items put without a reservation are always accepted.
+    """
+
+    __slots__ = ('weights', 'default', 'maxsize', 'levels', 'passes', 'virtual', 'control', 'size', 'reserved',
+            'waiters', 'lock', 'room')
+
+    def __init__(self, weights=None, default=3, maxsize=0):
+        self.weights = dict((int(level), float(weight)) for level, weight in (weights or WEIGHTS).items())
+        self.default = self.level(default)
+        self.maxsize = maxsize
+        self.levels = dict((level, deque()) for level in self.weights)
+        self.passes = dict.fromkeys(self.weights, 0.0)
+        self.virtual = 0.0
+        self.control = deque()
+        self.size = 0
+        self.reserved = 0
+        self.waiters = 0  # Consumers waiting for an item.
+
+        mutex = threading.Lock()
+        self.lock = threading.Condition(mutex)  # Notified as items are put.
+        self.room = threading.Condition(mutex)  # Notified as items are taken.
+
+    def level(self, priority):
+        """The configured level nearest to the given priority."""
+
+        if priority is None:
+            return self.default
+
+        return min(self.weights, key=lambda level: (abs(level - priority), level))
+
+    def _full(self):
+        return self.maxsize and self.size - len(self.control) + self.reserved >= self.maxsize
+
+    def reserve(self, block=True, timeout=None):
+        """Wait for room to put an item, raising ``queue.Full`` if none is available in time."""
+
+        with self.room:
+            if block and timeout is not None:
+                deadline = clock() + timeout
+
+            while self._full():
+                remaining = None if timeout is None else deadline - clock()
+
+                if not block or (remaining is not None and remaining <= 0):
+                    raise queue.Full()
+
+                self.room.wait(remaining)
+
+            self.reserved += 1
+
+    def release(self):
+        """Abandon a reservation."""
+
+        with self.room:
+            self.reserved -= 1
+            self.room.notify()
+
+    def put(self, item, priority=None, reserved=False):
+        with self.lock:
+            if reserved:
+                self.reserved -= 1
+
+            if item is None:
+                self.control.append(item)
+
+            else:
+                level = self.level(priority)
+                work = self.levels[level]
+
+                if not work:
+                    self.passes[level] = max(self.passes[level], self.virtual)
+
+                work.append((clock(), item))
+
+            self.size += 1
+            self.lock.notify()
+
+    def get(self, block=True, timeout=None):
+        with self.lock:
+            if block and timeout is not None:
+                deadline = clock() + timeout
+
+            while not self.size:
+                remaining = None if timeout is None else deadline - clock()
+
+                if not block or (remaining is not None and remaining <= 0):
+                    raise queue.Empty()
+
+                self.waiters += 1
+
+                try:
+                    self.lock.wait(remaining)
+
+                finally:
+                    self.waiters -= 1
+
+            self.size -= 1
+            self.room.notify()
+
+            waiting = [level for level in self.levels if self.levels[level]]
+
+            if not waiting:
+                return self.control.popleft()
+
+            level = min(waiting, key=lambda level: (self.passes[level], level))
+            self.virtual = self.passes[level]
+            self.passes[level] += 1 / self.weights[level]
+
+            return self.levels[level].popleft()[1]
+
+    def qsize(self):
+        return self.size
+
+    def age(self, now=None):
+        """The number of seconds the longest waiting item has been queued."""
+
+        with self.lock:
+            queued = [work[0][0] for work in self.levels.values() if work]
+
+        return ((clock() if now is None else now) - min(queued)) if queued else 0
+
+    def full(self):
+        with self.lock:
+            return bool(self._full())
+
+    def depths(self):
+        """The number of work items waiting at each priority level."""
+
+        with self.lock:
+            return dict((level, len(work)) for level, work in self.levels.items())
+
+
 class ScalingPoolExecutor(futures.ThreadPoolExecutor):
-    def __init__(self, workers, divisor, timeout):
+    """A thread pool growing between ``minimum`` and ``workers`` threads with demand.
+
+    Threads are added as the queue deepens (one per ``divisor`` queued items) or, if ``latency`` is
+    given, whenever the oldest queued item has waited longer than that many seconds with no thread
+    free to take it.  The age of the queue is checked as work is submitted and completed and, if
+    ``monitor`` is given, by an additional thread every ``monitor`` seconds.  Threads beyond the
+    minimum are only released after ``timeout`` seconds without work, so short lulls do not cause
+    the pool to be torn down and rebuilt.  If ``recycle`` is given, threads are replaced after
+    running that many work items.
+    """
+
+    def __init__(self, workers, divisor, timeout, weights=None, maxsize=0, minimum=0, latency=None, recycle=None,
+            monitor=None):
         self._max_workers = workers
+        self._min_workers = min(minimum, workers)
         self.divisor = divisor
         self.timeout = timeout
+        self.latency = latency
+        self.recycle = recycle
 
-        self._work_queue = queue.Queue()
+        self._work_queue = PriorityQueue(weights, maxsize=maxsize)
 
         self._threads = set()
         self._shutdown = False
         self._shutdown_lock = threading.Lock()
         self._management_lock = threading.Lock()
+        self._stopped = threading.Event()
 
         atexit.register(self._atexit)
 
+        self._adjust_thread_count()
+
+        if latency is not None and monitor:
+            thread = threading.Thread(target=latency_monitor, args=(weakref.ref(self), monitor, self._stopped))
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, fn, *args, **kwargs):
+        return self.schedule(None, fn, *args, **kwargs)
+
+    def schedule(self, priority, fn, *args, **kwargs):
+        """Submit a callable to be run at the given priority level, or the default level if None."""
+        return self._schedule(priority, False, fn, args, kwargs)
+
+    def _schedule(self, priority, reserved, fn, args, kwargs):
+        # If reserved, room for the work item has already been reserved within the work queue.
+        with self._shutdown_lock:
+            if self._shutdown:
+                if reserved:
+                    self._work_queue.release()
+
+                raise RuntimeError('cannot schedule new futures after shutdown')
+            
+            f = futures.Future()
+            self._work_queue.put(WorkItem(f, fn, args, kwargs), priority, reserved)
+            self._adjust_thread_count()
+            
+            return f
+    
     def shutdown(self, wait=True):
         with self._shutdown_lock:
-            self._shutdown = True
+            with self._management_lock:
+                self._shutdown = True
+                workers = len(self._threads)
 
-            for i in range(len(self._threads)):
+            for i in range(workers):
                 self._work_queue.put(None)
 
+            self._stopped.set()
+
         if wait:
             for thread in list(self._threads):
                 thread.join()
@@ -120,44 +376,219 @@ class ScalingPoolExecutor(futures.ThreadPoolExecutor):
         self.shutdown(True)
 
     def _spawn(self):
-        t = threading.Thread(target=thread_worker, args=(weakref.ref(self), self._work_queue, self.divisor, self.timeout))
+        t = threading.Thread(target=thread_worker, args=(weakref.ref(self), self._work_queue, self.timeout, self.recycle))
         t.daemon = True
+        self._threads.add(t)
         t.start()
 
+    def _retire(self, force=False):
+        """Remove the calling thread from the pool if the pool is above its minimum size."""
+
         with self._management_lock:
-            self._threads.add(t)
+            if not force and not self._shutdown and len(self._threads) <= self._min_workers:
+                return False
+
+            self._threads.discard(threading.current_thread())
+
+        if force and not self._shutdown:
+            self._adjust_thread_count()  # Replace exhausted workers, maintaining the minimum.
+
+        return True
 
     def _adjust_thread_count(self):
-        pool = len(self._threads)
+        with self._management_lock:
+            if self._shutdown:
+                return
+
+            pool = len(self._threads)
+            optimum = self._optimum_workers
 
-        if pool < self._optimum_workers:
-            tospawn = int(self._optimum_workers - pool)
-            log.debug("Spawning %d thread%s." % (tospawn, tospawn != 1 and "s" or ""))
+            if pool < optimum:
+                tospawn = int(optimum - pool)
+                log.debug("Spawning %d thread%s.", tospawn, tospawn != 1 and "s" or "")
 
-            for i in range(tospawn):
-                self._spawn()
+                for i in range(tospawn):
+                    self._spawn()
 
     @property
     def _optimum_workers(self):
-        return min(self._max_workers, math.ceil(self._work_queue.qsize() / float(self.divisor)))
+        work = self._work_queue
+        optimum = max(self._min_workers, math.ceil(work.qsize() / float(self.divisor)))
+
+        if self.latency is not None and work.qsize() > work.waiters and work.age() > self.latency:
+            optimum = max(optimum, len(self._threads) + 1)
+
+        return min(self._max_workers, optimum)
+
+
+class Spill(object):
+    """Messages set aside on disk while the work queue is full, returned to it, oldest first, as room frees.
+
+    Only the messages are written; their receipts remain in memory.  Files left behind by a process
+    which did not stop cleanly are queued again, with new receipts, on the next startup.
+    """
+
+    __slots__ = ('path', 'entries', 'sequence', 'lock', 'thread', 'running', 'executor', 'deliver')
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.entries = deque()
+        self.sequence = count()
+        self.lock = threading.Condition()
+        self.thread = None
+        self.running = False
+        self.executor = None
+        self.deliver = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def startup(self, executor, deliver):
+        self.executor = executor
+        self.deliver = deliver
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        for name in sorted(os.listdir(self.path)):
+            log.warning("Queueing message %s spilled by a previous run.", name)
+            self.entries.append((name, futures.Future()))
+
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="Spill")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def shutdown(self):
+        """Wait for every spilled message to be returned to the work queue."""
+
+        with self.lock:
+            self.running = False
+            self.lock.notify()
+
+        self.thread.join()
+
+    def hold(self, batch):
+        """Reserve room for the given ``(message, receipt)`` pairs, or write the messages to disk.
+
+        Returns True if the messages were spilled.  Once anything is spilled everything that follows is
+        also spilled, until the backlog has been returned to the work queue, preserving order.
+        """
+
+        with self.lock:
+            if not self.entries:
+                try:
+                    self.executor._work_queue.reserve(False)
+
+                except queue.Full:
+                    pass
+
+                else:
+                    return False
+
+            for message, receipt in batch:
+                name = "%017.6f.%d_%d" % (time.time(), os.getpid(), next(self.sequence))
+
+                with open(os.path.join(self.path, name), 'wb') as fh:
+                    pickle.dump(message, fh, 2)
+
+                self.entries.append((name, receipt))
+
+            log.debug("Spilled %d messages; %d now spilled.", len(batch), len(self.entries))
+            self.lock.notify()
+
+        return True
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while self.running and not self.entries:
+                    self.lock.wait()
+
+                if not self.entries:
+                    break
+
+            self.executor._work_queue.reserve()
+
+            with self.lock:
+                name, receipt = self.entries.popleft()
+
+            filename = os.path.join(self.path, name)
+
+            try:
+                with open(filename, 'rb') as fh:
+                    message = pickle.load(fh)
+
+                os.unlink(filename)
+
+            except Exception as e:
+                log.exception("Unable to load spilled message %s.", name)
+                self.executor._work_queue.release()
+                receipt.set_exception(e)
+                continue
+
+            self.executor._schedule(priority(message), True, self.deliver, (message, receipt), {})
 
 
 class DynamicManager(object):
-    __slots__ = ('workers', 'divisor', 'timeout', 'executor', 'transport')
+    __slots__ = ('workers', 'minimum', 'divisor', 'timeout', 'latency', 'recycle', 'monitor', 'weights', 'size',
+            'policy', 'wait', 'spill', 'executor', 'transport', 'retry')
 
     name = "Dynamic"
     Executor = ScalingPoolExecutor
 
     def __init__(self, config, transport):
         self.workers = int(config.get('workers', 10))  # Maximum number of threads to create.
+        self.minimum = int(config.get('minimum', 0))  # Number of threads kept regardless of load.
         self.divisor = int(config.get('divisor', 10))  # Estimate the number of required threads by dividing the queue size by this.
         self.timeout = float(config.get('timeout', 60))  # Seconds before starvation.
+        self.latency = config.get('latency', 1)  # Seconds a delivery may wait before another thread is added.
+        self.recycle = int(config.get('recycle', 0)) or None  # Jobs before a thread is replaced; by default, never.
+        self.monitor = float(config.get('monitor', 0) or 0) or None  # Seconds between checks of queue age, if any.
+
+        if self.latency not in (None, ''):
+            self.latency = float(self.latency)
+
+        else:
+            self.latency = None
+
+        self.weights = self._weights(config)  # Relative share of workers given to each priority level.
+        self.size = int(config.get('queue.size', 0))  # Maximum number of queued work items; zero for no limit.
+        self.policy = config.get('queue.policy', 'block')  # What to do when the queue is full.
+        self.wait = config.get('queue.timeout', None)  # Seconds to block before giving up.
+        self.spill = None
+
+        if self.wait is not None:
+            self.wait = float(self.wait)
+
+        if self.policy not in ('block', 'reject', 'spill'):
+            raise MailConfigurationException("Unknown queue policy: %s" % (self.policy, ))
+
+        if self.policy == 'spill':
+            if not config.get('queue.path', None):
+                raise MailConfigurationException("The spill queue policy requires a queue.path directive.")
+
+            self.spill = Spill(config['queue.path'])
 
         self.executor = None
-        self.transport = TransportPool(transport)
+        self.transport = TransportPool.from_config(transport, config)
+        self.retry = RetryScheduler(RetryPolicy.from_config(config))
 
         super(DynamicManager, self).__init__()
 
+    @staticmethod
+    def _weights(config):
+        weights = dict(WEIGHTS)
+
+        for key in config:
+            if key == 'weights':
+                weights = dict(config[key])
+
+            elif key.startswith('weights.'):
+                weights[int(key[8:])] = config[key]
+
+        return weights
+
     def startup(self):
         log.info("%s manager starting up.", self.name)
 
@@ -166,19 +597,95 @@ class DynamicManager(object):
 
         workers = self.workers
         log.debug("Starting thread pool with %d workers." % (workers, ))
-        self.executor = self.Executor(workers, self.divisor, self.timeout)
+        self.executor = self.Executor(workers, self.divisor, self.timeout, self.weights, self.size, self.minimum,
+                self.latency, self.recycle, self.monitor)
+
+        log.debug("Starting retry scheduler.")
+        self.retry.startup(self._submit)
+
+        if self.spill is not None and self.size:
+            log.debug("Starting spill.")
+            self.spill.startup(self.executor, partial(self.retry.deliver, self.transport))
 
         log.info("%s manager ready.", self.name)
 
+    @property
+    def depths(self):
+        """The number of deliveries waiting at each priority level."""
+        return self.executor._work_queue.depths()
+
+    @property
+    def queued(self):
+        """The number of work items (deliveries or batches) waiting in memory for a worker."""
+        return self.executor._work_queue.qsize()
+
+    @property
+    def spilled(self):
+        """The number of messages waiting on disk for room within the queue."""
+        return len(self.spill) if self.spill is not None and self.size else 0
+
+    def _admit(self, level, fn, args, batch):
+        """Queue a work item delivering the given ``(message, receipt)`` pairs, subject to the queue bound."""
+
+        if not self.size:
+            self.executor.schedule(level, fn, *args)
+            return
+
+        if self.spill is not None:
+            if not self.spill.hold(batch):
+                self.executor._schedule(level, True, fn, args, {})
+
+            return
+
+        try:
+            self.executor._work_queue.reserve(self.policy == 'block', self.wait)
+
+        except queue.Full:
+            raise QueueFullException("The delivery queue is full (%d queued)." % (self.size, ))
+
+        self.executor._schedule(level, True, fn, args, {})
+
+    def _submit(self, fn, pool, message, *args):
+        # Retries are scheduled at the priority of the message being retried.
+        return self.executor.schedule(priority(message), fn, pool, message, *args)
+
     def deliver(self, message):
-        # Return the Future object so the application can register callbacks.
-        # We pass the message so the executor can do what it needs to to make
-        # the message thread-local.
-        return self.executor.submit(partial(worker, self.transport), message)
+        # Return a Future object so the application can register callbacks.  Deliveries deferred by
+        # transport failure are parked with the retry scheduler, not within a worker thread.
+        receipt = futures.Future()
+        self._admit(priority(message), self.retry.deliver, (self.transport, message, receipt), [(message, receipt)])
+        return receipt
+
+    def deliver_many(self, messages):
+        # A single work item handles each priority level within the batch, checking a transport out
+        # of the pool once per level.
+        receipts = [futures.Future() for message in messages]
+        levels = {}
+
+        for message, receipt in zip(messages, receipts):
+            levels.setdefault(priority(message), []).append((message, receipt))
+
+        for level, batch in levels.items():
+            try:
+                retry = partial(self.retry.retry, self.transport)
+                self._admit(level, deliver_batch, (self.transport, batch, retry), batch)
+
+            except QueueFullException as e:
+                for message, receipt in batch:
+                    receipt.set_exception(e)
+
+        return receipts
 
     def shutdown(self, wait=True):
         log.info("%s manager stopping.", self.name)
 
+        if self.spill is not None and self.size:
+            log.debug("Returning %d spilled messages to the queue.", len(self.spill))
+            self.spill.shutdown()
+
+        log.debug("Stopping retry scheduler.")
+        self.retry.shutdown()
+
         log.debug("Stopping thread pool.")
         self.executor.shutdown(wait=wait)
 
@@ -2,8 +2,7 @@
 
 from functools import partial
 
-from marrow.mailer.exc import TransportFailedException, TransportExhaustedException, MessageFailedException, DeliveryFailedException
-from marrow.mailer.manager.util import TransportPool
+from marrow.mailer.manager.util import TransportPool, RetryPolicy, RetryScheduler, deliver_batch
 
 try:
     from concurrent import futures
@@ -17,45 +16,15 @@ log = __import__('logging').getLogger(__name__)
 
 
 
-def worker(pool, message):
-    # This may be non-obvious, but there are several conditions which
-    # we trap later that require us to retry the entire delivery.
-    result = None
-    
-    while True:
-        with pool() as transport:
-            try:
-                result = transport.deliver(message)
-            
-            except MessageFailedException as e:
-                raise DeliveryFailedException(message, e.args[0] if e.args else "No reason given.")
-            
-            except TransportFailedException:
-                # The transport has suffered an internal error or has otherwise
-                # requested to not be recycled. Delivery should be attempted
-                # again.
-                transport.ephemeral = True
-                continue
-            
-            except TransportExhaustedException:
-                # The transport sent the message, but pre-emptively
-                # informed us that future attempts will not be successful.
-                transport.ephemeral = True
-        
-        break
-    
-    return message, result
-
-
-
 class FuturesManager(object):
-    __slots__ = ('workers', 'executor', 'transport')
+    __slots__ = ('workers', 'executor', 'transport', 'retry')
     
     def __init__(self, config, transport):
         self.workers = config.get('workers', 1)
         
         self.executor = None
-        self.transport = TransportPool(transport)
+        self.transport = TransportPool.from_config(transport, config)
+        self.retry = RetryScheduler(RetryPolicy.from_config(config))
         
         super(FuturesManager, self).__init__()
     
@@ -69,17 +38,32 @@ class FuturesManager(object):
         log.debug("Starting thread pool with %d workers." % (workers, ))
         self.executor = futures.ThreadPoolExecutor(workers)
         
+        log.debug("Starting retry scheduler.")
+        self.retry.startup(self.executor.submit)
+        
         log.info("Futures delivery manager ready.")
     
     def deliver(self, message):
-        # Return the Future object so the application can register callbacks.
-        # We pass the message so the executor can do what it needs to to make
-        # the message thread-local.
-        return self.executor.submit(partial(worker, self.transport), message)
+        # Return a Future object so the application can register callbacks.  Deliveries deferred by
+        # transport failure are parked with the retry scheduler, not within a worker thread, so the
+        # Future is our own rather than the executor's.
+        receipt = futures.Future()
+        self.executor.submit(self.retry.deliver, self.transport, message, receipt)
+        return receipt
+    
+    def deliver_many(self, messages):
+        # A single work item handles the whole batch, checking a transport out of the pool once.
+        # One Future is returned per message so the outcome of each can be tracked individually.
+        receipts = [futures.Future() for message in messages]
+        self.executor.submit(deliver_batch, self.transport, list(zip(messages, receipts)), partial(self.retry.retry, self.transport))
+        return receipts
     
     def shutdown(self, wait=True):
         log.info("Futures delivery manager stopping.")
         
+        log.debug("Stopping retry scheduler.")
+        self.retry.shutdown()
+        
         log.debug("Stopping thread pool.")
         self.executor.shutdown(wait=wait)
         
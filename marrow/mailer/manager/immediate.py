@@ -1,7 +1,14 @@
 # encoding: utf-8
 
-from marrow.mailer.exc import TransportExhaustedException, TransportFailedException, DeliveryFailedException, MessageFailedException
-from marrow.mailer.manager.util import TransportPool
+import time
+
+from marrow.mailer.exc import TransportFailedException, DeliveryFailedException
+from marrow.mailer.manager.util import TransportPool, RetryPolicy, deliver_batch, deliver_once, conclude, clock
+
+try:
+    from concurrent import futures
+except ImportError: # pragma: no cover
+    raise ImportError("You must install the futures package to use batch delivery.")
 
 
 __all__ = ['ImmediateManager']
@@ -11,13 +18,16 @@ log = __import__('logging').getLogger(__name__)
 
 
 class ImmediateManager(object):
-    __slots__ = ('transport', )
+    __slots__ = ('transport', 'retry')
+    
+    blocking = True  # Deliveries are made within the calling thread; see the domain router.
     
     def __init__(self, config, Transport):
         """Initialize the immediate delivery manager."""
         
         # Create a transport pool; this will encapsulate the recycling logic.
-        self.transport = TransportPool(Transport)
+        self.transport = TransportPool.from_config(Transport, config)
+        self.retry = RetryPolicy.from_config(config)
         
         super(ImmediateManager, self).__init__()
     
@@ -35,31 +45,54 @@ class ImmediateManager(object):
         log.info("Immediate delivery manager started.")
     
     def deliver(self, message):
-        result = None
+        """Deliver a message, blocking until delivered.
         
+        As delivery is blocking, waiting out the backoff between attempts (should the transport fail)
+        is also blocking.
+        """
+        
+        return self._deliver(message, 0, clock(), self.retry.limit(message))
+    
+    def _deliver(self, message, attempt, started, limit):
         while True:
-            with self.transport() as transport:
-                try:
-                    result = transport.deliver(message)
-                
-                except MessageFailedException as e:
-                    raise DeliveryFailedException(message, e.args[0] if e.args else "No reason given.")
+            if attempt:
+                delay = self.retry.next(attempt, started, limit)
                 
-                except TransportFailedException:
-                    # The transport has suffered an internal error or has otherwise
-                    # requested to not be recycled. Delivery should be attempted
-                    # again.
-                    transport.ephemeral = True
-                    continue
+                if delay is None:
+                    log.error("%s ABANDONED after %d attempts.", message.id, attempt)
+                    conclude(message)
+                    raise DeliveryFailedException(message, "Delivery abandoned after %d attempts." % (attempt, ))
                 
-                except TransportExhaustedException:
-                    # The transport sent the message, but pre-emptively
-                    # informed us that future attempts will not be successful.
-                    transport.ephemeral = True
+                log.info("%s DEFERRED %.2f seconds.", message.id, delay)
+                time.sleep(delay)
             
-            break
+            try:
+                return deliver_once(self.transport, message)
+            
+            except TransportFailedException:
+                attempt += 1
+            
+            except Exception:
+                conclude(message)
+                raise
+    
+    def _retry(self, message, receipt):
+        try:
+            receipt.set_result(self._deliver(message, 1, clock(), self.retry.limit(message)))
+        
+        except Exception as e:
+            receipt.set_exception(e)
+    
+    def deliver_many(self, messages):
+        """Deliver a batch of messages using a single transport checkout.
+        
+        Delivery is complete when this returns; the list of receipts (one already-resolved Future
+        per message) is returned for parity with the background managers.
+        """
         
-        return message, result
+        receipts = [futures.Future() for message in messages]
+        deliver_batch(self.transport, list(zip(messages, receipts)), self._retry)
+        return receipts
     
     def shutdown(self):
         log.info("Immediate delivery manager stopping.")
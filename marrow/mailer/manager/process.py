@@ -0,0 +1,203 @@
+# encoding: utf-8
+
+"""A delivery manager rendering and delivering messages within a pool of worker processes.
+
+Rendering a message with large attachments or rich bodies is CPU bound; within a thread pool it is
+serialized by the GIL.  Each worker process of this manager renders and delivers independently, using
+its own transport pool.
+"""
+
+import uuid
+import multiprocessing
+
+from functools import partial
+from multiprocessing.util import Finalize
+
+from marrow.mailer.exc import DeliveryFailedException, MailConfigurationException
+from marrow.mailer.manager.util import TransportPool, RetryPolicy, RetryScheduler, deliver_batch, conclude, clock
+
+try:
+    from concurrent import futures
+except ImportError: # pragma: no cover
+    raise ImportError("You must install the futures package to use process pool delivery.")
+
+
+__all__ = ['ProcessManager']
+
+log = __import__('logging').getLogger(__name__)
+
+
+# The transport pools of the current worker process, by manager token.
+_pools = {}
+
+
+
+def worker_pool(token, factory, config):
+    """Return the transport pool of the current worker process, creating and starting it on first use."""
+
+    pool = _pools.get(token)
+
+    if pool is None:
+        pool = _pools[token] = TransportPool.from_config(factory, config)
+        pool.startup()
+        Finalize(None, pool.shutdown, exitpriority=10)  # Run as the worker process exits.
+
+    return pool
+
+
+def deliver_remote(token, factory, config, messages):
+    """Deliver a batch of messages from within a worker process.
+
+    Returns one ``(outcome, value)`` pair per message; the outcome is one of ``delivered`` (the value
+    being the transport's result), ``failed`` (the reason), ``deferred`` (the envelope recipients left
+    to deliver to, the result so far, and the envelope to eventually restore; see ``settle``), or
+    ``error`` (the exception).  Messages themselves are not returned, sparing their transfer back to
+    the parent.
+    """
+
+    pool = worker_pool(token, factory, config)
+    deferred = set()
+    receipts = [futures.Future() for message in messages]
+
+    deliver_batch(pool, list(zip(messages, receipts)), lambda message, receipt: deferred.add(receipt))
+
+    outcomes = []
+
+    for message, receipt in zip(messages, receipts):
+        if receipt in deferred:
+            outcomes.append(('deferred', (getattr(message, '_recipients', None), getattr(message, '_result', None), getattr(message, '_restore', None))))
+            continue
+
+        exception = receipt.exception()
+
+        if exception is None:
+            outcomes.append(('delivered', receipt.result()[1]))
+
+        elif isinstance(exception, DeliveryFailedException):
+            outcomes.append(('failed', exception.reason))
+
+        else:
+            outcomes.append(('error', exception))
+
+    return outcomes
+
+
+
+class ProcessManager(object):
+    """Deliver messages from a pool of ``workers`` processes, returning a ``Future`` per message.
+
+    Messages are pickled (without their MIME tree; see ``Message.__getstate__``) and rendered within
+    the worker.  Transports must therefore be importable by the worker processes, as must any
+    callable message bodies be resolvable prior to delivery.  Deliveries deferred by transport
+    failure are rescheduled by the parent, so any worker may attempt the retry.
+
+    With the ``pool.prewarm`` directive the worker processes are started along with the manager, each
+    starting its transport pool (and so its prewarmed transports) as it starts.  This requires the
+    ``initializer`` argument of ``ProcessPoolExecutor``, added in Python 3.7.
+    """
+
+    __slots__ = ('workers', 'token', 'factory', 'options', 'executor', 'retry')
+
+    def __init__(self, config, transport):
+        self.workers = int(config.get('workers', 0)) or multiprocessing.cpu_count()
+        self.token = uuid.uuid4().hex
+        self.factory = transport
+
+        # Only the transport pool directives are needed by the workers.
+        self.options = dict((key, value) for key, value in config.items() if key.startswith('pool.') or key == 'render')
+
+        self.executor = None
+        self.retry = RetryScheduler(RetryPolicy.from_config(config))
+
+        super(ProcessManager, self).__init__()
+
+    def startup(self):
+        log.info("Process pool delivery manager starting.")
+
+        log.debug("Starting process pool with %d workers." % (self.workers, ))
+
+        if self.options.get('pool.prewarm', None) in (None, '', 0, '0'):
+            self.executor = futures.ProcessPoolExecutor(self.workers)
+
+        else:
+            try:
+                self.executor = futures.ProcessPoolExecutor(self.workers, initializer=worker_pool,
+                        initargs=(self.token, self.factory, self.options))
+
+            except TypeError:
+                raise MailConfigurationException("The pool.prewarm directive of the process manager requires Python 3.7 or later.")
+
+            for i in range(self.workers):
+                self.executor.submit(int)  # Start the worker processes now, rather than as messages arrive.
+
+        log.debug("Starting retry scheduler.")
+        self.retry.startup(self._resubmit)
+
+        log.info("Process pool delivery manager ready.")
+
+    def deliver(self, message):
+        return self.deliver_many([message])[0]
+
+    def deliver_many(self, messages):
+        # A single task handles the whole batch, sending the messages to a worker together.
+        receipts = [futures.Future() for message in messages]
+        entries = []
+
+        for message, receipt in zip(messages, receipts):
+            if receipt.set_running_or_notify_cancel():
+                entries.append((message, receipt, 0, clock(), self.retry.policy.limit(message)))
+
+        self._submit(entries)
+        return receipts
+
+    def _resubmit(self, fn, pool, message, receipt, attempt, started, limit):
+        # Called by the retry scheduler as deferred deliveries come due.
+        self._submit([(message, receipt, attempt, started, limit)])
+
+    def _submit(self, entries):
+        if not entries:
+            return
+
+        outcome = self.executor.submit(deliver_remote, self.token, self.factory, self.options, [entry[0] for entry in entries])
+        outcome.add_done_callback(partial(self._complete, entries))
+
+    def _complete(self, entries, outcome):
+        exception = outcome.exception()
+
+        if exception is not None:
+            log.error("Delivery of %d messages failed within the worker process: %r", len(entries), exception)
+
+            for entry in entries:
+                entry[1].set_exception(exception)
+
+            return
+
+        for (message, receipt, attempt, started, limit), (kind, value) in zip(entries, outcome.result()):
+            if kind == 'deferred':
+                if value[1] is not None:  # Only some recipients remain to be delivered to.
+                    message._recipients, message._result, message._restore = value
+
+                self.retry.defer(None, message, receipt, attempt + 1, started, limit)
+                continue
+
+            conclude(message)  # The worker concluded its own copy of the message.
+
+            if kind == 'delivered':
+                receipt.set_result((message, value))
+
+            elif kind == 'failed':
+                receipt.set_exception(DeliveryFailedException(message, value))
+
+            else:
+                receipt.set_exception(value)
+
+    def shutdown(self, wait=True):
+        log.info("Process pool delivery manager stopping.")
+
+        log.debug("Stopping retry scheduler.")
+        self.retry.shutdown()
+
+        log.debug("Stopping process pool.")
+        self.executor.shutdown(wait=wait)
+
+        log.info("Process pool delivery manager stopped.")
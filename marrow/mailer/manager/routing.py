@@ -0,0 +1,322 @@
+# encoding: utf-8
+
+"""Per-destination-domain concurrency and rate limits, applied ahead of the delivery manager."""
+
+import threading
+
+from collections import deque
+from functools import partial
+
+from marrow.mailer.exc import MailConfigurationException, MailerNotRunning
+from marrow.mailer.manager.util import clock
+
+try:
+    from concurrent import futures
+except ImportError: # pragma: no cover
+    raise ImportError("You must install the futures package to use domain routing.")
+
+
+__all__ = ['TokenBucket', 'Route', 'DomainRouter']
+
+log = __import__('logging').getLogger(__name__)
+
+
+
+class TokenBucket(object):
+    """A token bucket permitting ``rate`` events per second, with bursts of up to ``capacity`` events.
+
+    Not thread safe; the router serializes access.
+    """
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1, self.rate))
+        self.tokens = self.capacity
+        self.updated = clock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now=None):
+        """The number of seconds until a token is available; zero if one is available now."""
+
+        self._refill(clock() if now is None else now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, now=None):
+        """Take a token if one is available, returning True if one was taken."""
+
+        if self.delay(now):
+            return False
+
+        self.tokens -= 1
+        return True
+
+
+class Route(object):
+    """The limits and queue of deliveries for a single destination domain."""
+
+    __slots__ = ('domain', 'connections', 'bucket', 'active', 'queue')
+
+    options = ('connections', 'rate', 'burst')  # Those which may be configured.
+
+    def __init__(self, domain, connections=None, rate=None, burst=None):
+        self.domain = domain
+        self.connections = int(connections) if connections not in (None, '') else None
+        self.bucket = TokenBucket(float(rate), float(burst) if burst not in (None, '') else None) if rate not in (None, '') else None
+        self.active = 0
+        self.queue = deque()
+
+    def __repr__(self):
+        return "Route(%s, active=%d, queued=%d)" % (self.domain, self.active, len(self.queue))
+
+    @property
+    def saturated(self):
+        return self.connections is not None and self.active >= self.connections
+
+
+class DomainRouter(object):
+    """Hold back deliveries to rate or concurrency limited domains until the manager may attempt them.
+
+    Messages without a recipient within a limited domain are handed to the manager untouched.  The rest
+    are queued by domain, oldest first, and released by a dispatcher thread once every limited domain
+    among their recipients has a free connection and, if rate limited, a token.  A domain which is
+    waiting never holds up deliveries to any other: a message waiting on one of its domains is moved
+    to the head of that domain's queue, out of the way of those behind it.
+
+    The deliveries of a ``blocking`` manager (the immediate manager) are made within the calling thread
+    once the limits permit, returning the manager's own result; otherwise a ``Future`` is returned.
+    """
+
+    __slots__ = ('manager', 'routes', 'lock', 'thread', 'running')
+
+    def __init__(self, manager, limits):
+        if getattr(manager, 'asynchronous', False):
+            raise MailConfigurationException("Domain limits can not be used with an asynchronous manager.")
+
+        self.manager = manager
+        self.routes = {}
+
+        for domain, options in limits.items():
+            unknown = sorted(set(options) - set(Route.options))
+
+            if unknown:
+                raise MailConfigurationException("Unknown option %r for domain %s; expected one of: %s." % (
+                        unknown[0], domain, ", ".join(Route.options)))
+
+            try:
+                self.routes[domain] = Route(domain, **options)
+
+            except ValueError as e:
+                raise MailConfigurationException("Invalid limits for domain %s: %s" % (domain, e))
+        self.lock = threading.Condition()
+        self.thread = None
+        self.running = False
+
+    @classmethod
+    def from_config(cls, manager, config):
+        """Construct a router from the ``domains`` manager directive, or return None if absent.
+
+        The directive is a mapping of domain names to ``connections``, ``rate``, and ``burst`` limits;
+        flattened keys such as ``domains.example.com.rate`` are also understood.
+        """
+
+        limits = {}
+
+        for key in config:
+            if key == 'domains':
+                for domain, options in config[key].items():
+                    limits.setdefault(domain, {}).update(options)
+
+            elif key.startswith('domains.'):
+                domain, _, option = key[8:].rpartition('.')
+                limits.setdefault(domain, {})[option] = config[key]
+
+        if not limits:
+            return None
+
+        return cls(manager, dict((domain.encode('idna').decode('ascii').lower(), options) for domain, options in limits.items()))
+
+    def startup(self):
+        self.running = True
+
+        self.thread = threading.Thread(target=self._run, name="DomainRouter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def shutdown(self):
+        """Stop accepting messages, waiting until every queued message has been handed to the manager."""
+
+        with self.lock:
+            self.running = False
+            self.lock.notify()
+
+        self.thread.join()
+
+    def routes_for(self, message):
+        domains = set(address.rpartition('@')[2].lower() for address in message.recipients.string_addresses)
+        return sorted((self.routes[domain] for domain in domains if domain in self.routes), key=lambda route: route.domain)
+
+    def _enqueue(self, message, routes):
+        receipt = futures.Future()
+
+        with self.lock:
+            if not self.running:
+                raise MailerNotRunning("Domain router not running.")
+
+            routes[0].queue.append((message, receipt, routes))
+            self.lock.notify()
+
+        return receipt
+
+    def deliver(self, message):
+        routes = self.routes_for(message)
+
+        if not routes:
+            return self.manager.deliver(message)
+
+        if not getattr(self.manager, 'blocking', False):
+            return self._enqueue(message, routes)
+
+        # Wait for our turn, queued without a message, then deliver as the manager would have.
+        self._enqueue(None, routes).result()
+
+        try:
+            return self.manager.deliver(message)
+
+        finally:
+            self._release(routes)
+
+    def deliver_many(self, messages, deliver):
+        """Queue the messages requiring it, passing the remainder in bulk to the given ``deliver`` callable."""
+
+        receipts = [None] * len(messages)
+        direct = []
+
+        blocking = getattr(self.manager, 'blocking', False)
+
+        for i, message in enumerate(messages):
+            routes = self.routes_for(message)
+
+            if routes and blocking:
+                receipts[i] = receipt = futures.Future()
+
+                try:
+                    receipt.set_result(self.deliver(message))
+
+                except Exception as e:
+                    receipt.set_exception(e)
+
+            elif routes:
+                receipts[i] = self._enqueue(message, routes)
+
+            else:
+                direct.append(i)
+
+        if direct:
+            for i, receipt in zip(direct, deliver([messages[i] for i in direct])):
+                receipts[i] = receipt
+
+        return receipts
+
+    def _ready(self, now):
+        """Dequeue every delivery which may proceed, returning them and the seconds until another might."""
+
+        ready, wake = [], None
+
+        def blocked(route):
+            return route.saturated or (route.bucket.delay(now) if route.bucket else 0)
+
+        for route in self.routes.values():
+            while route.queue:
+                message, receipt, routes = route.queue[0]
+                blocker = route if blocked(route) else next((i for i in routes if blocked(i)), None)
+
+                if blocker is not None:
+                    delay = 0 if blocker.saturated else blocker.bucket.delay(now)
+
+                    if delay:
+                        wake = delay if wake is None else min(wake, delay)
+
+                    if blocker is route:
+                        break  # Woken again as deliveries complete, or once a token is due.
+
+                    # Wait at the head of the queue of the domain holding it up, not this one.
+                    route.queue.popleft()
+                    blocker.queue.appendleft((message, receipt, routes))
+                    continue
+
+                route.queue.popleft()
+
+                for i in routes:
+                    i.active += 1
+
+                    if i.bucket:
+                        i.bucket.consume(now)
+
+                ready.append((message, receipt, routes))
+
+        return ready, wake
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while True:
+                    ready, wake = self._ready(clock())
+
+                    if ready or (not self.running and not any(route.queue for route in self.routes.values())):
+                        break
+
+                    self.lock.wait(wake)
+
+            if not ready:
+                break
+
+            for message, receipt, routes in ready:
+                self._dispatch(message, receipt, routes)
+
+    def _dispatch(self, message, receipt, routes):
+        if not receipt.set_running_or_notify_cancel():
+            self._release(routes)
+            return
+
+        if message is None:
+            receipt.set_result(None)  # A blocking delivery, made by the waiting caller; see deliver.
+            return
+
+        try:
+            outcome = self.manager.deliver(message)
+
+        except Exception as e:
+            self._release(routes)
+            receipt.set_exception(e)
+            return
+
+        if isinstance(outcome, futures.Future):
+            outcome.add_done_callback(partial(self._complete, receipt, routes))
+            return
+
+        self._release(routes)
+        receipt.set_result(outcome)
+
+    def _complete(self, receipt, routes, outcome):
+        self._release(routes)
+
+        if outcome.cancelled():
+            receipt.set_exception(futures.CancelledError())
+
+        elif outcome.exception() is not None:
+            receipt.set_exception(outcome.exception())
+
+        else:
+            receipt.set_result(outcome.result())
+
+    def _release(self, routes):
+        with self.lock:
+            for route in routes:
+                route.active -= 1
+
+            self.lock.notify()
@@ -0,0 +1,269 @@
+# encoding: utf-8
+
+"""A durable delivery manager backed by an on-disk, maildir-style spool."""
+
+import os
+import time
+import socket
+import threading
+
+from itertools import count
+from functools import partial
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from marrow.util.convert import boolean
+
+from marrow.mailer.exc import DeliveryFailedException, DeliveryDeferredException, MailConfigurationException
+from marrow.mailer.manager.util import TransportPool, RetryPolicy, RetryScheduler, deliver_batch
+
+try:
+    from concurrent import futures
+except ImportError: # pragma: no cover
+    raise ImportError("You must install the futures package to use spooled delivery.")
+
+
+__all__ = ['SpoolManager']
+
+log = __import__('logging').getLogger(__name__)
+
+
+
+class SpoolManager(object):
+    """Persist messages to disk before delivering them from a pool of worker threads.
+
+    Each message is pickled into ``tmp/``, made durable, then renamed into ``new/``.  Writes made while a
+    previous group is being synchronized are made durable together, so the cost of ``fsync`` is shared
+    across concurrent producers.  Once durable, messages are handed to the workers in batches; those
+    delivered are removed from the spool, and those refused are moved to ``failed/``.  Anything left in
+    ``new/`` when the process stops, cleanly or otherwise, is delivered after the next startup.
+
+    As with the futures manager, ``deliver()`` returns a ``Future`` resolving to ``(message, result)``.
+    """
+
+    __slots__ = ('path', 'workers', 'batch', 'sync', 'executor', 'transport', 'retry', 'pending', 'lock', 'syncer', 'running', 'sequence', 'hostname')
+
+    def __init__(self, config, transport):
+        if not config.get('path', None):
+            raise MailConfigurationException("The spool manager requires a path directive.")
+
+        self.path = os.path.abspath(config['path'])
+        self.workers = int(config.get('workers', 1))
+        self.batch = int(config.get('batch', 100))
+        self.sync = boolean(config.get('sync', True))
+
+        self.executor = None
+        self.transport = TransportPool.from_config(transport, config)
+        self.retry = RetryScheduler(RetryPolicy.from_config(config))
+
+        self.pending = []
+        self.lock = threading.Condition()
+        self.syncer = None
+        self.running = False
+        self.sequence = count()
+        self.hostname = socket.gethostname().replace('/', '_').replace(':', '_')
+
+        super(SpoolManager, self).__init__()
+
+    def startup(self):
+        log.info("Spool delivery manager starting.")
+
+        for name in ('tmp', 'new', 'failed'):
+            directory = os.path.join(self.path, name)
+
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+        log.debug("Initializing transport queue.")
+        self.transport.startup()
+
+        log.debug("Starting thread pool with %d workers." % (self.workers, ))
+        self.executor = futures.ThreadPoolExecutor(self.workers)
+
+        log.debug("Starting retry scheduler.")
+        self.retry.startup(self.executor.submit)
+
+        self.recover()
+
+        self.running = True
+        self.syncer = threading.Thread(target=self._synchronize, name="SpoolSynchronizer")
+        self.syncer.daemon = True
+        self.syncer.start()
+
+        log.info("Spool delivery manager ready.")
+
+    def recover(self):
+        """Resume delivery of messages spooled by a previous run, oldest first."""
+
+        for name in os.listdir(os.path.join(self.path, 'tmp')):
+            # Never made durable, and thus never acknowledged as spooled.
+            os.unlink(os.path.join(self.path, 'tmp', name))
+
+        entries = []
+
+        for name in sorted(os.listdir(os.path.join(self.path, 'new'))):
+            try:
+                with open(os.path.join(self.path, 'new', name), 'rb') as fh:
+                    message = pickle.load(fh)
+
+            except Exception:
+                log.exception("Unable to load spooled message %s; moving to failed.", name)
+                self._move(name, 'failed')
+                continue
+
+            entries.append((name, message, futures.Future()))
+
+        if entries:
+            log.info("Resuming delivery of %d spooled messages.", len(entries))
+            self._dispatch(entries)
+
+        return len(entries)
+
+    def deliver(self, message):
+        return self.deliver_many([message])[0]
+
+    def deliver_many(self, messages):
+        # Each file is written and closed here, and reopened only to be made durable, so no more than a
+        # single descriptor is held however large the batch.  Should any message fail to be spooled, none
+        # of the batch is.
+        entries = []
+
+        try:
+            for message in messages:
+                message.segments  # Validate and render the message within the calling thread.
+                name = "%017.6f.%d_%d.%s" % (time.time(), os.getpid(), next(self.sequence), self.hostname)
+                entries.append((name, message, futures.Future()))
+
+                with open(os.path.join(self.path, 'tmp', name), 'wb') as fh:
+                    pickle.dump(message, fh, 2)
+
+            with self.lock:
+                if not self.running:
+                    raise RuntimeError("Cannot spool messages after shutdown.")
+
+                self.pending.extend(entries)
+                self.lock.notify()
+
+        except:
+            for name, message, receipt in entries:
+                try:
+                    os.unlink(os.path.join(self.path, 'tmp', name))
+
+                except OSError:
+                    pass
+
+            raise
+
+        return [receipt for name, message, receipt in entries]
+
+    def _synchronize(self):
+        """Make spooled messages durable in groups, then hand them to the workers."""
+
+        while True:
+            with self.lock:
+                while self.running and not self.pending:
+                    self.lock.wait()
+
+                entries, self.pending = self.pending, []
+
+                if not entries and not self.running:
+                    break
+
+            durable = []
+
+            for name, message, receipt in entries:
+                path = os.path.join(self.path, 'tmp', name)
+
+                try:
+                    if self.sync:
+                        self._sync_file(path)
+
+                    os.rename(path, os.path.join(self.path, 'new', name))
+
+                except Exception as e:
+                    log.exception("Unable to spool message %s.", message.id)
+                    receipt.set_exception(e)
+                    continue
+
+                durable.append((name, message, receipt))
+
+            if self.sync:
+                self._sync_directory('new')
+
+            if durable:
+                self._dispatch(durable)
+
+    def _sync_file(self, path):
+        fd = os.open(path, os.O_RDWR)  # Writable, as some platforms refuse to flush a read-only descriptor.
+
+        try:
+            os.fsync(fd)
+
+        finally:
+            os.close(fd)
+
+    def _sync_directory(self, name):
+        try:
+            fd = os.open(os.path.join(self.path, name), os.O_RDONLY)
+
+        except OSError: # pragma: no cover
+            return  # E.g. Windows, where directories can not be opened.
+
+        try:
+            os.fsync(fd)
+
+        finally:
+            os.close(fd)
+
+    def _dispatch(self, entries):
+        # Spread the entries evenly across the workers, to a maximum of one batch each.
+        size = max(1, min(self.batch, -(-len(entries) // self.workers)))
+
+        for i in range(0, len(entries), size):
+            self.executor.submit(self._drain, entries[i:i + size])
+
+    def _drain(self, entries):
+        for name, message, receipt in entries:
+            receipt.add_done_callback(partial(self._acknowledge, name, message))
+
+        deliver_batch(self.transport, [(message, receipt) for name, message, receipt in entries], partial(self.retry.retry, self.transport))
+
+    def _acknowledge(self, name, message, receipt):
+        exception = None if receipt.cancelled() else receipt.exception()
+
+        if exception is None:
+            os.unlink(os.path.join(self.path, 'new', name))
+
+        elif isinstance(exception, DeliveryFailedException) and not isinstance(exception, DeliveryDeferredException):
+            self._move(name, 'failed')
+
+        else:
+            log.error("Message %s remains spooled for delivery after restart.", message.id)
+
+    def _move(self, name, folder):
+        os.rename(os.path.join(self.path, 'new', name), os.path.join(self.path, folder, name))
+
+    def shutdown(self, wait=True):
+        log.info("Spool delivery manager stopping.")
+
+        log.debug("Flushing spool.")
+
+        with self.lock:
+            self.running = False
+            self.lock.notify()
+
+        self.syncer.join()
+
+        log.debug("Stopping retry scheduler.")
+        self.retry.shutdown()
+
+        log.debug("Stopping thread pool.")
+        self.executor.shutdown(wait=wait)
+
+        log.debug("Draining transport queue.")
+        self.transport.shutdown()
+
+        log.info("Spool delivery manager stopped.")
@@ -1,63 +1,314 @@
 # encoding: utf-8
 
+import time
+import random
+import threading
+
+from heapq import heappush, heappop
+from itertools import count
+from collections import deque
+from threading import Condition
+
+from marrow.mailer.address import AddressList
+from marrow.mailer.exc import TransportFailedException, TransportExhaustedException, MessageFailedException, DeliveryFailedException, DeliveryDeferredException, PoolTimeoutException, RecipientsDeferredException
+from marrow.mailer.result import DeliveryResult
+
 try:
-    import queue
-except ImportError:
-    import Queue as queue
+    from concurrent import futures
+except ImportError: # pragma: no cover
+    raise ImportError("You must install the futures package to use batch delivery.")
 
 
-__all__ = ['TransportPool']
+__all__ = ['TransportPool', 'RetryPolicy', 'RetryScheduler', 'BatchResult', 'deliver_once', 'deliver_batch', 'settle', 'conclude']
 
 log = __import__('logging').getLogger(__name__)
 
+clock = getattr(time, 'monotonic', time.time)
+
 
 
 class TransportPool(object):
-    __slots__ = ('factory', 'transports')
+    """A thread-safe pool of transport instances, checked out using the ``with pool() as transport`` idiom.
+    
+    By default the pool is unbounded and idle transports are kept forever.  Optionally:
+    
+    * ``size`` caps the number of transports in existence (idle or checked out); once reached, callers
+      block until one is returned, for up to ``timeout`` seconds before ``PoolTimeoutException``.
+    * ``idle`` is the number of seconds an unused transport is kept before being shut down.
+    * ``age`` is the number of seconds after creation a transport is retired, regardless of use.
+    * ``probe`` is the number of seconds a transport may sit idle before it is checked, by way of its
+      optional ``alive()`` method (e.g. SMTP NOOP), prior to re-use; ``0`` checks on every re-use.
+    * ``render`` has messages rendered by ``deliver_once`` and ``deliver_batch`` before a transport is
+      checked out, rather than by the transport, so transports are only held for their I/O.
+    * ``prewarm`` transports are started, in parallel, by ``startup``; a background thread then starts
+      more as they are checked out or discarded, keeping that many idle and ready for use.
+    
+    Counts of transports created, reused, evicted, and waited for are kept in ``stats``.
+    """
     
-    def __init__(self, factory):
+    __slots__ = ('factory', 'transports', 'size', 'timeout', 'idle', 'age', 'probe', 'render', 'prewarm', 'active', 'lock', 'stats', 'wanted', 'refill')
+    
+    def __init__(self, factory, size=None, timeout=None, idle=None, age=None, probe=None, render=False, prewarm=0):
         self.factory = factory
-        self.transports = queue.Queue()
+        self.transports = deque()  # Idle (released, created, transport) entries, most recently released last.
+        
+        self.size = size
+        self.timeout = timeout
+        self.idle = idle
+        self.age = age
+        self.probe = probe
+        self.render = render
+        self.prewarm = prewarm or 0
+        
+        self.active = 0  # Transports in existence, whether idle or checked out.
+        self.lock = Condition()
+        self.stats = dict(created=0, reused=0, evicted=0, waited=0)
+        
+        self.wanted = threading.Event()  # Set when the refill thread should top up the idle transports.
+        self.refill = None
+    
+    @classmethod
+    def from_config(cls, factory, config):
+        """Construct a pool using the ``pool.*`` and ``render`` directives of a manager's configuration."""
+        
+        def option(name, kind=float):
+            value = config.get('pool.' + name, None)
+            return None if value in (None, '') else kind(value)
+        
+        return cls(factory, option('size', int), option('timeout'), option('idle'), option('age'), option('probe'),
+                config.get('render', None) == 'worker', option('prewarm', int))
     
     def startup(self):
-        pass
+        if not self.prewarm:
+            return
+        
+        log.debug("Starting %d transports.", self.prewarm)
+        self.warm()
+        
+        self.wanted.clear()
+        self.refill = threading.Thread(target=self._refill, name="TransportPool")
+        self.refill.daemon = True
+        self.refill.start()
+    
+    def warm(self):
+        """Start transports, in parallel, until ``prewarm`` are idle or the pool is full; returns the number started."""
+        
+        with self.lock:
+            count = self.prewarm - len(self.transports)
+            
+            if self.size is not None:
+                count = min(count, self.size - self.active)
+            
+            count = max(0, count)
+            self.active += count  # Reserve the slots, so concurrent acquisition can not overfill the pool.
+            self.stats['created'] += count
+        
+        threads = [threading.Thread(target=self._warm) for i in range(count)]
+        
+        for thread in threads:
+            thread.start()
+        
+        for thread in threads:
+            thread.join()
+        
+        return count
+    
+    def _warm(self):
+        try:
+            transport = self.factory()
+            transport.startup()
+        
+        except Exception:
+            log.warning("Unable to start a transport in advance of use.", exc_info=True)
+            
+            with self.lock:
+                self.active -= 1
+                self.lock.notify()
+            
+            return
+        
+        now = clock()
+        
+        with self.lock:
+            self.transports.appendleft((now, now, transport))  # Behind any transports already proven in use.
+            self.lock.notify()
+    
+    def _refill(self):
+        failures = 0
+        
+        while self.refill is not None:
+            # Poll occasionally, as idle transports may also be lost to eviction by another thread.
+            self.wanted.wait(min(2 ** failures, 60) if failures else 5)
+            self.wanted.clear()
+            
+            if self.refill is None:
+                break
+            
+            self.evict()
+            
+            with self.lock:
+                before = len(self.transports)
+            
+            started = self.warm()
+            
+            with self.lock:
+                failures = failures + 1 if started and len(self.transports) <= before else 0
     
     def shutdown(self):
+        refill, self.refill = self.refill, None
+        
+        if refill is not None:
+            self.wanted.set()
+            refill.join()
+        
+        with self.lock:
+            transports = [transport for released, created, transport in self.transports]
+            self.transports.clear()
+            self.active -= len(transports)
+            self.lock.notify_all()
+        
+        for transport in transports:
+            transport.shutdown()
+    
+    def _expired(self, now, released, created):
+        return (self.idle is not None and now - released >= self.idle) or (self.age is not None and now - created >= self.age)
+    
+    def evict(self):
+        """Shut down any idle transports which have outlived the ``idle`` or ``age`` limits."""
+        
+        now = clock()
+        evicted = []
+        
+        with self.lock:
+            for entry in list(self.transports):
+                if self._expired(now, entry[0], entry[1]):
+                    self.transports.remove(entry)
+                    evicted.append(entry[2])
+            
+            self._discarded(len(evicted), True)
+        
+        for transport in evicted:
+            log.debug("Evicting expired transport instance.")
+            transport.shutdown()
+        
+        return len(evicted)
+    
+    def _discarded(self, count=1, evicted=False):
+        # Must be called with the lock held.
+        if not count:
+            return
+        
+        self.active -= count
+        
+        if evicted:
+            self.stats['evicted'] += count
+        
+        self.lock.notify(count)
+        
+        if self.prewarm:
+            self.wanted.set()
+    
+    def acquire(self):
+        """Check out an idle transport, or create a new one if the pool permits, returning (transport, created)."""
+        
+        self.evict()
+        deadline = None if self.timeout is None else clock() + self.timeout
+        
+        while True:
+            with self.lock:
+                waited = False
+                
+                while not self.transports and self.size is not None and self.active >= self.size:
+                    remaining = None if deadline is None else deadline - clock()
+                    
+                    if remaining is not None and remaining <= 0:
+                        raise PoolTimeoutException("Unable to acquire a transport within %r seconds." % (self.timeout, ))
+                    
+                    if not waited:
+                        waited = True
+                        self.stats['waited'] += 1
+                    
+                    self.lock.wait(remaining)
+                
+                if self.transports:
+                    released, created, transport = self.transports.pop()
+                    
+                    if self.prewarm:
+                        self.wanted.set()
+                
+                else:
+                    self.active += 1
+                    self.stats['created'] += 1
+                    released = created = transport = None
+            
+            if transport is None:
+                # No transport is available, so we initialize another one.
+                log.debug("Unable to acquire existing transport, initalizing new instance.")
+                
+                try:
+                    transport = self.factory()
+                    transport.startup()
+                
+                except:
+                    with self.lock:
+                        self._discarded()
+                    
+                    raise
+                
+                return transport, clock()
+            
+            alive = getattr(transport, 'alive', None)
+            
+            if self.probe is not None and alive is not None and clock() - released >= self.probe and not alive():
+                log.debug("Discarding unresponsive transport instance.")
+                self.discard(transport, True)
+                continue
+            
+            log.debug("Acquired existing transport instance.")
+            
+            with self.lock:
+                self.stats['reused'] += 1
+            
+            return transport, created
+    
+    def release(self, transport, created):
+        """Return a checked out transport to the pool for re-use."""
+        
+        now = clock()
+        
+        if self.age is not None and now - created >= self.age:
+            log.debug("Transport has reached its maximum age, shutting down instance.")
+            self.discard(transport, True)
+            return
+        
+        log.debug("Scheduling transport instance for re-use.")
+        
+        with self.lock:
+            self.transports.append((now, created, transport))
+            self.lock.notify()
+    
+    def discard(self, transport, evicted=False):
+        """Shut down a checked out transport, freeing its slot in the pool."""
+        
         try:
-            while True:
-                transport = self.transports.get(False)
-                transport.shutdown()
+            transport.shutdown()
         
-        except queue.Empty:
-            pass
+        finally:
+            with self.lock:
+                self._discarded(1, evicted)
     
     class Context(object):
-        __slots__ = ('pool', 'transport')
+        __slots__ = ('pool', 'transport', 'created')
         
         def __init__(self, pool):
             self.pool = pool
             self.transport = None
+            self.created = None
         
         def __enter__(self):
-            # First we attempt to find an available transport.
-            pool = self.pool
-            transport = None
-            
-            while not transport:
-                try:
-                    # By consuming transports this way, we maintain thread safety.
-                    # Transports are only accessed by a single thread at a time.
-                    transport = pool.transports.get(False)
-                    log.debug("Acquired existing transport instance.")
-                
-                except queue.Empty:
-                    # No transport is available, so we initialize another one.
-                    log.debug("Unable to acquire existing transport, initalizing new instance.")
-                    transport = pool.factory()
-                    transport.startup()
-            
-            self.transport = transport
-            return transport
+            # Transports are only accessed by a single thread at a time.
+            self.transport, self.created = self.pool.acquire()
+            return self.transport
         
         def __exit__(self, type, value, traceback):
             transport = self.transport
@@ -65,16 +316,432 @@ class TransportPool(object):
             
             if type is not None:
                 log.error("Shutting down transport due to unhandled exception.", exc_info=True)
-                transport.shutdown()
+                self.pool.discard(transport)
                 return
             
             if not ephemeral:
-                log.debug("Scheduling transport instance for re-use.")
-                self.pool.transports.put(transport)
+                self.pool.release(transport, self.created)
             
             else:
                 log.debug("Transport marked as ephemeral, shutting down instance.")
-                transport.shutdown()
+                self.pool.discard(transport)
     
     def __call__(self):
         return self.Context(self)
+
+
+
+class RetryPolicy(object):
+    """Exponential backoff, with jitter, for deliveries deferred by a transport failure.
+    
+    Retry ``n`` is delayed by ``delay * factor ** (n - 1)`` seconds, capped at ``maximum``, then varied
+    randomly by up to ``jitter`` (a fraction of the delay) in either direction so that messages
+    deferred together are not retried together.  Delivery is abandoned after ``attempts`` retries (by
+    default the message's own ``retries`` value) or once ``deadline`` seconds have passed since the
+    first attempt.
+    """
+    
+    __slots__ = ('delay', 'factor', 'maximum', 'jitter', 'deadline', 'attempts')
+    
+    def __init__(self, delay=1, factor=2, maximum=300, jitter=0.1, deadline=None, attempts=None):
+        self.delay = delay
+        self.factor = factor
+        self.maximum = maximum
+        self.jitter = jitter
+        self.deadline = deadline
+        self.attempts = attempts
+    
+    @classmethod
+    def from_config(cls, config):
+        """Construct a policy using the ``retry.*`` directives of a manager's configuration."""
+        
+        policy = cls()
+        
+        for name, kind in (('delay', float), ('factor', float), ('maximum', float), ('jitter', float), ('deadline', float), ('attempts', int)):
+            value = config.get('retry.' + name, None)
+            
+            if value not in (None, ''):
+                setattr(policy, name, kind(value))
+        
+        return policy
+    
+    def limit(self, message):
+        """The number of retries permitted for the given message, determined prior to its first attempt."""
+        return self.attempts if self.attempts is not None else max(0, getattr(message, 'retries', 0))
+    
+    def backoff(self, attempt):
+        delay = min(self.maximum, self.delay * self.factor ** (attempt - 1))
+        
+        if self.jitter:
+            delay *= 1 + self.jitter * (2 * random.random() - 1)
+        
+        return max(0, delay)
+    
+    def next(self, attempt, started, limit):
+        """Return the number of seconds to wait before retry number ``attempt``, or None to give up."""
+        
+        if attempt > limit:
+            return None
+        
+        delay = self.backoff(attempt)
+        
+        if self.deadline is not None and clock() + delay - started > self.deadline:
+            return None
+        
+        return delay
+
+
+class RetryScheduler(object):
+    """Park deliveries deferred by transport failure until their retry is due.
+    
+    Parked deliveries are held in a heap ordered by due time; a single timer thread hands each back to
+    the manager's ``submit`` callable (typically an executor's) as it comes due, so no worker thread is
+    occupied while a delivery waits.  On shutdown every parked delivery is released for a final attempt.
+    """
+    
+    __slots__ = ('policy', 'submit', 'heap', 'lock', 'thread', 'running', 'sequence')
+    
+    def __init__(self, policy=None):
+        self.policy = policy or RetryPolicy()
+        self.submit = None
+        self.heap = []
+        self.lock = Condition()
+        self.thread = None
+        self.running = False
+        self.sequence = count()
+    
+    def __len__(self):
+        """The number of deliveries currently deferred."""
+        return len(self.heap)
+    
+    def startup(self, submit):
+        self.submit = submit
+        self.running = True
+        
+        self.thread = threading.Thread(target=self._run, name="RetryScheduler")
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def shutdown(self):
+        with self.lock:
+            self.running = False
+            entries = [entry for due, sequence, entry in sorted(self.heap)]
+            del self.heap[:]
+            self.lock.notify()
+        
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        
+        if entries:
+            log.info("Releasing %d deferred deliveries for a final attempt.", len(entries))
+        
+        for entry in entries:
+            self.submit(self.deliver, *entry)
+    
+    def _run(self):
+        while True:
+            with self.lock:
+                while self.running and (not self.heap or self.heap[0][0] > clock()):
+                    self.lock.wait(self.heap[0][0] - clock() if self.heap else None)
+                
+                if not self.running:
+                    break
+                
+                due, sequence, entry = heappop(self.heap)
+            
+            try:
+                self.submit(self.deliver, *entry)
+            
+            except Exception as e:  # pragma: no cover
+                log.exception("Unable to resume deferred delivery.")
+                entry[2].set_exception(e)
+    
+    def deliver(self, pool, message, receipt, attempt=0, started=None, limit=None):
+        """Attempt delivery, resolving the receipt, or parking the message if a transport fails."""
+        
+        if not attempt:
+            if not receipt.set_running_or_notify_cancel():
+                return
+            
+            started, limit = clock(), self.policy.limit(message)
+        
+        try:
+            outcome = deliver_once(pool, message)
+        
+        except TransportFailedException:
+            self.defer(pool, message, receipt, attempt + 1, started, limit)
+        
+        except Exception as e:
+            conclude(message)
+            receipt.set_exception(e)
+        
+        else:
+            receipt.set_result(outcome)
+    
+    def retry(self, pool, message, receipt):
+        """Defer a running delivery which has failed its first attempt."""
+        self.defer(pool, message, receipt, 1, clock(), self.policy.limit(message))
+    
+    def defer(self, pool, message, receipt, attempt, started, limit):
+        delay = self.policy.next(attempt, started, limit)
+        
+        if delay is None:
+            log.error("%s ABANDONED after %d attempts.", getattr(message, 'id', None), attempt)
+            conclude(message)
+            receipt.set_exception(DeliveryFailedException(message, "Delivery abandoned after %d attempts." % (attempt, )))
+            return
+        
+        with self.lock:
+            if self.running:
+                log.info("%s DEFERRED %.2f seconds.", getattr(message, 'id', None), delay)
+                heappush(self.heap, (clock() + delay, next(self.sequence), (pool, message, receipt, attempt, started, limit)))
+                self.lock.notify()
+                return
+        
+        conclude(message)
+        receipt.set_exception(DeliveryDeferredException(message, "Delivery deferred during shutdown."))
+
+
+def _attempt(transport, message):
+    try:
+        return transport.deliver(message)
+    
+    except TransportExhaustedException as e:
+        # The transport sent the message, but pre-emptively
+        # informed us that future attempts will not be successful.
+        transport.ephemeral = True
+        return e.args[0] if e.args else None
+
+
+def settle(message, result):
+    """Combine the result of an attempt at delivery with those of earlier attempts, returning the whole.
+    
+    Results other than a ``DeliveryResult`` are returned as-is.  If recipients were temporarily
+    refused the combined result is kept by the message, its envelope recipients are narrowed to those
+    refused, and ``RecipientsDeferredException`` is raised; only they are attempted again.  Once no
+    recipients remain deferred the envelope is restored, see ``conclude``.
+    """
+    
+    if not isinstance(result, DeliveryResult):
+        return result
+    
+    previous = getattr(message, '_result', None)
+    
+    if previous is not None:
+        result = previous.combine(result)
+    
+    deferred = result.deferred
+    
+    if deferred:
+        if previous is None:
+            message._restore = message._recipients
+        
+        message._result = result
+        message._recipients = AddressList(sorted(deferred))
+        raise RecipientsDeferredException(result)
+    
+    conclude(message)
+    return result
+
+
+def conclude(message):
+    """Forget the earlier attempts at delivery of a message, restoring the envelope ``settle`` narrowed.
+    
+    Called as delivery succeeds or ultimately fails, so that the message may be sent again whole.
+    """
+    
+    if getattr(message, '_result', None) is not None:
+        message._recipients, message._restore, message._result = message._restore, None, None
+
+
+def deliver_once(pool, message):
+    """Make a single attempt at delivery using a pooled transport, returning ``(message, result)``.
+    
+    Raises ``DeliveryFailedException`` if the message was refused, or ``TransportFailedException`` if
+    delivery should be attempted again later; ``RecipientsDeferredException`` if only some of its
+    recipients should be (see ``settle``).
+    """
+    
+    failure = None
+    
+    if pool.render:
+        message.segments  # Render and cache prior to checking out a transport.
+    
+    with pool() as transport:
+        try:
+            result = _attempt(transport, message)
+        
+        except MessageFailedException as e:
+            raise DeliveryFailedException(message, e.args[0] if e.args else "No reason given.")
+        
+        except RecipientsDeferredException as e:
+            failure = e  # The transport remains usable.
+        
+        except TransportFailedException as e:
+            # The transport has suffered an internal error or has otherwise
+            # requested to not be recycled.
+            transport.ephemeral = True
+            failure = e
+    
+    if failure is not None:
+        raise failure
+    
+    return message, settle(message, result)
+
+
+def deliver_batch(pool, batch, defer=None):
+    """Deliver a sequence of (message, receipt) pairs using as few transports as possible.
+    
+    A transport is checked out of the pool once and re-used for every message in the batch; a
+    replacement is only acquired if the transport fails or becomes exhausted.  Each receipt is a
+    ``Future`` instance which is resolved with the ``(message, result)`` tuple, or the exception
+    raised, for its message.  Cancelled receipts are skipped.
+    
+    A message whose transport fails is passed, along with its receipt, to ``defer`` (e.g. a retry
+    scheduler) if given; otherwise it is immediately retried using a fresh transport.  Should no
+    transport be available at all, every remaining message is deferred, if the failure was one of
+    the transport's own (``TransportFailedException``), or fails with the exception raised.
+    
+    Messages are only passed to ``defer`` once the transport has been returned to the pool, as it may well
+    deliver them immediately (e.g. the immediate manager, after waiting out the backoff).
+    """
+    
+    pending = deque((message, receipt) for message, receipt in batch if receipt.set_running_or_notify_cancel())
+    
+    if pool.render:
+        # Render every message prior to checking out a transport.
+        for message, receipt in list(pending):
+            try:
+                message.segments
+            
+            except Exception as e:
+                pending.remove((message, receipt))
+                receipt.set_exception(e)
+    
+    while pending:
+        deferred = []
+        
+        try:
+            with pool() as transport:
+                while pending:
+                    message, receipt = pending[0]
+                    
+                    try:
+                        result = settle(message, _attempt(transport, message))
+                    
+                    except MessageFailedException as e:
+                        pending.popleft()
+                        conclude(message)
+                        receipt.set_exception(DeliveryFailedException(message, e.args[0] if e.args else "No reason given."))
+                    
+                    except RecipientsDeferredException:
+                        # Retry the temporarily refused recipients later, or immediately.
+                        if defer is not None:
+                            deferred.append(pending.popleft())
+                        
+                        if getattr(transport, 'ephemeral', False):
+                            break
+                    
+                    except TransportFailedException:
+                        # Retry the same message, later or using a fresh transport.
+                        transport.ephemeral = True
+                        
+                        if defer is not None:
+                            deferred.append(pending.popleft())
+                        
+                        break
+                    
+                    except Exception as e:
+                        # Unlike single delivery we can not let this escape; the remaining messages must
+                        # still be attempted, so record it and discard the (potentially broken) transport.
+                        log.error("Delivery of message %s failed.", getattr(message, 'id', None), exc_info=True)
+                        pending.popleft()
+                        conclude(message)
+                        receipt.set_exception(e)
+                        transport.ephemeral = True
+                        break
+                    
+                    else:
+                        pending.popleft()
+                        receipt.set_result((message, result))
+                        
+                        if getattr(transport, 'ephemeral', False):
+                            break
+        
+        except Exception as e:
+            # No transport could be acquired (or released); as with single delivery, retry the
+            # remaining messages if the failure was the transport's, otherwise fail them.  No receipt
+            # may be left unresolved.
+            log.error("Unable to acquire a transport for %d messages.", len(pending), exc_info=True)
+            
+            retry = defer is not None and isinstance(e, TransportFailedException)
+            
+            while pending:
+                message, receipt = pending.popleft()
+                
+                if retry:
+                    defer(message, receipt)
+                
+                else:
+                    conclude(message)
+                    receipt.set_exception(e)
+        
+        for message, receipt in deferred:
+            defer(message, receipt)
+
+
+class BatchResult(object):
+    """The aggregate result of a bulk delivery initiated by ``Mailer.send_many()``.
+    
+    One receipt (a ``Future`` instance) is tracked per message, in submission order.  Iterating the
+    batch yields ``(message, receipt)`` pairs; use ``outcomes()`` to wait for and unpack the results.
+    """
+    
+    __slots__ = ('messages', 'receipts')
+    
+    def __init__(self, messages=None, receipts=None):
+        self.messages = list(messages or ())
+        self.receipts = list(receipts or ())
+    
+    def __repr__(self):
+        return "BatchResult(messages=%d, done=%d)" % (len(self.receipts), sum(1 for i in self.receipts if i.done()))
+    
+    def __len__(self):
+        return len(self.receipts)
+    
+    def __iter__(self):
+        return iter(zip(self.messages, self.receipts))
+    
+    def extend(self, messages, receipts):
+        self.messages.extend(messages)
+        self.receipts.extend(receipts)
+    
+    @property
+    def done(self):
+        return all(receipt.done() for receipt in self.receipts)
+    
+    def wait(self, timeout=None):
+        """Block until every message has been processed or the timeout expires.
+        
+        Returns True if all deliveries have completed.
+        """
+        
+        return not futures.wait(self.receipts, timeout).not_done
+    
+    def outcomes(self, timeout=None):
+        """Yield a (message, result, exception) tuple for each message, in order, as they complete."""
+        
+        for message, receipt in zip(self.messages, self.receipts):
+            exception = receipt.exception(timeout)
+            yield message, None if exception else receipt.result()[1], exception
+    
+    @property
+    def delivered(self):
+        """The messages which were delivered successfully.  Blocks until the batch is complete."""
+        return [message for message, result, exception in self.outcomes() if exception is None]
+    
+    @property
+    def failed(self):
+        """A list of (message, exception) tuples for failed deliveries.  Blocks until the batch is complete."""
+        return [(message, exception) for message, result, exception in self.outcomes() if exception is not None]
@@ -4,20 +4,22 @@
 
 import imghdr
 import os
+import re
 import time
-import base64
+import socket
 
 from datetime import datetime
+from collections import OrderedDict
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from email.mime.nonmultipart import MIMENonMultipart
 from email.header import Header
 from email.utils import make_msgid, formatdate
 from mimetypes import guess_type
 
 from marrow.mailer import release
-from marrow.mailer.address import Address, AddressList, AutoConverter
-from marrow.util.compat import basestring, unicode, native
+from marrow.mailer.attachment import StreamedPart, MemoryPart, share
+from marrow.mailer.address import Address, AddressList, CompactAddressList, AutoConverter
+from marrow.util.compat import basestring, unicode, native, bytestring
 
 
 #from marrow.schema import Container, DataAttribute, Attribute, CallbackAttribute, Attributes
@@ -31,15 +33,31 @@ from marrow.util.compat import basestring, unicode, native
 __all__ = ['Message']
 
 
+_domain = []  # The fully qualified domain name of this host, once determined.
+
+
+def msgid():
+	"""Return a new unique Message-ID, as ``make_msgid`` does, resolving the host's domain name only once."""
+	
+	if not _domain:
+		_domain.append(socket.getfqdn())
+	
+	try:
+		return make_msgid(domain=_domain[0])
+	
+	except TypeError:  # pragma: no cover - Python 2 lacks the domain argument, and resolves the name itself.
+		return make_msgid()
+
+
 class Message(object):
 	"""Represents an e-mail message."""
 
 	sender = AutoConverter('_sender', Address, False)
 	author = AutoConverter('_author', AddressList)
 	authors = author
-	to = AutoConverter('_to', AddressList)
-	cc = AutoConverter('_cc', AddressList)
-	bcc = AutoConverter('_bcc', AddressList)
+	to = AutoConverter('_to', AddressList, accept=(AddressList, CompactAddressList))
+	cc = AutoConverter('_cc', AddressList, accept=(AddressList, CompactAddressList))
+	bcc = AutoConverter('_bcc', AddressList, accept=(AddressList, CompactAddressList))
 	reply = AutoConverter('_reply', AddressList)
 	notify = AutoConverter('_notify', AddressList)
 
@@ -56,6 +74,11 @@ class Message(object):
 		self._id = None
 		self._processed = False
 		self._dirty = False
+		self._serialized = None
+		self._segments = None  # The rendered message, if split around streamed attachments.
+		self._recipients = None  # Envelope recipients overriding those of the headers; see split().
+		self._result = None  # The outcome of earlier, partially successful, delivery attempts.
+		self._restore = None  # The envelope recipients to restore once those attempts are concluded.
 		self.mailer = None
 
 		# Default values
@@ -99,21 +122,96 @@ class Message(object):
 	def __setattr__(self, name, value):
 		"""Set the dirty flag as properties are updated."""
 		object.__setattr__(self, name, value)
-		if name not in ('bcc', '_id', '_dirty', '_processed'):
+		if name not in ('bcc', '_id', '_dirty', '_processed', '_serialized', '_segments', '_recipients', '_result', '_restore', 'retries'):
 			object.__setattr__(self, '_dirty', True)
 	
+	def __getstate__(self):
+		"""Prepare the message for pickling, e.g. for storage within a spool.
+
+		The bound mailer and the MIME tree are dropped (the serialized form is kept), callable bodies
+		are resolved to their current value, and the message identifier is fixed.
+		"""
+
+		self.id  # Generated on first access; ensure the copy is identified identically.
+
+		state = self.__dict__.copy()
+		state['mailer'] = None
+		state['plain'] = self._callable(self.plain)
+		state['rich'] = self._callable(self.rich)
+
+		if state.pop('_mime', None) is not None:
+			state['_processed'] = False
+
+		return state
+
 	def __str__(self):
-		return self.mime.as_string()
+		return native(self.serialized)
 	
 	__unicode__ = __str__
 	
 	def __bytes__(self):
-		return self.mime.as_string().encode('ascii')
+		return self.serialized
+	
+	@property
+	def serialized(self):
+		"""The complete wire-format message as an immutable byte string.
+		
+		The MIME tree is only flattened once; the result is cached until the message is altered.
+		Wrap it in a ``memoryview`` to slice it without copying.  A message with streamed attachments
+		(see ``attach``) is instead assembled anew on each access; use ``stream()`` to avoid this.
+		"""
+		
+		segments = self.segments
+		
+		if self._segments is None:
+			return segments[0]
+		
+		return b''.join(self.stream())
+	
+	@property
+	def segments(self):
+		"""The wire-format message as a list of byte strings and, in place of the content of each
+		streamed attachment, the ``StreamedPart`` to encode there.
+		
+		Rendered once and cached alongside ``serialized``.  Messages without streamed attachments have a
+		single segment.
+		"""
+		
+		if self._dirty or (self._serialized is None and self._segments is None):
+			rendered = bytestring(self.mime.as_string())
+			streamed = dict((bytestring(part.token), part) for part in self.attachments + self.embedded if isinstance(part, StreamedPart))
+			
+			if streamed:
+				pattern = re.compile(b'(' + b'|'.join(streamed) + b')')
+				self._segments = [streamed.get(segment, segment) for segment in pattern.split(rendered) if segment]
+			
+			else:
+				self._serialized = rendered
+		
+		return self._segments or [self._serialized]
+	
+	@property
+	def size(self):
+		"""The length of the wire-format message in bytes, calculated without encoding streamed attachments."""
+		
+		return sum(len(segment) if isinstance(segment, bytes) else segment.length for segment in self.segments)
+	
+	def stream(self, size=None):
+		"""Return an iterator over the wire-format message as a series of byte strings.
+		
+		The message is rendered immediately; the content of streamed attachments is then read and encoded
+		as iteration proceeds, roughly ``size`` bytes of each file at a time.  Every string ends with a
+		complete line.
+		"""
+		
+		segments = self.segments
+		
+		return (chunk for segment in segments for chunk in ((segment, ) if isinstance(segment, bytes) else segment.encode(size)))
 	
 	@property
 	def id(self):
 		if not self._id or (self._processed and self._dirty):
-			self._id = make_msgid()
+			self._id = msgid()
 			self._processed = False
 		return self._id
 
@@ -128,7 +226,40 @@ class Message(object):
 
 	@property
 	def recipients(self):
-		return AddressList(self.to + self.cc + self.bcc)
+		if self._recipients is not None:
+			return self._recipients
+		
+		recipients = self.to + self.cc + self.bcc
+		return recipients if isinstance(recipients, CompactAddressList) else AddressList(recipients)
+	
+	def split(self):
+		"""Partition the envelope recipients by domain, returning one message per domain.
+		
+		The messages share this message's identifier and rendered (serialized) form, differing only in
+		their envelope recipients, so the MIME document is only rendered once.  If every recipient is
+		within a single domain a list containing only this message is returned.
+		"""
+		
+		groups = OrderedDict()
+		
+		for address in self.recipients:
+			groups.setdefault(address.address.rpartition('@')[2].lower(), []).append(address)
+		
+		if len(groups) < 2:
+			return [self]
+		
+		self.segments  # Render once, prior to sharing.
+		self.id
+		
+		parts = []
+		
+		for recipients in groups.values():
+			part = self.__class__.__new__(self.__class__)
+			part.__dict__.update(self.__dict__)
+			part._recipients = AddressList(recipients)
+			parts.append(part)
+		
+		return parts
 
 	def _mime_document(self, plain, rich=None):
 		if not rich:
@@ -201,12 +332,12 @@ class Message(object):
 
 	def _add_headers_to_message(self, message, headers):
 		for header in headers:
-			if header[1] is None or (isinstance(header[1], list) and not header[1]):
+			if header[1] is None or (isinstance(header[1], (list, CompactAddressList)) and not header[1]):
 				continue
 			
 			name, value = header
 			
-			if isinstance(value, (Address, AddressList)):
+			if isinstance(value, (Address, AddressList, CompactAddressList)):
 				value = unicode(value)
 			
 			message[name] = value
@@ -240,6 +371,8 @@ class Message(object):
 			return self._mime
 
 		self._processed = False
+		self._serialized = None
+		self._segments = None
 
 		plain = MIMEText(self._callable(self.plain), 'plain', self.encoding)
 
@@ -258,7 +391,7 @@ class Message(object):
 		return message
 
 	def attach(self, name, data=None, maintype=None, subtype=None,
-		inline=False, filename=None, encoding=None):
+		inline=False, filename=None, encoding=None, stream=False):
 		"""Attach a file to this message.
 
 		:param name: Path to the file to attach if data is None, or the name
@@ -276,6 +409,9 @@ class Message(object):
 									by the user in his/her mail client.
 		:param encoding: Value of the Content-Encoding MIME header (e.g. "gzip"
 						 in case of .tar.gz, but usually empty)
+		:param stream: Whether to defer reading and encoding a file from disk
+					   until the message is delivered; the file must remain
+					   in place until then
 		"""
 		self._dirty = True
 
@@ -287,25 +423,30 @@ class Message(object):
 			else:
 				maintype, _, subtype = maintype.partition('/')
 
-		part = MIMENonMultipart(maintype, subtype)
+		if stream:
+			if data is not None:
+				raise TypeError("Only attachments read from disk may be streamed.")
+			part = StreamedPart(maintype, subtype, share(name))
+			name = os.path.basename(name)
+		else:
+			if data is None:
+				with open(name, 'rb') as fp:
+					value = fp.read()
+				name = os.path.basename(name)
+			elif isinstance(data, bytes):
+				value = data
+			elif hasattr(data, 'read'):
+				value = data.read()
+			else:
+				raise TypeError("Unable to read attachment contents")
+			
+			part = MemoryPart(maintype, subtype, value)
+
 		part.add_header('Content-Transfer-Encoding', 'base64')
 
 		if encoding:
 			part.add_header('Content-Encoding', encoding)
 
-		if data is None:
-			with open(name, 'rb') as fp:
-				value = fp.read()
-			name = os.path.basename(name)
-		elif isinstance(data, bytes):
-			value = data
-		elif hasattr(data, 'read'):
-			value = data.read()
-		else:
-			raise TypeError("Unable to read attachment contents")
-		
-		part.set_payload(base64.encodestring(value))
-
 		if not filename:
 			filename = name
 		filename = os.path.basename(filename)
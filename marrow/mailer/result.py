@@ -0,0 +1,45 @@
+# encoding: utf-8
+
+"""The per-recipient outcome of message delivery."""
+
+
+__all__ = ['DeliveryResult']
+
+
+
+class DeliveryResult(dict):
+    """The outcome of delivering a message, recipient by recipient.
+
+    As with the return value of ``SMTP.sendmail`` the dictionary itself maps each refused recipient to
+    the ``(code, response)`` reply of the server; ``accepted`` likewise maps each recipient the message
+    was accepted for.  Refusals with a 4xx code are temporary and are retried by the managers, see
+    ``deferred``; any other refusal is permanent, see ``rejected``.
+    """
+
+    def __init__(self, accepted=None, refused=None):
+        super(DeliveryResult, self).__init__(refused or ())
+        self.accepted = dict(accepted or ())
+
+    def __repr__(self):
+        return "DeliveryResult(accepted=%r, refused=%r)" % (self.accepted, dict(self))
+
+    @property
+    def deferred(self):
+        """The recipients temporarily refused."""
+        return dict((recipient, reply) for recipient, reply in self.items() if 400 <= reply[0] < 500)
+
+    @property
+    def rejected(self):
+        """The recipients permanently refused."""
+        return dict((recipient, reply) for recipient, reply in self.items() if not 400 <= reply[0] < 500)
+
+    def combine(self, later):
+        """Return the outcome of this delivery updated by a later one, such as the retry of deferred recipients."""
+
+        accepted = dict(self.accepted)
+        accepted.update(later.accepted)
+
+        refused = dict((recipient, reply) for recipient, reply in self.items() if recipient not in accepted)
+        refused.update(later)
+
+        return self.__class__(accepted, refused)
@@ -0,0 +1,144 @@
+# encoding: utf-8
+
+"""Mail-merge message templates which render their shared MIME skeleton once."""
+
+import re
+
+from string import Template
+from uuid import uuid4
+from copy import copy
+from itertools import groupby
+from email.mime.text import MIMEText
+
+from marrow.mailer.message import Message
+from marrow.mailer.attachment import StreamedPart
+from marrow.mailer.address import AddressList
+from marrow.util.compat import bytestring, unicode
+
+try:
+	from email.policy import compat32
+	_fold = compat32.clone(max_line_length=0).fold  # Matches Message.as_string(), which does not wrap.
+
+except ImportError:  # pragma: no cover
+	from email.header import Header
+
+	def _fold(name, value):
+		return '%s: %s\n' % (name, Header(value, header_name=name).encode())
+
+
+__all__ = ['MessageTemplate']
+
+
+class MessageTemplate(Message):
+	"""A message used as the basis for many nearly identical messages.
+
+	Configure it exactly as you would a Message, using ``$name`` placeholders (see ``string.Template``)
+	within the plain and rich bodies, then call ``render()`` once per recipient.  The headers,
+	attachments, and multipart boundaries are flattened once; each rendered message is produced by
+	splicing the encoded recipient header and bodies between those pre-computed byte segments.
+
+	Streamed attachments are shared by every rendered message, each encoding the file as it is delivered.
+	Any change to the template discards the pre-rendered skeleton.
+	"""
+
+	def __init__(self, author=None, to=None, subject=None, **kw):
+		self._skeleton = None
+		super(MessageTemplate, self).__init__(author, to, subject, **kw)
+
+	def __setattr__(self, name, value):
+		super(MessageTemplate, self).__setattr__(name, value)
+
+		if name != '_skeleton':
+			object.__setattr__(self, '_skeleton', None)
+
+	def _prepare(self):
+		"""Flatten the template with placeholder tokens and split the result into literal segments."""
+
+		if not self.author:
+			raise ValueError("You must specify an author.")
+
+		if not self.subject:
+			raise ValueError("You must specify a subject.")
+
+		if not self.plain:
+			raise ValueError("You must provide plain text content.")
+
+		tokens = dict((slot, 'merge' + uuid4().hex) for slot in ('To', 'plain', 'rich'))
+		to_line = _fold('To', tokens['To'])
+
+		plain = MIMEText(tokens['plain'], 'plain', self.encoding)
+		rich = MIMEText(tokens['rich'], 'html', self.encoding) if self.rich else None
+
+		document = self._mime_document(plain, rich)
+		headers = [(name, tokens['To'] if name == 'To' else value) for name, value in self._build_header_list(self.author, self.sender)]
+		self._add_headers_to_message(document, headers)
+
+		rendered = bytestring(document.as_string())
+		lookup = {bytestring(to_line): 0, bytestring(tokens['plain']): 1, bytestring(tokens['rich']): 2}  # Indexes into render()'s parts.
+		lookup.update((bytestring(part.token), part) for part in self.attachments + self.embedded if isinstance(part, StreamedPart))
+
+		pattern = re.compile(b'(' + b'|'.join(re.escape(i) for i in lookup) + b')')
+		segments = [lookup.get(segment, segment) for segment in pattern.split(rendered) if segment]
+
+		bodies = dict(plain=unicode(self._callable(self.plain)), rich=unicode(self._callable(self.rich)) if self.rich else None)
+		state = dict((k, v) for k, v in self.__dict__.items() if k not in ('_skeleton', '_mime', '_serialized', '_segments', '_id'))
+
+		skeleton = self._skeleton = (segments, bodies, state)
+		return skeleton
+
+	def _encode_body(self, text, subtype):
+		"""Encode a body exactly as the email generator would emit it within the MIME document."""
+
+		payload = MIMEText(text, subtype, self.encoding).get_payload()
+		return bytestring(re.sub(r'\r\n|\r', '\n', payload))
+
+	def render(self, to, **values):
+		"""Produce a new Message addressed to ``to`` with body placeholders substituted from ``values``.
+
+		The returned message is fully independent of the template and is already serialized.
+		"""
+
+		segments, bodies, state = self._skeleton or self._prepare()
+
+		to = to if isinstance(to, AddressList) else AddressList(to)
+
+		if not to:
+			raise ValueError("You must specify at least one recipient.")
+
+		plain = Template(bodies['plain']).substitute(values)
+		rich = Template(bodies['rich']).substitute(values) if bodies['rich'] is not None else None
+
+		parts = (
+				bytestring(_fold('To', unicode(to))),
+				self._encode_body(plain, 'plain'),
+				self._encode_body(rich, 'html') if rich is not None else None
+			)
+
+		pieces = (parts[segment] if isinstance(segment, int) else segment for segment in segments)
+		rendered = []
+
+		for literal, group in groupby(pieces, lambda piece: not isinstance(piece, StreamedPart)):
+			if literal:
+				rendered.append(b''.join(group))
+			else:
+				rendered.extend(group)  # The content of streamed attachments is encoded on delivery.
+
+		message = Message.__new__(Message)
+		data = message.__dict__
+		data.update(state)
+
+		for name in ('_author', '_cc', '_bcc', '_reply', '_notify', 'attachments', 'embedded', 'headers'):
+			data[name] = copy(data[name])
+
+		data.update(
+				_to = to,
+				_id = None,
+				plain = plain,
+				rich = rich,
+				_processed = False,
+				_dirty = False,
+				_serialized = rendered[0] if len(rendered) == 1 else None,
+				_segments = rendered if len(rendered) > 1 else None
+			)
+
+		return message
@@ -13,6 +13,8 @@ from smtpd import SMTPServer
 from email.parser import Parser
 from asyncore import loop
 
+from marrow.mailer.message import Message
+
 try:
 	from pytest import fixture
 except:  # We don't honestly care if pytest is installed.
@@ -23,6 +25,54 @@ except:  # We don't honestly care if pytest is installed.
 TestMessage = namedtuple('TestMessage', ('sender', 'recipients', 'time', 'message', 'raw'))
 
 
+def build_message(subject="Test.", to='recipient@example.com', **kw):
+	"""Construct a minimal deliverable message; keyword arguments are passed through to ``Message``."""
+	
+	kw.setdefault('plain', "Hello.")
+	return Message('author@example.com', to, subject, **kw)
+
+
+class RecordingTransport(object):
+	"""A transport recording, in order, the messages delivered through any instance of it.
+	
+	Deliveries are appended to the ``delivered`` list of the class; call ``reset()`` between tests.
+	"""
+	
+	delivered = []
+	
+	def __init__(self, config):
+		self.config = config
+	
+	def startup(self):
+		pass
+	
+	def deliver(self, message):
+		self.delivered.append(message)
+		return True
+	
+	def shutdown(self):
+		pass
+	
+	@classmethod
+	def reset(cls):
+		del cls.delivered[:]
+
+
+class GatedTransport(RecordingTransport):
+	"""A recording transport holding every delivery until its ``gate`` event is set."""
+	
+	gate = Event()
+	
+	def deliver(self, message):
+		self.gate.wait(5)
+		return super(GatedTransport, self).deliver(message)
+	
+	@classmethod
+	def reset(cls):
+		cls.gate.clear()
+		super(GatedTransport, cls).reset()
+
+
 class DebuggingSMTPServer(SMTPServer, Thread):
 	"""A generalized testing SMTP server that captures messages delivered to it."""
 	
@@ -43,7 +93,7 @@ class DebuggingSMTPServer(SMTPServer, Thread):
 		self.messages = deque()
 		
 		# Setup threading.
-		self._stop = Event()
+		self._halt = Event()  # Thread already has a _stop method.
 		self._lock = RLock()
 		Thread.__init__(self, name=self.__class__.__name__)
 	
@@ -59,19 +109,20 @@ class DebuggingSMTPServer(SMTPServer, Thread):
 		except KeyboardInterrupt:
 			pass
 	
-	def process_message(self, peer, sender, recipients, data):
+	def process_message(self, peer, sender, recipients, data, **options):
 		# We construct a helpful namedtuple with all of the relevant delivery details.
-		message = TestMessage(sender, recipients, datetime.utcnow(), Parser().parsestr(data), data)
+		text = data.decode('utf-8') if isinstance(data, bytes) else data
+		message = TestMessage(sender, recipients, datetime.utcnow(), Parser().parsestr(text), data)
 		
 		with self._lock:  # Protect against parallel access.
 			self.messages.append(message)
 	
 	def run(self):
-		while not self._stop.is_set():
+		while not self._halt.is_set():
 			loop(timeout=self.POLL_TIMEOUT, count=1)
 	
 	def stop(self, timeout=None):
-		self._stop.set()
+		self._halt.set()
 		self.join(timeout)
 		self.close()
 	
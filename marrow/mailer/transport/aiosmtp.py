@@ -0,0 +1,367 @@
+# encoding: utf-8
+
+"""Deliver messages using (E)SMTP from within an asyncio event loop.
+
+Requires Python 3.5 or later; see the ``asyncio`` delivery manager.
+"""
+
+import socket
+import asyncio
+
+from base64 import b64encode
+from smtplib import (SMTPException, SMTPRecipientsRefused, SMTPSenderRefused, SMTPServerDisconnected,
+                     SMTPDataError, SMTPAuthenticationError, SMTPResponseException, quoteaddr)
+
+from marrow.util.convert import boolean
+from marrow.util.compat import native
+
+from marrow.mailer.exc import (
+    TransportExhaustedException, TransportException, TransportFailedException,
+    MessageFailedException)
+from marrow.mailer.result import DeliveryResult
+from marrow.mailer.transport import tls
+from marrow.mailer.transport.smtp import quote_data
+
+log = __import__('logging').getLogger(__name__)
+
+
+class AsyncSMTPTransport(object):
+    """An asynchronous (E)SMTP pipelining transport built on asyncio streams.
+
+    Accepts the same configuration as the blocking SMTP transport.  The ``startup``, ``deliver``, and
+    ``shutdown`` methods are coroutines, so this transport must be driven by the ``asyncio`` manager.
+    """
+
+    __slots__ = ('ephemeral', 'host', 'tls', 'certfile', 'keyfile', 'port', 'local_hostname', 'username', 'password', 'timeout', 'debug', 'pipeline', 'reader', 'writer', 'extensions', 'sent')
+
+    def __init__(self, config):
+        self.host = native(config.get('host', '127.0.0.1'))
+        self.tls = config.get('tls', 'optional')
+        self.certfile = config.get('certfile', None)
+        self.keyfile = config.get('keyfile', None)
+        self.port = int(config.get('port', 465 if self.tls == 'ssl' else 25))
+        self.local_hostname = native(config.get('local_hostname', '')) or None
+        self.username = native(config.get('username', '')) or None
+        self.password = native(config.get('password', '')) or None
+        self.timeout = config.get('timeout', None)
+
+        if self.timeout:
+            self.timeout = int(self.timeout)
+
+        self.debug = boolean(config.get('debug', False))
+
+        self.pipeline = config.get('pipeline', None)
+        if self.pipeline not in (None, True, False):
+            self.pipeline = int(self.pipeline)
+
+        self.reader = self.writer = None
+        self.extensions = {}
+        self.sent = 0
+
+    async def startup(self):
+        if not self.connected:
+            await self.connect_to_server()
+
+    async def shutdown(self):
+        if self.connected:
+            log.debug("Closing SMTP connection")
+
+            try:
+                await self.command('QUIT')
+
+            except (SMTPException, OSError, EOFError, asyncio.TimeoutError): # pragma: no cover
+                pass
+
+            finally:
+                self.close()
+
+    def close(self):
+        writer, self.reader, self.writer = self.writer, None, None
+
+        if writer is not None:
+            writer.close()
+
+    @property
+    def connected(self):
+        return self.writer is not None and not self.writer.transport.is_closing()
+
+    def _context(self):
+        return tls.context(self.certfile, self.keyfile)
+
+    async def connect_to_server(self):
+        log.info("Connecting to SMTP server %s:%s", self.host, self.port)
+
+        connection = asyncio.open_connection(self.host, self.port, ssl=self._context() if self.tls == 'ssl' else None)
+        self.reader, self.writer = await asyncio.wait_for(connection, self.timeout)
+
+        try:
+            code, response = await self.reply()
+
+            if code != 220:
+                raise SMTPResponseException(code, response)
+
+            await self.ehlo()
+
+            # Do TLS handshake if configured
+            if self.tls in ('required', 'optional', True):
+                if 'starttls' in self.extensions and not hasattr(self.writer, 'start_tls'):
+                    # Carrying on in the clear would expose any credentials; only Python 3.11 can upgrade a stream.
+                    raise TransportException('TLS is offered but STARTTLS is unsupported by this version of Python -- aborting')
+
+                if 'starttls' in self.extensions: # pragma: no cover
+                    code, response = await self.command('STARTTLS')
+
+                    if code != 220:
+                        raise SMTPResponseException(code, response)
+
+                    started = tls.clock()
+
+                    try:
+                        await self.writer.start_tls(self._context(), server_hostname=self.host)
+
+                    except BaseException:
+                        tls.record(tls.clock() - started, failed=True)
+                        raise
+
+                    tls.record(tls.clock() - started)
+                    await self.ehlo()
+
+                elif self.tls == 'required':
+                    raise TransportException('TLS is required but not available -- aborting')
+
+            # Authenticate to server if necessary
+            if self.username and self.password:
+                log.info("Authenticating as %s", self.username)
+                await self.login(self.username, self.password)
+
+        except BaseException:
+            self.close()
+            raise
+
+        self.sent = 0
+
+    async def ehlo(self):
+        name = self.local_hostname or socket.getfqdn()
+        code, response = await self.command('EHLO ' + name)
+
+        if code != 250:
+            code, response = await self.command('HELO ' + name)
+
+            if code != 250:
+                raise SMTPResponseException(code, response)
+
+            self.extensions = {}
+            return
+
+        lines = response.decode('latin-1').split('\n')[1:]  # The first line is the greeting.
+        self.extensions = dict((line.partition(' ')[0].lower(), line.partition(' ')[2].strip()) for line in lines)
+
+    async def login(self, username, password):
+        mechanisms = self.extensions.get('auth', '').upper().split()
+
+        if 'PLAIN' in mechanisms:
+            token = b64encode(('\0%s\0%s' % (username, password)).encode('utf-8')).decode('ascii')
+            code, response = await self.command('AUTH PLAIN ' + token)
+
+        elif 'LOGIN' in mechanisms:
+            code, response = await self.command('AUTH LOGIN ' + b64encode(username.encode('utf-8')).decode('ascii'))
+
+            if code == 334:
+                code, response = await self.command(b64encode(password.encode('utf-8')).decode('ascii'))
+
+        else:
+            raise TransportException('No supported authentication mechanism offered by the server -- aborting')
+
+        if code not in (235, 503):  # 503: Already authenticated.
+            raise SMTPAuthenticationError(code, response)
+
+    async def reply(self):
+        """Read a (potentially multi-line) reply, returning the code and response text like smtplib."""
+
+        code, lines = None, []
+
+        while True:
+            line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+
+            if not line:
+                self.close()
+                raise SMTPServerDisconnected("Connection unexpectedly closed")
+
+            if self.debug:
+                log.debug("reply: %r", line)
+
+            code, lines = line[:3], lines + [line[4:].strip(b' \t\r\n')]
+
+            if line[3:4] != b'-':
+                break
+
+        try:
+            return int(code), b'\n'.join(lines)
+
+        except ValueError:
+            self.close()
+            raise SMTPServerDisconnected("Malformed reply from server: %r" % (code, ))
+
+    async def send(self, data):
+        if self.debug:
+            log.debug("send: %r", data)
+
+        self.writer.write(data.encode('ascii') if not isinstance(data, bytes) else data)
+        await self.writer.drain()
+
+    async def command(self, line):
+        await self.send(line + '\r\n')
+        return await self.reply()
+
+    async def deliver(self, message):
+        if not self.connected:
+            try:
+                await self.connect_to_server()
+
+            except SMTPResponseException as e:
+                # Refused a session (e.g. a 421 or 554 greeting) by the server, not on account of the message.
+                log.warning("%s DEFERRED %s %s", message.id, e.__class__.__name__, e)
+                raise TransportFailedException(str(e))
+
+        result = await self.send_with_smtp(message)
+
+        if not self.pipeline or self.sent >= self.pipeline:
+            raise TransportExhaustedException(result)
+
+        return result
+
+    async def transaction(self, sender, recipients, content):
+        """Perform a mail transaction, pipelining the envelope if the server supports RFC 2920.
+
+        Returns a ``DeliveryResult``: a dictionary of refused recipients mapped to their (code, response)
+        reply, also recording the reply accepting the message for each other recipient.  Raises the same
+        exceptions as ``SMTP.sendmail`` if the sender, every recipient, or the message is refused.
+        """
+
+        options = ' SIZE=%d' % len(content) if 'size' in self.extensions else ''
+        commands = ['MAIL FROM:%s%s' % (quoteaddr(sender), options)]
+        commands.extend('RCPT TO:%s' % quoteaddr(recipient) for recipient in recipients)
+        commands.append('DATA')
+
+        if 'pipelining' in self.extensions:
+            await self.send(''.join(command + '\r\n' for command in commands))
+            replies = []
+
+            for command in commands:
+                replies.append(await self.reply())
+
+            (code, response), data = replies[0], replies[-1]
+            refused = dict((recipient, reply) for recipient, reply in zip(recipients, replies[1:-1]) if reply[0] not in (250, 251))
+
+            if data[0] == 354 and (code != 250 or len(refused) == len(recipients)):
+                # The server wants the message even though nobody will receive it; give it an empty one.
+                await self.command('.')
+
+        else:
+            code, response = data = await self.command(commands[0])
+            refused = {}
+
+            if code == 250:
+                for recipient, command in zip(recipients, commands[1:-1]):
+                    reply = await self.command(command)
+
+                    if reply[0] not in (250, 251):
+                        refused[recipient] = reply
+
+                if len(refused) != len(recipients):
+                    data = await self.command('DATA')
+
+        if code != 250:
+            await self._abort(code)
+            raise SMTPSenderRefused(code, response, sender)
+
+        if len(refused) == len(recipients):
+            await self._abort(code)
+            raise SMTPRecipientsRefused(refused)
+
+        if data[0] != 354:
+            await self._abort(data[0])
+            raise SMTPDataError(*data)
+
+        await self.send(quote_data(content))
+        code, response = reply = await self.reply()
+
+        if code != 250:
+            await self._abort(code)
+            raise SMTPDataError(code, response)
+
+        return DeliveryResult(((recipient, reply) for recipient in recipients if recipient not in refused), refused)
+
+    async def _abort(self, code):
+        """Reset the transaction following a failure, or disconnect if the server is going away."""
+
+        if code == 421:
+            self.close()
+            return
+
+        await self.command('RSET')
+
+    async def send_with_smtp(self, message):
+        try:
+            sender = str(message.envelope)
+            recipients = message.recipients.string_addresses
+
+            result = await self.transaction(sender, recipients, message.serialized)
+            self.sent += 1
+
+            for recipient, reply in result.items():
+                log.warning("%s %s %s %s", message.id, "DEFERRED" if 400 <= reply[0] < 500 else "REFUSED", recipient, reply)
+
+            return result
+
+        except SMTPSenderRefused as e:
+            # The envelope sender was refused.  This is bad, unless only temporarily.
+            if 400 <= e.smtp_code < 500:
+                log.warning("%s DEFERRED %s %s", message.id, e.__class__.__name__, e)
+                raise TransportFailedException(str(e))
+
+            log.error("%s REFUSED %s %s", message.id, e.__class__.__name__, e)
+            raise MessageFailedException(str(e))
+
+        except SMTPRecipientsRefused as e:
+            # All recipients were refused. Log which recipients.
+            # This allows you to automatically parse your logs for bad e-mail addresses.
+            log.warning("%s REFUSED %s %s", message.id, e.__class__.__name__, e)
+            result = DeliveryResult(refused=e.recipients)
+
+            if result.deferred:
+                return result  # Some may yet accept the message; the manager will retry them.
+
+            raise MessageFailedException(str(e))
+
+        except SMTPDataError as e:
+            # The message was refused after the envelope was accepted, thus for every recipient alike.
+            if 400 <= e.smtp_code < 500:
+                log.warning("%s DEFERRED %s %s", message.id, e.__class__.__name__, e)
+                return DeliveryResult(refused=dict((recipient, (e.smtp_code, e.smtp_error)) for recipient in recipients))
+
+            log.error("%s REFUSED %s %s", message.id, e.__class__.__name__, e)
+            raise MessageFailedException(str(e))
+
+        except SMTPResponseException as e:
+            # Any other unexpected reply; retried if temporary.
+            if e.smtp_code == 421:
+                self.close()
+
+            if 400 <= e.smtp_code < 500:
+                log.warning("%s DEFERRED %s %s", message.id, e.__class__.__name__, e)
+                raise TransportFailedException(str(e))
+
+            log.error("%s REFUSED %s %s", message.id, e.__class__.__name__, e)
+            raise MessageFailedException(str(e))
+
+        except (SMTPServerDisconnected, OSError, EOFError, asyncio.TimeoutError) as e:
+            self.close()
+
+            if message.retries >= 0:
+                log.warning("%s DEFERRED %s", message.id, e.__class__.__name__)
+                message.retries -= 1
+                raise TransportFailedException()
+
+            log.error("%s REFUSED %s", message.id, e.__class__.__name__)
+            raise MessageFailedException(str(e))
@@ -1,5 +1,7 @@
 # encoding: utf-8
 
+from marrow.util.compat import native
+
 
 __all__ = ['LoggingTransport']
 
@@ -17,7 +19,7 @@ class LoggingTransport(object):
         log.debug("Logging transport starting.")
     
     def deliver(self, message):
-        msg = str(message)
+        msg = native(message.serialized)
         self.log.info("DELIVER %s %s %d %r %r", message.id, message.date.isoformat(),
             len(msg), message.author, message.recipients)
         self.log.critical(msg)
@@ -44,7 +44,7 @@ class MaildirTransport(object):
     def deliver(self, message):
         # TODO: Create an ID based on process and thread IDs.
         # Current bhaviour may allow for name clashes in multi-threaded.
-        self.box.add(mailbox.MaildirMessage(str(message)))
+        self.box.add(message.serialized)
     
     def shutdown(self):
         self.box = None
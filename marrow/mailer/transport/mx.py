@@ -0,0 +1,308 @@
+# encoding: utf-8
+
+"""Deliver messages directly to the mail exchangers of each recipient domain."""
+
+import random
+import socket
+import threading
+
+from collections import OrderedDict
+from smtplib import SMTPException
+
+from marrow.util.compat import basestring, native
+from marrow.util.object import load_object
+
+from marrow.mailer.exc import TransportException, TransportFailedException, MessageFailedException
+from marrow.mailer.manager.util import clock
+from marrow.mailer.result import DeliveryResult
+from marrow.mailer.transport.smtp import SMTPTransport
+
+
+__all__ = ['MXCache', 'MXTransport', 'resolve']
+
+log = __import__('logging').getLogger(__name__)
+
+
+
+def resolve(domain):
+    """Look up the MX records of a domain, returning ``(ttl, [(preference, host), ...])``.
+
+    Uses dnspython if installed, otherwise pydns (as used by the validator).  A domain without MX
+    records returns an empty list; lookup failures raise an exception.
+    """
+
+    try:
+        from dns import resolver, rdatatype
+
+    except ImportError:
+        import DNS
+        return None, [(preference, host) for preference, host in DNS.mxlookup(domain)]
+
+    try:
+        answer = getattr(resolver, 'resolve', None) or resolver.query
+        answer = answer(domain, rdatatype.MX)
+
+    except (resolver.NXDOMAIN, resolver.NoAnswer):
+        return None, []
+
+    return answer.rrset.ttl, [(record.preference, record.exchange.to_text()) for record in answer]
+
+
+class MXCache(object):
+    """A thread safe, size bounded cache of mail exchangers, honouring the TTL of each lookup."""
+
+    __slots__ = ('resolver', 'size', 'ttl', 'maximum', 'entries', 'lock')
+
+    def __init__(self, resolver, size=1000, ttl=300, maximum=86400):
+        self.resolver = resolver
+        self.size = size  # The number of domains retained.
+        self.ttl = ttl  # Used when the resolver does not provide one.
+        self.maximum = maximum  # The longest any lookup is trusted, regardless of its TTL.
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __call__(self, domain):
+        """Return the exchangers of the given domain as a list of host names, most preferred first.
+
+        Exchangers sharing a preference are randomly ordered, spreading load between them.  A domain
+        without MX records is its own exchanger (RFC 5321 section 5.1).
+        """
+
+        now = clock()
+
+        with self.lock:
+            entry = self.entries.get(domain)
+
+            if entry is not None and entry[0] > now:
+                return self._order(entry[1])
+
+        ttl, records = self.resolver(domain)
+        ttl = min(self.maximum, self.ttl if ttl is None else ttl)
+        records = sorted(records) if records else [(0, domain)]
+
+        with self.lock:
+            self.entries.pop(domain, None)
+            self.entries[domain] = (now + ttl, records)
+            self._evict(now)
+
+        return self._order(records)
+
+    def _evict(self, now):
+        for domain in [domain for domain, entry in self.entries.items() if entry[0] <= now]:
+            del self.entries[domain]
+
+        while len(self.entries) > self.size:
+            self.entries.popitem(False)
+
+    @staticmethod
+    def _order(records):
+        records = list(records)
+        random.shuffle(records)
+        return [host.rstrip('.') for preference, host in sorted(records, key=lambda record: record[0])]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class MXTransport(object):
+    """An SMTP transport delivering to the mail exchangers of each recipient domain.
+
+    Lookups are cached across every instance sharing a resolver.  Each instance keeps a connection
+    open to the ``hosts`` exchangers it has most recently used, until unused for ``idle`` seconds,
+    ``age`` seconds after it was opened, or ``pipeline`` messages have been delivered across it; when
+    pooled by a manager, this gives each exchanger its own pool of connections.  Should an exchanger be
+    unreachable, the next most preferred is tried.
+    """
+
+    __slots__ = ('ephemeral', 'resolver', 'port', 'hosts', 'pipeline', 'idle', 'age', 'options', 'connections', 'used', 'cache')
+
+    caches = {}
+    lock = threading.Lock()
+
+    def __init__(self, config):
+        self.resolver = config.get('resolver', None) or resolve
+        self.port = int(config.get('port', 25))
+        self.hosts = int(config.get('hosts', 10))
+        self.pipeline = config.get('pipeline', None)
+        self.idle = config.get('idle', None)
+        self.age = config.get('age', None)
+
+        if isinstance(self.resolver, basestring):
+            self.resolver = load_object(self.resolver)
+
+        # Every other directive is passed to the SMTP transport used to speak to each exchanger.
+        self.options = dict((key, value) for key, value in config.items() if not key.startswith('cache') and key not in ('use', 'resolver', 'hosts', 'idle', 'age'))
+        self.options.setdefault('tls', 'optional')
+
+        if self.pipeline not in (None, True, False):
+            self.pipeline = int(self.pipeline)
+
+        if self.idle is not None:
+            self.idle = float(self.idle)
+
+        if self.age is not None:
+            self.age = float(self.age)
+
+        self.connections = OrderedDict()
+        self.used = {}  # The times each connection was opened and last used, by exchanger.
+
+        with self.lock:
+            self.cache = self.caches.get(self.resolver)
+
+            if self.cache is None:
+                self.cache = self.caches[self.resolver] = MXCache(
+                        self.resolver,
+                        int(config.get('cache.size', 1000)),
+                        int(config.get('cache.ttl', 300)),
+                        int(config.get('cache.maximum', 86400))
+                    )
+
+    def startup(self):
+        pass
+
+    def shutdown(self):
+        while self.connections:
+            host, connection = self.connections.popitem()
+            connection.shutdown()
+
+        self.used.clear()
+
+    def alive(self):
+        self._expire(clock())
+
+        for host, connection in list(self.connections.items()):
+            if not connection.alive():
+                self._close(host)
+
+        return True
+
+    def connection(self, host):
+        """Return an open connection to the given exchanger, closing the least recently used if needed."""
+
+        now = clock()
+        self._expire(now)
+        connection = self.connections.pop(host, None)
+
+        if connection is None:
+            while len(self.connections) >= self.hosts:
+                self._close(next(iter(self.connections)))
+
+            connection = SMTPTransport(dict(self.options, host=native(host), port=self.port))
+
+        self.connections[host] = connection
+
+        if not connection.connected:
+            connection.connect_to_server()
+            self.used[host] = (now, now)
+
+        return connection
+
+    def _expire(self, now):
+        """Close any connections which have outlived the ``idle`` or ``age`` limits."""
+
+        if self.idle is None and self.age is None:
+            return
+
+        for host, (created, used) in list(self.used.items()):
+            if (self.idle is not None and now - used >= self.idle) or (self.age is not None and now - created >= self.age):
+                log.debug("Closing expired connection to %s.", host)
+                self._close(host)
+
+    def _close(self, host):
+        self.used.pop(host, None)
+        connection = self.connections.pop(host, None)
+
+        if connection is not None:
+            try:
+                connection.shutdown()
+
+            except Exception: # pragma: no cover
+                log.exception("Error closing connection to %s.", host)
+
+    def deliver(self, message):
+        """Deliver the message to every recipient domain in turn, returning the combined ``DeliveryResult``.
+
+        If a domain can not be reached after other domains have accepted the message its recipients are
+        treated as temporarily refused (451), so that the manager narrows the envelope recipients of the
+        message to them and a retry only attempts the domains which failed (see ``settle``).
+        """
+
+        result, pending, failure = DeliveryResult(), [], None
+
+        for part in message.split():
+            recipients = part.recipients.string_addresses
+            domain = recipients[0].rpartition('@')[2].lower()
+
+            try:
+                outcome = self.deliver_domain(domain, part)
+
+            except MessageFailedException as e:
+                log.warning("%s REFUSED by %s: %s", message.id, domain, e)
+                result.update((recipient, (550, native(str(e)))) for recipient in recipients)
+
+            except TransportFailedException as e:
+                pending.extend(recipients)
+                failure = e
+
+            else:
+                result.accepted.update(getattr(outcome, 'accepted', ()))
+                result.update(outcome)
+
+        if failure is not None:
+            if len(pending) == len(message.recipients):
+                raise failure
+
+            result.update((recipient, (451, native(str(failure) or "Unable to reach a mail exchanger."))) for recipient in pending)
+
+        if len(result) == len(message.recipients) and not result.deferred:
+            raise MessageFailedException("All recipients refused: %r" % (dict(result), ))
+
+        return result
+
+    def deliver_domain(self, domain, message):
+        """Deliver to a single domain, trying each of its exchangers in order of preference."""
+
+        try:
+            hosts = self.cache(domain)
+
+        except Exception:
+            log.exception("%s DEFERRED: unable to resolve mail exchangers for %s.", message.id, domain)
+            raise TransportFailedException("Unable to resolve %s." % (domain, ))
+
+        if hosts == ['']:  # A "null MX" (RFC 7505): the domain accepts no mail.
+            raise MessageFailedException("Domain %s does not accept mail." % (domain, ))
+
+        for host in hosts:
+            try:
+                connection = self.connection(host)
+
+            except (SMTPException, TransportException, socket.error) as e:
+                log.warning("%s unable to connect to %s for %s: %s", message.id, host, domain, e)
+                self._close(host)
+                continue
+
+            try:
+                result = connection.send_with_smtp(message)
+
+            except TransportFailedException:
+                log.warning("%s lost connection to %s for %s.", message.id, host, domain)
+                self._close(host)
+                continue
+
+            if result is None:  # A failure logged and swallowed by the connection, which is no longer trusted.
+                self._close(host)
+                raise TransportFailedException("Delivery to %s via %s deferred." % (domain, host))
+
+            if self.pipeline not in (None, True) and connection.sent >= self.pipeline:
+                self._close(host)
+
+            elif host in self.used:
+                self.used[host] = (self.used[host][0], clock())
+
+            return result
+
+        raise TransportFailedException("No mail exchanger of %s could be reached." % (domain, ))
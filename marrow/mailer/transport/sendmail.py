@@ -27,11 +27,14 @@ class SendmailTransport(object): # pragma: no cover
         args = [self.executable, '-t', '-i']
 
         if message.sendmail_f:
-            log.info("sendmail_f : {}".format(message.sendmail_f))
+            log.info("sendmail_f : %s", message.sendmail_f)
             args.extend(['-f', message.sendmail_f])
 
         proc = Popen(args, shell=False, stdin=PIPE)
-        proc.communicate(bytes(message))
+
+        for chunk in message.stream():
+            proc.stdin.write(chunk)
+
         proc.stdin.close()
         if proc.wait() != 0:
             raise MessageFailedException("Status code %d." % (proc.returncode, ))
@@ -2,10 +2,12 @@
 
 """Deliver messages using (E)SMTP."""
 
+import re
 import socket
 
-from smtplib import (SMTP, SMTP_SSL, SMTPException, SMTPRecipientsRefused,
-                     SMTPSenderRefused, SMTPServerDisconnected)
+from smtplib import (SMTP, SMTPException, SMTPRecipientsRefused,
+                     SMTPSenderRefused, SMTPServerDisconnected, SMTPDataError,
+                     SMTPResponseException, quoteaddr)
 
 from marrow.util.convert import boolean
 from marrow.util.compat import native
@@ -13,14 +15,71 @@ from marrow.util.compat import native
 from marrow.mailer.exc import (
     TransportExhaustedException, TransportException, TransportFailedException,
     MessageFailedException)
+from marrow.mailer.result import DeliveryResult
+from marrow.mailer.transport import tls
 
 log = __import__('logging').getLogger(__name__)
 
+_eols = re.compile(br'\r\n|\n|\r')
+_periods = re.compile(br'^\.', re.M)
+
+
+def quote_data(data):
+    """Prepare a serialized message for the DATA phase: CRLF line endings, dot-stuffed, and terminated."""
+
+    data = _periods.sub(b'..', _eols.sub(b'\r\n', data))
+
+    if not data.endswith(b'\r\n'):
+        data += b'\r\n'
+
+    return data + b'.\r\n'
+
+
+def quote_chunks(chunks):
+    """Prepare an iterable of message chunks, each beginning and ending on a line boundary, for the DATA phase."""
+
+    tail = b''
+
+    for data in chunks:
+        data = _periods.sub(b'..', _eols.sub(b'\r\n', data))
+
+        if data:
+            tail = data[-2:]
+            yield data
+
+    yield b'.\r\n' if tail == b'\r\n' else b'\r\n.\r\n'
+
+
+def split_lines(data, size):
+    """Divide a byte string into pieces of roughly ``size`` bytes, each ending with a complete line."""
+
+    offset = 0
+
+    while offset < len(data):
+        end = data.find(b'\n', offset + size) + 1 or len(data)
+        yield data[offset:end]
+        offset = end
+
+
+class SMTP_TLS(SMTP):
+    """An SMTP connection over implicit TLS, using the shared context and resuming earlier sessions; see ``tls``."""
+
+    default_port = 465
+
+    def __init__(self, certfile=None, keyfile=None, **kw):
+        self.certfile = certfile
+        self.keyfile = keyfile
+        SMTP.__init__(self, **kw)
+
+    def _get_socket(self, host, port, timeout):
+        sock = SMTP._get_socket(self, host, port, timeout)
+        return tls.wrap(sock, host, port, self.certfile, self.keyfile)
+
 
 class SMTPTransport(object):
     """An (E)SMTP pipelining transport."""
 
-    __slots__ = ('ephemeral', 'host', 'tls', 'certfile', 'keyfile', 'port', 'local_hostname', 'username', 'password', 'timeout', 'debug', 'pipeline', 'connection', 'sent')
+    __slots__ = ('ephemeral', 'host', 'tls', 'certfile', 'keyfile', 'port', 'local_hostname', 'username', 'password', 'timeout', 'debug', 'pipeline', 'chunking', 'connection', 'sent')
 
     def __init__(self, config):
         self.host = native(config.get('host', '127.0.0.1'))
@@ -42,6 +101,8 @@ class SMTPTransport(object):
         if self.pipeline not in (None, True, False):
             self.pipeline = int(self.pipeline)
 
+        self.chunking = int(config.get('chunking', 1024 * 1024) or 0)  # BDAT chunk size; zero to always use DATA.
+
         self.connection = None
         self.sent = 0
 
@@ -67,8 +128,8 @@ class SMTPTransport(object):
                 self.connection = None
 
     def connect_to_server(self):
-        if self.tls == 'ssl': # pragma: no cover
-            connection = SMTP_SSL(local_hostname=self.local_hostname, keyfile=self.keyfile,
+        if self.tls == 'ssl':
+            connection = SMTP_TLS(local_hostname=self.local_hostname, keyfile=self.keyfile,
                                   certfile=self.certfile, timeout=self.timeout)
         else:
             connection = SMTP(local_hostname=self.local_hostname, timeout=self.timeout)
@@ -79,9 +140,11 @@ class SMTPTransport(object):
 
         # Do TLS handshake if configured
         connection.ehlo()
-        if self.tls in ('required', 'optional', True):
-            if connection.has_extn('STARTTLS'): # pragma: no cover
-                connection.starttls(self.keyfile, self.certfile)
+        if self.tls == 'ssl':
+            tls.remember(connection.sock, self.host, self.port, self.certfile, self.keyfile)
+        elif self.tls in ('required', 'optional', True):
+            if connection.has_extn('STARTTLS'):
+                self.starttls(connection)
             elif self.tls == 'required':
                 raise TransportException('TLS is required but not available on the server -- aborting')
 
@@ -93,33 +156,254 @@ class SMTPTransport(object):
         self.connection = connection
         self.sent = 0
 
+    def starttls(self, connection):
+        """Upgrade the connection to TLS, as ``SMTP.starttls`` does, but using the shared context and resuming sessions."""
+
+        code, response = connection.docmd('STARTTLS')
+
+        if code != 220:
+            raise SMTPResponseException(code, response)
+
+        connection.sock = tls.wrap(connection.sock, self.host, self.port, self.certfile, self.keyfile)
+        connection.file = None
+
+        # Forget everything learned from the server prior to the handshake, per RFC 3207.
+        connection.helo_resp = connection.ehlo_resp = None
+        connection.esmtp_features = {}
+        connection.does_esmtp = False
+
+        connection.ehlo()
+        tls.remember(connection.sock, self.host, self.port, self.certfile, self.keyfile)
+
     @property
     def connected(self):
         return getattr(self.connection, 'sock', None) is not None
 
+    def alive(self):
+        """Determine if the server is still listening, for use by the transport pool prior to re-use."""
+
+        if not self.connected:
+            return False
+
+        try:
+            return self.connection.noop()[0] == 250
+
+        except (SMTPException, socket.error):
+            return False
+
     def deliver(self, message):
         if not self.connected:
             self.connect_to_server()
 
         try:
-            self.send_with_smtp(message)
+            result = self.send_with_smtp(message)
 
-        finally:
+        except Exception:
             if not self.pipeline or self.sent >= self.pipeline:
-                raise TransportExhaustedException()
+                self.ephemeral = True  # Retire the connection, without masking the failure.
+
+            raise
+
+        if not self.pipeline or self.sent >= self.pipeline:
+            raise TransportExhaustedException(result)
+
+        return result
+
+    def send_pipelined(self, sender, recipients, content, size=None):
+        """Perform an RFC 2920 pipelined mail transaction.
+
+        The MAIL, RCPT and DATA commands are written in a single batch and their replies read back
+        together, sparing a network round trip per recipient.  Behaves like ``SMTP.sendmail``: a
+        dictionary of refused recipients, mapped to their (code, response) reply, is returned, and
+        the same exceptions are raised if the sender, every recipient, or the message is refused.
+        The dictionary is a ``DeliveryResult``, also mapping each accepted recipient to the reply
+        accepting the message.
+
+        The content may be a byte string or, with its ``size`` given, an iterable of chunks such as
+        ``Message.stream()`` returns.  If the server supports RFC 3030 chunking the message is sent
+        using BDAT in place of DATA.
+        """
+
+        connection = self.connection
+        connection.ehlo_or_helo_if_needed()
+        chunking = self.chunking and connection.has_extn('chunking')
+
+        size = len(content) if size is None else size
+        options = ' SIZE=%d' % size if connection.has_extn('size') else ''
+        commands = ['MAIL FROM:%s%s' % (quoteaddr(sender), options)]
+        commands.extend('RCPT TO:%s' % quoteaddr(recipient) for recipient in recipients)
+
+        if not chunking:
+            commands.append('DATA')  # With chunking the message follows the replies, using BDAT.
+
+        connection.send(''.join(command + '\r\n' for command in commands))
+        replies = [connection.getreply() for command in commands]
+
+        (code, response), data = replies[0], (354, None) if chunking else replies[-1]
+        refused = dict((recipient, reply) for recipient, reply in zip(recipients, replies[1:]) if reply[0] not in (250, 251))
+
+        if data[0] == 354 and not chunking and (code != 250 or len(refused) == len(recipients)):
+            # The server wants the message even though nobody will receive it; give it an empty one.
+            connection.send(b'.\r\n')
+            connection.getreply()
+
+        if code != 250:
+            self._abort(code)
+            raise SMTPSenderRefused(code, response, sender)
+
+        if len(refused) == len(recipients):
+            self._abort(code)
+            raise SMTPRecipientsRefused(refused)
+
+        if data[0] != 354:
+            self._abort(data[0])
+            raise SMTPDataError(*data)
+
+        reply = self._send_chunks(content, True) if chunking else self._send_data(content)
+        return DeliveryResult(((recipient, reply) for recipient in recipients if recipient not in refused), refused)
+
+    def send_streamed(self, sender, recipients, content, size):
+        """Perform a mail transaction one command at a time, writing the message from an iterable of chunks.
+
+        Used in place of ``SMTP.sendmail``, which requires the complete message and reports only the
+        refused recipients, when the server does not support pipelining.  Returns and raises as
+        ``send_pipelined`` does.
+        """
+
+        connection = self.connection
+        connection.ehlo_or_helo_if_needed()
+
+        code, response = connection.mail(sender, ['SIZE=%d' % size] if connection.has_extn('size') else [])
+
+        if code != 250:
+            self._abort(code)
+            raise SMTPSenderRefused(code, response, sender)
+
+        refused = {}
+
+        for recipient in recipients:
+            reply = connection.rcpt(recipient)
+
+            if reply[0] not in (250, 251):
+                refused[recipient] = reply
+
+        if len(refused) == len(recipients):
+            self._abort(reply[0])
+            raise SMTPRecipientsRefused(refused)
+
+        if self.chunking and connection.has_extn('chunking'):
+            reply = self._send_chunks(content, False)
+
+        else:
+            code, response = connection.docmd('DATA')
+
+            if code != 354:
+                self._abort(code)
+                raise SMTPDataError(code, response)
+
+            reply = self._send_data(content)
+
+        return DeliveryResult(((recipient, reply) for recipient in recipients if recipient not in refused), refused)
+
+    def _send_data(self, content):
+        connection = self.connection
+
+        if isinstance(content, bytes):
+            connection.send(quote_data(content))
+
+        else:
+            for chunk in quote_chunks(content):
+                connection.send(chunk)
+
+        code, response = connection.getreply()
+
+        if code != 250:
+            self._abort(code)
+            raise SMTPDataError(code, response)
+
+        return code, response
+
+    def _send_chunks(self, content, pipelined):
+        """Transmit the message as a series of RFC 3030 BDAT commands, the last marked LAST.
+
+        BDAT content is counted rather than terminated, so no dot-stuffing is needed; only line endings
+        are converted.  Without pipelining the reply to each chunk is read before the next is sent.
+        """
+
+        connection = self.connection
+        chunks = split_lines(content, self.chunking) if isinstance(content, bytes) else content
+        replies, pending = [], None
+
+        for chunk in chunks:
+            chunk = _eols.sub(b'\r\n', chunk)
+
+            if not chunk:
+                continue
+
+            if pending is not None:
+                connection.send(('BDAT %d\r\n' % len(pending)).encode('ascii') + pending)
+                replies.append(None if pipelined else connection.getreply())
+
+                if replies[-1] and replies[-1][0] != 250:
+                    break  # No further chunks may be sent once one has been refused.
+
+            pending = chunk
+
+        else:
+            pending = pending or b''
+            connection.send(('BDAT %d LAST\r\n' % len(pending)).encode('ascii') + pending)
+            replies.append(None)
+
+        replies = [reply or connection.getreply() for reply in replies]
+        failures = [reply for reply in replies if reply[0] != 250]
+
+        if failures:
+            self._abort(failures[0][0])
+            raise SMTPDataError(*failures[0])
+
+        return replies[-1]
+
+    def _abort(self, code):
+        """Reset the transaction following a failure, or disconnect if the server is going away."""
+
+        if code == 421:
+            self.connection.close()
+            return
+
+        try:
+            self.connection.rset()
+
+        except SMTPServerDisconnected:  # pragma: no cover
+            pass
 
     def send_with_smtp(self, message):
         try:
             sender = str(message.envelope)
             recipients = message.recipients.string_addresses
-            recipients = [addr.decode('utf-8') for addr in message.recipients.string_addresses]
-            content = str(message)
 
-            self.connection.sendmail(sender, recipients, content)
+            send = self.send_pipelined if self.connection.has_extn('pipelining') else self.send_streamed
+            segments = message.segments
+
+            if len(segments) > 1:
+                # Streamed attachments are read from disk and encoded as the message is written.
+                result = send(sender, recipients, message.stream(), message.size)
+
+            else:
+                result = send(sender, recipients, segments[0], len(segments[0]))
+
             self.sent += 1
 
+            for recipient, reply in result.items():
+                log.warning("%s %s %s %s", message.id, "DEFERRED" if 400 <= reply[0] < 500 else "REFUSED", recipient, reply)
+
+            return result
+
         except SMTPSenderRefused as e:
-            # The envelope sender was refused.  This is bad.
+            # The envelope sender was refused; temporarily (e.g. a local error) or, which is bad, for good.
+            if 400 <= e.smtp_code < 500:
+                log.warning("%s DEFERRED %s %s", message.id, e.__class__.__name__, e)
+                raise TransportFailedException(str(e))
+
             log.error("%s REFUSED %s %s", message.id, e.__class__.__name__, e)
             raise MessageFailedException(str(e))
 
@@ -127,6 +411,20 @@ class SMTPTransport(object):
             # All recipients were refused. Log which recipients.
             # This allows you to automatically parse your logs for bad e-mail addresses.
             log.warning("%s REFUSED %s %s", message.id, e.__class__.__name__, e)
+            result = DeliveryResult(refused=e.recipients)
+
+            if result.deferred:
+                return result  # Some may yet accept the message; the manager will retry them.
+
+            raise MessageFailedException(str(e))
+
+        except SMTPDataError as e:
+            # The message was refused after the envelope was accepted, thus for every recipient alike.
+            if 400 <= e.smtp_code < 500:
+                log.warning("%s DEFERRED %s %s", message.id, e.__class__.__name__, e)
+                return DeliveryResult(refused=dict((recipient, (e.smtp_code, e.smtp_error)) for recipient in recipients))
+
+            log.error("%s REFUSED %s %s", message.id, e.__class__.__name__, e)
             raise MessageFailedException(str(e))
 
         except SMTPServerDisconnected as e: # pragma: no cover
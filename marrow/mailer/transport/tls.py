@@ -0,0 +1,132 @@
+# encoding: utf-8
+
+"""TLS shared by the SMTP transports: one SSL context per certificate, and session resumption across connections.
+
+Building an ``SSLContext`` loads the system's trust store and any client certificate, and a full handshake costs
+several round trips and an asymmetric key exchange.  Transports are routinely discarded and reconnected (e.g. after
+each ``pipeline`` messages) so the context is built once per process, and the session negotiated by one connection
+offered to the next connection to the same server, which may then resume it with an abbreviated handshake.
+
+Sessions are retained for the ``sessions`` servers most recently connected to.  Counts and the total duration of
+the handshakes performed are kept in ``stats``.
+"""
+
+import ssl
+import time
+
+from threading import Lock
+from collections import OrderedDict
+
+
+__all__ = ['context', 'wrap', 'remember', 'record', 'stats']
+
+log = __import__('logging').getLogger(__name__)
+
+clock = getattr(time, 'monotonic', time.time)
+
+_contexts = {}  # Client contexts by (certfile, keyfile).
+_sessions = OrderedDict()  # The most recent session by (host, port, certfile, keyfile), least recently used first.
+_lock = Lock()
+
+sessions = 256  # The number of servers whose session is retained.
+
+stats = dict(handshakes=0, resumed=0, failed=0, seconds=0.0)
+
+
+
+def context(certfile=None, keyfile=None):
+    """Return the process-wide client context for the given certificate, creating it on first use.
+
+    As with ``smtplib`` the server's certificate is not verified.
+    """
+
+    key = (certfile, keyfile)
+
+    with _lock:
+        result = _contexts.get(key)
+
+        if result is None:
+            result = ssl.create_default_context()
+            result.check_hostname = False
+            result.verify_mode = ssl.CERT_NONE
+
+            if certfile:
+                result.load_cert_chain(certfile, keyfile)
+
+            _contexts[key] = result
+
+    return result
+
+
+def record(seconds, resumed=False, failed=False):
+    """Count a handshake in ``stats``, for handshakes not performed by ``wrap``."""
+
+    with _lock:
+        stats['handshakes'] += 1
+        stats['seconds'] += seconds
+
+        if resumed:
+            stats['resumed'] += 1
+
+        if failed:
+            stats['failed'] += 1
+
+
+def wrap(sock, host, port, certfile=None, keyfile=None):
+    """Perform the client handshake over a connected socket, resuming the last session with this server if possible.
+
+    Returns the wrapped socket.
+    """
+
+    key = (host, port, certfile, keyfile)
+    options = dict(server_hostname=host)
+
+    with _lock:
+        session = _sessions.get(key)
+
+        if session is not None:  # Never present where the ssl module (i.e. before Python 3.6) lacks session support.
+            _sessions.move_to_end(key)
+            options['session'] = session
+
+    started = clock()
+
+    try:
+        sock = context(certfile, keyfile).wrap_socket(sock, **options)
+
+    except Exception:
+        record(clock() - started, failed=True)
+
+        with _lock:
+            _sessions.pop(key, None)
+
+        raise
+
+    elapsed = clock() - started
+    resumed = getattr(sock, 'session_reused', False)
+    record(elapsed, resumed)
+
+    log.debug("TLS handshake with %s:%s %s in %.1fms.", host, port, "resumed" if resumed else "completed", elapsed * 1000)
+
+    remember(sock, host, port, certfile, keyfile)
+    return sock
+
+
+def remember(sock, host, port, certfile=None, keyfile=None):
+    """Retain the session of a wrapped socket for reuse by later connections to the same server.
+
+    Servers speaking TLS 1.3 issue session tickets only after the handshake; call again once a reply has been read.
+    """
+
+    session = getattr(sock, 'session', None)
+
+    if session is None:
+        return
+
+    key = (host, port, certfile, keyfile)
+
+    with _lock:
+        _sessions[key] = session
+        _sessions.move_to_end(key)
+
+        while len(_sessions) > sessions:
+            _sessions.popitem(False)
@@ -99,12 +99,17 @@ setup(
 						'immediate = marrow.mailer.manager.immediate:ImmediateManager',
 						'futures = marrow.mailer.manager.futures:FuturesManager',
 						'dynamic = marrow.mailer.manager.dynamic:DynamicManager',
+						'asyncio = marrow.mailer.manager.aio:AsyncManager',
+						'spool = marrow.mailer.manager.spool:SpoolManager',
+						'process = marrow.mailer.manager.process:ProcessManager',
 						# 'transactional = marrow.mailer.manager.transactional:TransactionalDynamicManager'
 					],
 				'marrow.mailer.transport': [
 						'amazon = marrow.mailer.transport.ses:AmazonTransport',
 						'mock = marrow.mailer.transport.mock:MockTransport',
 						'smtp = marrow.mailer.transport.smtp:SMTPTransport',
+						'aiosmtp = marrow.mailer.transport.aiosmtp:AsyncSMTPTransport',
+						'mx = marrow.mailer.transport.mx:MXTransport',
 						'mbox = marrow.mailer.transport.mbox:MailboxTransport',
 						'mailbox = marrow.mailer.transport.mbox:MailboxTransport',
 						'maildir = marrow.mailer.transport.maildir:MaildirTransport',
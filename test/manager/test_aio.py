@@ -0,0 +1,194 @@
+# encoding: utf-8
+
+"""Test the asyncio delivery manager."""
+
+from __future__ import unicode_literals
+
+import threading
+
+import pytest
+
+from unittest import TestCase
+
+asyncio = pytest.importorskip('asyncio')
+aio = pytest.importorskip('marrow.mailer.manager.aio')  # Requires Python 3.5 syntax.
+
+from marrow.mailer import Mailer
+from marrow.mailer.exc import TransportFailedException, TransportExhaustedException, MessageFailedException, DeliveryFailedException
+from marrow.mailer.testing import build_message
+
+
+
+class AsyncMockTransport(object):
+    """Records deliveries, first raising any exceptions queued in the shared ``failures`` list."""
+    
+    instances = []
+    
+    def __init__(self, config=None):
+        self.failures = config.get('failures', []) if config else []  # Shared between instances.
+        self.started = self.stopped = 0
+        self.delivered = []
+        self.instances.append(self)
+    
+    async def startup(self):
+        self.started += 1
+    
+    async def deliver(self, message):
+        await asyncio.sleep(0)
+        
+        if self.failures:
+            raise self.failures.pop(0)
+        
+        self.delivered.append(message)
+        return len(self.delivered)
+    
+    async def shutdown(self):
+        self.stopped += 1
+
+
+class AsyncManagerTestCase(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        del AsyncMockTransport.instances[:]
+    
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+    
+    def build_mailer(self, manager=None, **transport):
+        manager = dict({'use': 'asyncio', 'concurrency': 4, 'retry.delay': 0.001}, **(manager or {}))
+        transport['use'] = AsyncMockTransport
+        return Mailer(dict(manager=manager, transport=transport))
+
+
+class TestSynchronousUse(AsyncManagerTestCase):
+    def test_entry_point(self):
+        assert Mailer(dict(manager=dict(use='asyncio'), transport=dict(use='mock'))).Manager is aio.AsyncManager
+    
+    def test_synchronous_use(self):
+        mailer = self.build_mailer().start()
+        message = build_message()
+        
+        assert mailer.send(message) == (message, 1)
+        assert mailer.send(message) == (message, 2)
+        assert len(AsyncMockTransport.instances) == 1  # The transport is re-used.
+        
+        mailer.stop()
+        assert AsyncMockTransport.instances[0].stopped == 1
+    
+    def test_without_event_loop(self):
+        mailer = self.build_mailer(dict(split=True)).start()
+        message = build_message(to=['one@example.com', 'two@example.org'])
+        results = []
+        
+        # A thread other than the main thread has no default event loop to fall back upon.
+        worker = threading.Thread(target=lambda: results.append(mailer.send(message)))
+        worker.start()
+        worker.join(5)
+        
+        assert results == [(message, [1, 2])]
+        
+        mailer.stop()
+        assert mailer.manager.loop is None  # The manager's own loop is closed with it.
+    
+    def test_from_another_thread(self):
+        mailer = self.build_mailer().start()
+        loop = self.loop
+        
+        async def main():
+            first = await mailer.deliver(build_message())
+            second = await loop.run_in_executor(None, mailer.send, build_message())  # Submitted to the running loop.
+            return first[1], second[1]
+        
+        assert loop.run_until_complete(main()) == (1, 2)
+        mailer.stop()
+    
+    def test_deliver_with_blocking_manager(self):
+        mailer = Mailer(dict(manager=dict(use='immediate'), transport=dict(use='mock'))).start()
+        message = build_message()
+        
+        assert self.loop.run_until_complete(mailer.deliver(message)) == (message, True)
+
+
+class TestAsynchronousUse(AsyncManagerTestCase):
+    def test_concurrent_delivery(self):
+        mailer = self.build_mailer().start()
+        messages = [build_message("Message %d." % i) for i in range(20)]
+        
+        async def main():
+            return await asyncio.gather(*[mailer.deliver(message) for message in messages])
+        
+        results = self.loop.run_until_complete(main())
+        
+        assert [message for message, result in results] == messages
+        assert 1 < len(AsyncMockTransport.instances) <= 4  # Bounded by the concurrency directive.
+        assert sum(len(i.delivered) for i in AsyncMockTransport.instances) == 20
+        
+        mailer.stop()
+        assert all(i.stopped == 1 for i in AsyncMockTransport.instances)
+    
+    def test_prewarm(self):
+        async def main():
+            mailer = self.build_mailer({'pool.prewarm': 2}).start()  # Within the running loop, so warming begins immediately.
+            pool = mailer.manager.transport
+            
+            for i in range(5): await asyncio.sleep(0)
+            idle = len(pool.transports)
+            
+            await mailer.send(build_message())
+            for i in range(5): await asyncio.sleep(0)
+            
+            await mailer.manager.shutdown()
+            return idle, len(pool.transports)
+        
+        assert self.loop.run_until_complete(main()) == (2, 0)
+        assert len(AsyncMockTransport.instances) == 3  # One replaced the transport checked out for delivery.
+        assert all(i.started == i.stopped == 1 for i in AsyncMockTransport.instances)
+    
+    def test_shutdown_waits_for_deliveries(self):
+        mailer = self.build_mailer().start()
+        
+        async def main():
+            tasks = [mailer.send(build_message()) for i in range(5)]
+            await mailer.manager.shutdown()
+            return tasks
+        
+        tasks = self.loop.run_until_complete(main())
+        assert all(task.done() for task in tasks)
+
+
+class TestFailures(AsyncManagerTestCase):
+    def test_transport_failure_retries(self):
+        mailer = self.build_mailer(failures=[TransportFailedException()]).start()
+        message = build_message()
+        
+        assert mailer.send(message) == (message, 1)
+        assert len(AsyncMockTransport.instances) == 2
+        assert AsyncMockTransport.instances[0].stopped == 1
+    
+    def test_transport_exhaustion(self):
+        mailer = self.build_mailer(failures=[TransportExhaustedException()]).start()
+        message = build_message()
+        
+        assert mailer.send(message) == (message, None)
+        assert AsyncMockTransport.instances[0].stopped == 1
+        assert not mailer.manager.transport.transports
+    
+    def test_transport_failure_abandoned(self):
+        mailer = self.build_mailer(failures=[TransportFailedException()] * 4).start()
+        
+        with pytest.raises(DeliveryFailedException) as exc:
+            mailer.send(build_message())
+        
+        assert 'abandoned after 4 attempts' in exc.value.reason  # The message's three retries are exhausted.
+    
+    def test_message_failure(self):
+        mailer = self.build_mailer(failures=[MessageFailedException("Bad.")]).start()
+        message = build_message()
+        
+        with pytest.raises(DeliveryFailedException) as exc:
+            mailer.send(message)
+        
+        assert exc.value.msg is message
+        assert exc.value.reason == "Bad."
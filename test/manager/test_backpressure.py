@@ -0,0 +1,186 @@
+# encoding: utf-8
+
+"""Test the bounded queue of the dynamic manager and its backpressure policies."""
+
+from __future__ import unicode_literals
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+
+import pytest
+
+from unittest import TestCase
+
+from marrow.mailer import Mailer
+from marrow.mailer.exc import MailConfigurationException, QueueFullException
+from marrow.mailer.manager.dynamic import PriorityQueue, DynamicManager
+from marrow.mailer.testing import GatedTransport, build_message
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+
+class TestReservation(TestCase):
+    def test_reserve(self):
+        work = PriorityQueue(maxsize=2)
+        work.reserve()
+        work.put('one', reserved=True)
+        work.put('unbounded')
+        
+        assert work.full()
+        
+        with pytest.raises(queue.Full):
+            work.reserve(False)
+        
+        with pytest.raises(queue.Full):
+            work.reserve(True, 0.01)
+        
+        threading.Timer(0.01, work.get).start()
+        work.reserve(True, 5)
+        work.release()
+        
+        assert not work.full()
+
+
+class BackpressureTestCase(TestCase):
+    config = dict()
+    
+    def setUp(self):
+        GatedTransport.reset()
+        self.path = tempfile.mkdtemp()
+        self.mailer = None
+    
+    def tearDown(self):
+        GatedTransport.gate.set()
+        
+        if self.mailer is not None:
+            self.mailer.stop()
+        
+        shutil.rmtree(self.path)
+    
+    @property
+    def delivered(self):
+        return [message.subject for message in GatedTransport.delivered]
+    
+    def start(self, **config):
+        """Start a single-worker manager whose only worker is occupied delivering the first message."""
+        
+        config = dict(self.config, use=DynamicManager, workers=1, **config)
+        self.mailer = Mailer(dict(manager=config, transport=dict(use=GatedTransport))).start()
+        
+        receipt = self.mailer.send(build_message('first'))
+        
+        for i in range(500):  # Wait for the only worker to take the first delivery.
+            if not self.mailer.manager.queued:
+                break
+            
+            time.sleep(0.01)
+        
+        return receipt
+
+
+class TestConfiguration(BackpressureTestCase):
+    def test_policy(self):
+        with pytest.raises(MailConfigurationException):
+            DynamicManager({'queue.policy': 'drop'}, None)
+    
+    def test_spill_path(self):
+        with pytest.raises(MailConfigurationException):
+            DynamicManager({'queue.policy': 'spill'}, None)
+        
+        assert DynamicManager({'queue.policy': 'spill', 'queue.path': self.path}, None).spill is not None
+
+
+class TestReject(BackpressureTestCase):
+    config = {'queue.size': 1, 'queue.policy': 'reject'}
+    
+    def test_reject(self):
+        self.start()
+        self.mailer.send(build_message('second'))
+        
+        assert self.mailer.manager.queued == 1
+        
+        with pytest.raises(QueueFullException):
+            self.mailer.send(build_message('third'))
+        
+        result = self.mailer.send_many([build_message('fourth')])
+        assert isinstance(result.failed[0][1], QueueFullException)
+        
+        GatedTransport.gate.set()
+        self.mailer.stop()
+        
+        assert self.delivered == ['first', 'second']
+
+
+class TestBlock(BackpressureTestCase):
+    config = {'queue.size': 1}
+    
+    def test_block(self):
+        self.start()
+        self.mailer.send(build_message('second'))
+        
+        threading.Timer(0.05, GatedTransport.gate.set).start()
+        self.mailer.send(build_message('third')).result(5)  # Blocks until there is room.
+        self.mailer.stop()
+        
+        assert self.delivered == ['first', 'second', 'third']
+    
+    def test_block_with_timeout(self):
+        self.start(**{'queue.timeout': 0.05})
+        self.mailer.send(build_message('second'))
+        
+        started = time.time()
+        
+        with pytest.raises(QueueFullException):
+            self.mailer.send(build_message('third'))
+        
+        assert time.time() - started >= 0.05
+
+
+class TestSpill(BackpressureTestCase):
+    config = {'queue.size': 1, 'queue.policy': 'spill'}
+    
+    def start(self, **config):
+        return super(TestSpill, self).start(**dict(config, **{'queue.path': self.path}))
+    
+    def test_spill(self):
+        self.start()
+        receipts = [self.mailer.send(build_message(str(i))) for i in range(5)]
+        
+        assert self.mailer.manager.queued == 1
+        assert self.mailer.manager.spilled == 4
+        assert len(os.listdir(self.path)) == 4
+        
+        GatedTransport.gate.set()
+        
+        for receipt in receipts:
+            receipt.result(5)
+        
+        self.mailer.stop()
+        
+        assert self.delivered == ['first', '0', '1', '2', '3', '4']
+        assert not os.listdir(self.path)
+    
+    def test_spill_recovery(self):
+        self.start()
+        self.mailer.send(build_message('queued'))
+        self.mailer.send(build_message('spilled'))
+        
+        self.mailer.manager.spill.entries.clear()  # As if the process had died.
+        GatedTransport.gate.set()
+        self.mailer.stop()
+        
+        assert self.delivered == ['first', 'queued']
+        assert len(os.listdir(self.path)) == 1
+        
+        self.start()
+        self.mailer.stop()
+        
+        assert sorted(self.delivered) == ['first', 'first', 'queued', 'spilled']
+        assert not os.listdir(self.path)
@@ -0,0 +1,255 @@
+# encoding: utf-8
+
+"""Test the transport pool shared by the delivery managers."""
+
+from __future__ import unicode_literals
+
+import time
+import threading
+
+import pytest
+
+from unittest import TestCase
+from concurrent import futures
+
+from marrow.mailer.exc import PoolTimeoutException, TransportFailedException
+from marrow.mailer.manager.util import TransportPool, deliver_once, deliver_batch
+from marrow.mailer.testing import build_message
+
+
+
+class PoolTransport(object):
+    def __init__(self, healthy=True):
+        self.healthy = healthy
+        self.running = False
+        self.probes = 0
+    
+    def startup(self):
+        self.running = True
+    
+    def shutdown(self):
+        self.running = False
+    
+    def alive(self):
+        self.probes += 1
+        return self.healthy
+    
+    def deliver(self, message):
+        return message._serialized is not None  # Was the message rendered prior to checkout?
+
+
+class TestCheckout(TestCase):
+    def test_reuse(self):
+        pool = TransportPool(PoolTransport)
+        
+        with pool() as first:
+            pass
+        
+        with pool() as second:
+            assert second is first
+        
+        assert pool.stats == dict(created=1, reused=1, evicted=0, waited=0)
+        
+        pool.shutdown()
+        assert not first.running
+        assert pool.active == 0
+    
+    def test_ephemeral_and_failed_transports_free_their_slot(self):
+        pool = TransportPool(PoolTransport, size=1)
+        
+        with pool() as transport:
+            transport.ephemeral = True
+        
+        with pytest.raises(ValueError):
+            with pool() as transport:
+                raise ValueError()
+        
+        assert pool.active == 0
+        assert not transport.running
+    
+    def test_size_limit_timeout(self):
+        pool = TransportPool(PoolTransport, size=1, timeout=0.05)
+        
+        with pool():
+            with pytest.raises(PoolTimeoutException):
+                with pool():
+                    pass
+        
+        assert pool.stats['waited'] == 1
+        assert pool.stats['created'] == 1
+    
+    def test_size_limit_blocks_until_release(self):
+        pool = TransportPool(PoolTransport, size=2, timeout=5)
+        seen = []
+        
+        def work():
+            with pool() as transport:
+                seen.append(transport)
+                time.sleep(0.01)
+        
+        threads = [threading.Thread(target=work) for i in range(6)]
+        
+        for thread in threads:
+            thread.start()
+        
+        for thread in threads:
+            thread.join()
+        
+        assert len(seen) == 6
+        assert len(set(map(id, seen))) <= 2
+        assert pool.stats['created'] <= 2
+        assert pool.stats['waited'] > 0
+
+
+class TestEviction(TestCase):
+    def test_idle_eviction(self):
+        pool = TransportPool(PoolTransport, idle=0.01)
+        
+        with pool() as first:
+            pass
+        
+        time.sleep(0.02)
+        assert pool.evict() == 1
+        assert not first.running
+        
+        with pool() as second:
+            assert second is not first
+        
+        assert pool.stats == dict(created=2, reused=0, evicted=1, waited=0)
+    
+    def test_age_eviction(self):
+        pool = TransportPool(PoolTransport, age=0.01)
+        
+        with pool() as first:
+            time.sleep(0.02)
+        
+        assert not first.running  # Retired upon release.
+        assert not pool.transports
+        assert pool.stats['evicted'] == 1
+    
+    def test_probe(self):
+        pool = TransportPool(PoolTransport, probe=0)
+        
+        with pool() as first:
+            pass
+        
+        with pool() as second:
+            assert second is first
+            second.healthy = False
+        
+        with pool() as third:
+            assert third is not first
+        
+        assert first.probes == 2
+        assert not first.running
+        assert pool.stats['evicted'] == 1
+    
+    def test_probe_threshold(self):
+        pool = TransportPool(PoolTransport, probe=60)
+        
+        with pool() as first:
+            pass
+        
+        with pool():
+            pass
+        
+        assert first.probes == 0  # Recently used transports are trusted.
+
+
+class TestPrewarm(TestCase):
+    def test_prewarm(self):
+        pool = TransportPool(PoolTransport, size=3, prewarm=2)
+        pool.startup()
+        
+        try:
+            assert len(pool.transports) == 2
+            assert all(transport.running for released, created, transport in pool.transports)
+            
+            with pool() as first:
+                assert pool.stats['reused'] == 1  # Warm transports are handed out as any idle one would be.
+                
+                for i in range(100):  # The refill thread replaces the transport checked out.
+                    if len(pool.transports) == 2:
+                        break
+                    
+                    time.sleep(0.01)
+                
+                assert len(pool.transports) == 2
+                
+                with pool() as second:
+                    time.sleep(0.05)
+                    assert len(pool.transports) == 1  # Never exceeding the size of the pool.
+            
+            assert pool.stats['created'] == 3
+        
+        finally:
+            pool.shutdown()
+        
+        assert pool.refill is None
+        assert pool.active == 0
+        assert not first.running
+    
+    def test_prewarm_failure(self):
+        class BrokenTransport(PoolTransport):
+            def startup(self):
+                raise IOError("Connection refused.")
+        
+        pool = TransportPool(BrokenTransport, prewarm=2)
+        pool.startup()  # Failures are logged, but are not fatal.
+        
+        try:
+            assert not pool.transports
+            assert pool.active == 0
+        
+        finally:
+            pool.shutdown()
+
+
+class TestConfiguration(TestCase):
+    def test_from_config(self):
+        pool = TransportPool.from_config(PoolTransport, {'pool.size': '4', 'pool.timeout': '2.5', 'pool.idle': 30, 'pool.prewarm': '2'})
+        
+        assert (pool.size, pool.timeout, pool.idle, pool.age, pool.probe) == (4, 2.5, 30.0, None, None)
+        assert pool.prewarm == 2
+        assert not pool.render
+        assert TransportPool.from_config(PoolTransport, {'render': 'worker'}).render
+
+
+class TestDelivery(TestCase):
+    def test_render(self):
+        assert deliver_once(TransportPool(PoolTransport), build_message())[1] is False
+        assert deliver_once(TransportPool(PoolTransport, render=True), build_message())[1] is True
+        
+        batch = [(build_message(), futures.Future()), (build_message(plain=None), futures.Future())]
+        deliver_batch(TransportPool(PoolTransport, render=True), batch)
+        
+        assert batch[0][1].result() == (batch[0][0], True)
+        assert isinstance(batch[1][1].exception(), ValueError)  # Unrenderable, thus never handed to a transport.
+    
+    def test_batch_acquisition_failure(self):
+        class RefusedTransport(PoolTransport):
+            def startup(self):
+                raise IOError("Connection refused.")
+        
+        class FailedTransport(PoolTransport):
+            def startup(self):
+                raise TransportFailedException("Try again later.")
+        
+        def build():
+            return [(build_message(), futures.Future()) for i in range(3)]
+        
+        batch = build()
+        deliver_batch(TransportPool(RefusedTransport), batch, lambda message, receipt: pytest.fail("Deferred."))
+        assert all(isinstance(receipt.exception(0), IOError) for message, receipt in batch)
+        
+        batch, deferred = build(), []
+        deliver_batch(TransportPool(FailedTransport), batch, lambda message, receipt: deferred.append(receipt))
+        assert deferred == [receipt for message, receipt in batch]
+        
+        batch = build()
+        pool = TransportPool(PoolTransport, size=1, timeout=0.01)
+        
+        with pool():
+            deliver_batch(pool, batch, lambda message, receipt: pytest.fail("Deferred."))
+        
+        assert all(isinstance(receipt.exception(0), PoolTimeoutException) for message, receipt in batch)
@@ -0,0 +1,122 @@
+# encoding: utf-8
+
+"""Test the priority scheduling of the dynamic manager."""
+
+from __future__ import unicode_literals
+
+import threading
+
+import pytest
+
+from unittest import TestCase
+
+from marrow.mailer import Mailer, Message
+from marrow.mailer.manager.dynamic import PriorityQueue, DynamicManager, priority
+from marrow.mailer.testing import GatedTransport, build_message
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+
+class TestPriority(TestCase):
+    def test_priority(self):
+        assert priority(Message()) is None
+        assert priority(Message(priority=1)) == 1
+        assert priority(Message(priority='2 (High)')) == 2
+        assert priority(Message(priority='urgent'), 3) == 3
+
+
+class TestPriorityQueue(TestCase):
+    def test_levels(self):
+        work = PriorityQueue({1: 2, 5: 1})
+        
+        assert work.default == 1  # Nearest to 3, favouring the more urgent.
+        assert work.level(2) == 1
+        assert work.level(4) == 5
+        assert work.level(9) == 5
+    
+    def test_weighted_fairness(self):
+        work = PriorityQueue({1: 4, 3: 2, 5: 1})
+        
+        for i in range(20):
+            work.put(('bulk', i), 5)
+            work.put(('normal', i))
+            work.put(('urgent', i), 1)
+        
+        assert work.qsize() == 60
+        assert work.depths() == {1: 20, 3: 20, 5: 20}
+        
+        served = [work.get()[0] for i in range(14)]
+        
+        assert served.count('urgent') == 8
+        assert served.count('normal') == 4
+        assert served.count('bulk') == 2  # Not starved.
+        assert work.depths() == {1: 12, 3: 16, 5: 18}
+    
+    def test_idle_levels_accrue_no_credit(self):
+        work = PriorityQueue({1: 1, 5: 1})
+        
+        for i in range(10):
+            work.put(i, 5)
+        
+        for i in range(10):
+            work.get()
+        
+        work.put('bulk', 5)
+        work.put('urgent', 1)
+        
+        assert work.get() == 'urgent'  # Level 5 has had its share; level 1 was merely idle.
+    
+    def test_fifo_within_level(self):
+        work = PriorityQueue()
+        
+        for i in range(5):
+            work.put(i)
+        
+        assert [work.get() for i in range(5)] == list(range(5))
+    
+    def test_sentinels_last(self):
+        work = PriorityQueue()
+        work.put(None)
+        work.put('work', 5)
+        
+        assert work.get() == 'work'
+        assert work.get() is None
+    
+    def test_empty(self):
+        work = PriorityQueue()
+        
+        with pytest.raises(queue.Empty):
+            work.get(False)
+        
+        with pytest.raises(queue.Empty):
+            work.get(True, 0.01)
+        
+        threading.Timer(0.01, work.put, ('late', )).start()
+        assert work.get(True, 5) == 'late'
+
+
+class TestPriorityDelivery(TestCase):
+    def setUp(self):
+        GatedTransport.reset()
+        self.mailer = Mailer(dict(manager=dict(use=DynamicManager, workers=1), transport=dict(use=GatedTransport))).start()
+    
+    def tearDown(self):
+        GatedTransport.gate.set()
+        self.mailer.stop()
+    
+    def test_urgent_overtakes_bulk(self):
+        receipts = [self.mailer.send(build_message('bulk', priority=5)) for i in range(20)]
+        receipts.append(self.mailer.send(build_message('reset', priority=1)))
+        
+        assert self.mailer.manager.depths[5] >= 19
+        
+        GatedTransport.gate.set()
+        
+        for receipt in receipts:
+            receipt.result(5)
+        
+        assert [message.subject for message in GatedTransport.delivered].index('reset') < 5
@@ -0,0 +1,106 @@
+# encoding: utf-8
+
+"""Test the process pool delivery manager."""
+
+from __future__ import unicode_literals
+
+import os
+import time
+import shutil
+import tempfile
+
+import pytest
+
+from unittest import TestCase
+
+from marrow.mailer import Mailer
+from marrow.mailer.exc import DeliveryFailedException, MessageFailedException, TransportFailedException
+from marrow.mailer.manager.process import ProcessManager
+from marrow.mailer.testing import RecordingTransport, build_message
+
+
+
+class ProcessTransport(RecordingTransport):
+    """Reports the process delivering each message; subjects request failures."""
+    
+    def startup(self):
+        if 'started' in self.config:
+            open(os.path.join(self.config['started'], str(os.getpid())), 'w').close()
+    
+    def deliver(self, message):
+        kind, _, path = message.subject.partition(':')
+        
+        if kind == 'refuse':
+            raise MessageFailedException("Refused.")
+        
+        if kind == 'flaky' and not os.path.exists(path):
+            open(path, 'w').close()  # Succeed on the next attempt, wherever it is made.
+            raise TransportFailedException()
+        
+        return os.getpid(), len(message.serialized)
+
+
+def attached_message(subject="Test."):
+    message = build_message(subject)
+    message.attach('data.bin', b'\0' * 4096)
+    return message
+
+
+class ProcessManagerTestCase(TestCase):
+    config = {'manager.use': ProcessManager, 'manager.workers': 2, 'manager.retry.delay': 0.01, 'transport.use': ProcessTransport}
+    
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.mailer = Mailer(self.config).start()
+    
+    def tearDown(self):
+        self.mailer.stop()
+        shutil.rmtree(self.path)
+
+
+class TestDelivery(ProcessManagerTestCase):
+    def test_delivery(self):
+        message = attached_message()
+        delivered, (pid, size) = self.mailer.send(message).result(10)
+        
+        assert delivered is message
+        assert pid != os.getpid()
+        assert size > 4096
+        assert message._serialized is None  # Rendered only within the worker.
+    
+    def test_batch(self):
+        result = self.mailer.send_many(attached_message() for i in range(10))
+        
+        assert result.wait(10)
+        assert len(result.delivered) == 10
+    
+    def test_refusal(self):
+        message = attached_message('refuse')
+        
+        with pytest.raises(DeliveryFailedException) as excinfo:
+            self.mailer.send(message).result(10)
+        
+        assert excinfo.value.msg is message
+        assert excinfo.value.reason == "Refused."
+    
+    def test_retry(self):
+        path = os.path.join(self.path, 'attempted')
+        message, result = self.mailer.send(attached_message('flaky:' + path)).result(10)
+        
+        assert os.path.exists(path)
+        assert result[0] != os.getpid()
+
+
+class TestPrewarm(ProcessManagerTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.mailer = Mailer(dict(self.config, **{'manager.pool.prewarm': 1, 'transport.started': self.path})).start()
+    
+    def test_prewarm(self):
+        for i in range(100):
+            if len(os.listdir(self.path)) == 2:
+                break
+            
+            time.sleep(0.05)
+        
+        assert len(os.listdir(self.path)) == 2  # Each worker started a transport before any delivery.
@@ -0,0 +1,273 @@
+# encoding: utf-8
+
+"""Test the retry of deliveries deferred by transport failure or temporary refusal."""
+
+from __future__ import unicode_literals
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+
+import pytest
+
+from unittest import TestCase
+
+from marrow.mailer import Mailer
+from marrow.mailer.exc import TransportFailedException, DeliveryFailedException, DeliveryDeferredException
+from marrow.mailer.manager.util import RetryPolicy, clock
+from marrow.mailer.result import DeliveryResult
+from marrow.mailer.testing import RecordingTransport, build_message
+
+
+
+class FlakyTransport(RecordingTransport):
+    """Fails the number of times requested by the message's subject before succeeding."""
+    
+    attempts = []
+    
+    def deliver(self, message):
+        self.attempts.append(clock())
+        
+        if len(self.attempts) <= int(message.subject):
+            raise TransportFailedException()
+        
+        return super(FlakyTransport, self).deliver(message)
+    
+    @classmethod
+    def reset(cls):
+        del cls.attempts[:]
+        super(FlakyTransport, cls).reset()
+
+
+class GreylistTransport(FlakyTransport):
+    """Temporarily refuses recipients named ``grey`` upon their first attempt."""
+    
+    def deliver(self, message):
+        recipients = message.recipients.string_addresses
+        self.attempts.append(recipients)
+        
+        refused = dict((recipient, (451, b'Greylisted.')) for recipient in recipients if recipient.startswith('grey') and len(self.attempts) == 1)
+        return DeliveryResult(((recipient, (250, b'Queued.')) for recipient in recipients if recipient not in refused), refused)
+
+
+def flaky_message(failures=0):
+    return build_message(str(failures))
+
+
+class RetryTestCase(TestCase):
+    manager = 'futures'
+    
+    def setUp(self):
+        FlakyTransport.reset()
+        self.mailer = None
+    
+    def tearDown(self):
+        if self.mailer is not None:
+            self.mailer.stop()
+    
+    def start(self, transport=FlakyTransport, **config):
+        config.setdefault('retry.delay', 0.01)
+        config.setdefault('retry.jitter', 0)
+        config['use'] = self.manager
+        self.mailer = Mailer(dict(manager=config, transport=dict(use=transport))).start()
+        return self.mailer
+    
+    def result(self, receipt):
+        return receipt if self.manager == 'immediate' else receipt.result(5)
+
+
+class TestRetryPolicy(TestCase):
+    def test_backoff(self):
+        policy = RetryPolicy(delay=1, factor=2, maximum=10, jitter=0)
+        assert [policy.backoff(i) for i in range(1, 6)] == [1, 2, 4, 8, 10]
+    
+    def test_jitter(self):
+        policy = RetryPolicy(delay=10, jitter=0.5)
+        delays = [policy.backoff(1) for i in range(100)]
+        
+        assert all(5 <= delay <= 15 for delay in delays)
+        assert len(set(delays)) > 1
+    
+    def test_limit(self):
+        message = flaky_message()
+        assert RetryPolicy().limit(message) == 3
+        assert RetryPolicy(attempts=5).limit(message) == 5
+        
+        message.retries = -1
+        assert RetryPolicy().limit(message) == 0
+    
+    def test_next(self):
+        policy = RetryPolicy(delay=1, jitter=0)
+        started = clock()
+        
+        assert policy.next(1, started, 2) == 1
+        assert policy.next(2, started, 2) == 2
+        assert policy.next(3, started, 2) is None
+    
+    def test_deadline(self):
+        policy = RetryPolicy(delay=1, jitter=0, deadline=3)
+        started = clock()
+        
+        assert policy.next(2, started, 10) == 2
+        assert policy.next(3, started, 10) is None  # Four seconds would exceed the deadline.
+    
+    def test_from_config(self):
+        policy = RetryPolicy.from_config({'retry.delay': '0.5', 'retry.attempts': '7', 'retry.deadline': ''})
+        
+        assert (policy.delay, policy.attempts, policy.deadline, policy.factor) == (0.5, 7, None, 2)
+    
+    def test_retries_do_not_invalidate_serialization(self):
+        message = flaky_message()
+        serialized = message.serialized
+        message.retries -= 1
+        
+        assert message.serialized is serialized
+
+
+class TestDeliveryResult(TestCase):
+    def test_combine(self):
+        first = DeliveryResult({'one': (250, b'OK')}, {'two': (451, b'Later.'), 'three': (550, b'Never.')})
+        
+        assert first == {'two': (451, b'Later.'), 'three': (550, b'Never.')}
+        assert list(first.deferred) == ['two']
+        assert list(first.rejected) == ['three']
+        
+        combined = first.combine(DeliveryResult({'two': (250, b'OK')}))
+        assert sorted(combined.accepted) == ['one', 'two']
+        assert combined == {'three': (550, b'Never.')}
+
+
+class ManagerRetryTests(object):
+    """Run against each manager in turn; mixed into a ``RetryTestCase`` subclass per manager."""
+    
+    def test_backoff(self):
+        mailer = self.start()
+        message = flaky_message(2)
+        
+        assert self.result(mailer.send(message)) == (message, True)
+        
+        first, second, third = FlakyTransport.attempts
+        assert 0.01 <= second - first
+        assert 0.02 <= third - second
+    
+    def test_abandoned(self):
+        mailer = self.start(**{'retry.attempts': 1})
+        
+        with pytest.raises(DeliveryFailedException) as exc:
+            self.result(mailer.send(flaky_message(5)))
+        
+        assert 'abandoned after 2 attempts' in exc.value.reason
+        assert len(FlakyTransport.attempts) == 2
+    
+    def test_batch_retry(self):
+        mailer = self.start()
+        messages = [flaky_message(1), flaky_message(0), flaky_message(0)]
+        
+        result = mailer.send_many(messages)
+        assert result.wait(5)
+        assert result.delivered == messages
+    
+    def test_deferred_recipients_retried(self):
+        mailer = self.start(GreylistTransport)
+        message = build_message(to=['one@example.com', 'grey@example.com'])
+        
+        message, result = self.result(mailer.send(message))
+        
+        assert GreylistTransport.attempts == [['one@example.com', 'grey@example.com'], ['grey@example.com']]
+        assert sorted(result.accepted) == ['grey@example.com', 'one@example.com']
+        assert result == {}
+        
+        # The envelope, narrowed for the retry, is restored so the message may be sent again whole.
+        assert message.recipients.string_addresses == ['one@example.com', 'grey@example.com']
+        assert message._result is None
+
+
+class TestImmediateRetry(ManagerRetryTests, RetryTestCase):
+    manager = 'immediate'
+    
+    def test_batch_retry_with_single_transport(self):
+        # The failed transport must be returned to the pool before the immediate manager retries.
+        mailer = self.start(**{'pool.size': 1})
+        messages = [flaky_message(1), flaky_message(0)]
+        
+        results = []
+        
+        worker = threading.Thread(target=lambda: results.append(mailer.send_many(messages)))
+        worker.daemon = True
+        worker.start()
+        worker.join(5)
+        
+        assert results and results[0].delivered == messages
+
+
+class TestFuturesRetry(ManagerRetryTests, RetryTestCase):
+    manager = 'futures'
+    
+    def test_deferred_recipients_restored_when_abandoned(self):
+        mailer = self.start(GreylistTransport, **{'retry.attempts': 0})
+        message = build_message(to=['one@example.com', 'grey@example.com'])
+        
+        with pytest.raises(DeliveryFailedException):
+            mailer.send(message).result(5)
+        
+        assert message.recipients.string_addresses == ['one@example.com', 'grey@example.com']
+    
+    def test_deferred_deliveries_do_not_occupy_workers(self):
+        mailer = self.start(workers=1, **{'retry.delay': 0.2})
+        
+        deferred = mailer.send(flaky_message(1))
+        time.sleep(0.05)
+        assert len(mailer.manager.retry) == 1
+        
+        healthy = mailer.send(flaky_message(0))
+        assert healthy.result(0.1)  # Delivered while the other waits.
+        assert not deferred.done()
+        
+        assert deferred.result(5)
+    
+    def test_shutdown_releases_deferred_deliveries(self):
+        mailer = self.start(**{'retry.delay': 60})
+        
+        receipt = mailer.send(flaky_message(1))
+        time.sleep(0.05)
+        mailer.stop()
+        
+        assert receipt.result(0)  # Given a final attempt, which succeeded.
+    
+    def test_shutdown_with_failing_deferred_delivery(self):
+        mailer = self.start(**{'retry.delay': 60})
+        
+        receipt = mailer.send(flaky_message(5))
+        time.sleep(0.05)
+        mailer.stop()
+        
+        with pytest.raises(DeliveryDeferredException):
+            receipt.result(0)
+
+
+class TestDynamicRetry(ManagerRetryTests, RetryTestCase):
+    manager = 'dynamic'
+
+
+class TestSpoolRetry(RetryTestCase):
+    manager = 'spool'
+    
+    def setUp(self):
+        super(TestSpoolRetry, self).setUp()
+        self.path = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        super(TestSpoolRetry, self).tearDown()
+        shutil.rmtree(self.path)
+    
+    def test_deferred_messages_are_kept(self):
+        mailer = self.start(path=self.path, **{'retry.delay': 60})
+        
+        mailer.send(flaky_message(5))
+        time.sleep(0.05)
+        mailer.stop()
+        
+        assert len(os.listdir(os.path.join(self.path, 'new'))) == 1
+        assert not os.listdir(os.path.join(self.path, 'failed'))
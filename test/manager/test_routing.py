@@ -0,0 +1,213 @@
+# encoding: utf-8
+
+"""Test per-domain connection caps and rate limits."""
+
+from __future__ import unicode_literals
+
+import time
+import threading
+
+from collections import defaultdict
+
+import pytest
+
+from unittest import TestCase
+
+from marrow.mailer import Mailer
+from marrow.mailer.exc import MailConfigurationException
+from marrow.mailer.manager.routing import TokenBucket
+from marrow.mailer.testing import RecordingTransport, build_message
+
+
+
+class SlowTransport(RecordingTransport):
+    """Tracks the peak number of simultaneous deliveries to each domain."""
+    
+    lock = threading.Lock()
+    active = defaultdict(int)
+    peak = defaultdict(int)
+    finished = []
+    
+    def deliver(self, message):
+        domain = message.recipients[0].address.rpartition('@')[2]
+        
+        with self.lock:
+            self.active[domain] += 1
+            self.peak[domain] = max(self.peak[domain], self.active[domain])
+        
+        time.sleep(0.02)
+        
+        with self.lock:
+            self.active[domain] -= 1
+            self.finished.append((time.time(), domain))
+        
+        return super(SlowTransport, self).deliver(message)
+    
+    @classmethod
+    def reset(cls):
+        cls.active.clear()
+        cls.peak.clear()
+        del cls.finished[:]
+        super(SlowTransport, cls).reset()
+
+
+def domain_message(domain):
+    return build_message(to='user@' + domain)
+
+
+class RoutingTestCase(TestCase):
+    def setUp(self):
+        SlowTransport.reset()
+    
+    def build_mailer(self, manager='futures', **config):
+        config.update(use=manager, workers=10)
+        return Mailer(dict(manager=config, transport=dict(use=SlowTransport)))
+
+
+class TestTokenBucket(TestCase):
+    def test_burst(self):
+        bucket = TokenBucket(10, 3)
+        now = bucket.updated
+        
+        assert [bucket.consume(now) for i in range(4)] == [True, True, True, False]
+        assert bucket.delay(now) == pytest.approx(0.1)
+    
+    def test_refill(self):
+        bucket = TokenBucket(10, 1)
+        now = bucket.updated
+        
+        assert bucket.consume(now)
+        assert not bucket.consume(now + 0.05)
+        assert bucket.consume(now + 0.11)
+        
+        assert bucket.delay(now + 10) == 0
+        assert bucket.tokens == 1  # Capped at capacity.
+    
+    def test_default_capacity(self):
+        assert TokenBucket(0.5).capacity == 1
+        assert TokenBucket(20).capacity == 20
+
+
+class TestConfiguration(RoutingTestCase):
+    def test_absent(self):
+        assert self.build_mailer().router is None
+    
+    def test_nested(self):
+        router = self.build_mailer(domains={'example.com': dict(connections=2, rate=5)}).router
+        route = router.routes['example.com']
+        
+        assert route.connections == 2
+        assert route.bucket.rate == 5
+    
+    def test_flattened(self):
+        router = self.build_mailer(**{'domains.example.com.connections': '2', 'domains.bücher.de.rate': '1'}).router
+        
+        assert router.routes['example.com'].connections == 2
+        assert router.routes['example.com'].bucket is None
+        assert router.routes['xn--bcher-kva.de'].bucket.rate == 1
+    
+    def test_invalid(self):
+        with pytest.raises(MailConfigurationException) as exc:
+            self.build_mailer(**{'domains.example.com.connection': '2'})
+        
+        assert "'connection'" in str(exc.value)
+        
+        with pytest.raises(MailConfigurationException):
+            self.build_mailer(domains={'example.com': dict(rate='fast')})
+    
+    def test_asynchronous_manager(self):
+        pytest.importorskip('marrow.mailer.manager.aio')
+        
+        with pytest.raises(MailConfigurationException):
+            self.build_mailer('asyncio', domains={'example.com': dict(connections=1)})
+
+
+class TestFuturesManager(RoutingTestCase):
+    def test_connection_limit(self):
+        mailer = self.build_mailer(domains={'limited.com': dict(connections=2)}).start()
+        receipts = [mailer.send(domain_message(domain)) for i in range(6) for domain in ('limited.com', 'other.com')]
+        
+        assert all(receipt.result(5) for receipt in receipts)
+        mailer.stop()
+        
+        assert SlowTransport.peak['limited.com'] == 2
+        assert SlowTransport.peak['other.com'] > 2
+        
+        finished = dict((domain, max(t for t, d in SlowTransport.finished if d == domain)) for domain in ('limited.com', 'other.com'))
+        assert finished['other.com'] < finished['limited.com']  # Unaffected by the other domain's queue.
+    
+    def test_rate_limit(self):
+        mailer = self.build_mailer(domains={'limited.com': dict(rate=50, burst=1)}).start()
+        
+        receipts = [mailer.send(domain_message('limited.com')) for i in range(5)]
+        assert all(receipt.result(5) for receipt in receipts)
+        
+        first = min(t for t, d in SlowTransport.finished)
+        last = max(t for t, d in SlowTransport.finished)
+        assert last - first >= 4 / 50.0 * 0.9
+        
+        mailer.stop()
+    
+    def test_send_many(self):
+        mailer = self.build_mailer(domains={'limited.com': dict(connections=1)}).start()
+        messages = [domain_message(domain) for i in range(3) for domain in ('limited.com', 'other.com')]
+        
+        result = mailer.send_many(messages)
+        assert result.wait(5)
+        assert result.delivered == messages
+        
+        mailer.stop()
+        assert SlowTransport.peak['limited.com'] == 1
+    
+    def test_multiple_domains_do_not_block_the_queue(self):
+        holding, release = threading.Event(), threading.Event()
+        
+        class HeldTransport(SlowTransport):
+            def deliver(self, message):
+                if message.subject == "Hold.":
+                    holding.set()
+                    release.wait(5)
+                
+                return SlowTransport.deliver(self, message)
+        
+        mailer = Mailer(dict(manager=dict(use='futures', workers=10, domains={'a.com': dict(connections=2), 'b.com': dict(connections=1)}),
+                transport=dict(use=HeldTransport))).start()
+        
+        try:
+            held = mailer.send(build_message("Hold.", to='user@b.com'))
+            assert holding.wait(5)
+            
+            both = mailer.send(build_message(to=['user@a.com', 'user@b.com']))
+            later = mailer.send(domain_message('a.com'))
+            
+            assert later.result(0.5)  # Not held up by the message waiting on b.com.
+            assert not both.done()
+        
+        finally:
+            release.set()
+        
+        assert held.result(5) and both.result(5)
+        mailer.stop()
+    
+    def test_stop_drains_queue(self):
+        mailer = self.build_mailer(domains={'limited.com': dict(connections=1)}).start()
+        receipts = [mailer.send(domain_message('limited.com')) for i in range(4)]
+        mailer.stop()
+        
+        assert all(receipt.done() for receipt in receipts)
+
+
+class TestImmediateManager(RoutingTestCase):
+    def test_connection_limit(self):
+        mailer = self.build_mailer('immediate', domains={'limited.com': dict(connections=1)}).start()
+        message = domain_message('limited.com')
+        
+        assert mailer.send(message) == (message, True)  # Delivered within the calling thread, as usual.
+        assert mailer.send(domain_message('other.com'))[1] is True  # Unlimited domains are unaffected.
+        
+        result = mailer.send_many([domain_message('limited.com'), domain_message('other.com')])
+        assert result.done
+        assert len(result.delivered) == 2
+        
+        mailer.stop()
+        assert SlowTransport.peak['limited.com'] == 1
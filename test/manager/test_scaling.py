@@ -0,0 +1,132 @@
+# encoding: utf-8
+
+"""Test the elastic worker pool of the dynamic manager."""
+
+from __future__ import unicode_literals
+
+import time
+import threading
+
+from unittest import TestCase
+
+from marrow.mailer.manager.dynamic import ScalingPoolExecutor, DynamicManager
+
+
+
+def wait_for(condition, timeout=5):
+    end = time.time() + timeout
+    
+    while not condition():
+        assert time.time() < end, "Timed out."
+        time.sleep(0.005)
+
+
+def current():
+    return threading.current_thread()
+
+
+class TestScalingPoolExecutor(TestCase):
+    def test_starvation_uses_timeout(self):
+        # The divisor (here, 100) was previously passed as the starvation timeout.
+        executor = ScalingPoolExecutor(4, 100, 0.05)
+        
+        try:
+            executor.submit(current).result(5)
+            assert len(executor._threads) == 1
+            
+            wait_for(lambda: not executor._threads, 2)
+        
+        finally:
+            executor.shutdown()
+    
+    def test_minimum(self):
+        executor = ScalingPoolExecutor(4, 1, 0.01, minimum=2)
+        
+        try:
+            assert len(executor._threads) == 2  # Started eagerly.
+            
+            for job in [executor.submit(time.sleep, 0.02) for i in range(4)]:
+                job.result(5)
+            
+            time.sleep(0.1)
+            assert len(executor._threads) == 2
+        
+        finally:
+            executor.shutdown()
+        
+        assert not executor._threads
+    
+    def test_threads_reused(self):
+        executor = ScalingPoolExecutor(4, 10, 60, minimum=1)
+        
+        try:
+            threads = set(executor.submit(current).result(5) for i in range(50))
+            assert len(threads) == 1
+        
+        finally:
+            executor.shutdown()
+    
+    def test_recycle(self):
+        executor = ScalingPoolExecutor(1, 10, 60, minimum=1, recycle=5)
+        
+        try:
+            threads = set(executor.submit(current).result(5) for i in range(20))
+            assert len(threads) == 4
+        
+        finally:
+            executor.shutdown()
+    
+    def test_latency(self):
+        executor = ScalingPoolExecutor(4, 100, 60, latency=0.02)
+        
+        try:
+            gate = threading.Event()
+            blocker = executor.submit(gate.wait, 5)
+            
+            waiting = executor.submit(current)
+            assert len(executor._threads) == 1  # The queue is short, and nothing has waited.
+            
+            time.sleep(0.05)
+            executor.submit(current)  # The second job has now waited too long.
+            
+            assert waiting.result(5)
+            assert len(executor._threads) == 2
+            
+            gate.set()
+            blocker.result(5)
+        
+        finally:
+            executor.shutdown()
+    
+    def test_latency_without_activity(self):
+        executor = ScalingPoolExecutor(4, 100, 60, latency=0.05, monitor=0.025)
+        
+        try:
+            gate = threading.Event()
+            blocker = executor.submit(gate.wait, 5)
+            waiting = executor.submit(current)
+            
+            assert waiting.result(1)  # Nothing else is submitted or completed; the monitor must add the thread.
+            assert len(executor._threads) == 2
+            
+            gate.set()
+            blocker.result(5)
+        
+        finally:
+            executor.shutdown()
+
+
+class TestConfiguration(TestCase):
+    def test_manager_configuration(self):
+        manager = DynamicManager(dict(minimum=2, latency='', recycle=100), None)
+        
+        assert manager.minimum == 2
+        assert manager.latency is None
+        assert manager.recycle == 100
+        
+        manager = DynamicManager(dict(), None)
+        assert manager.latency == 1
+        assert manager.recycle is None
+        assert manager.monitor is None  # No thread polls the queue unless asked to.
+        
+        assert DynamicManager(dict(monitor='0.5'), None).monitor == 0.5
@@ -0,0 +1,165 @@
+# encoding: utf-8
+
+"""Test the durable spool delivery manager."""
+
+from __future__ import unicode_literals
+
+import os
+import pickle
+import shutil
+import tempfile
+
+import pytest
+
+from unittest import TestCase
+
+from marrow.mailer import Mailer
+from marrow.mailer.exc import MessageFailedException, DeliveryFailedException, MailConfigurationException
+from marrow.mailer.manager.spool import SpoolManager
+from marrow.mailer.testing import RecordingTransport, build_message
+
+
+
+class RefusingTransport(RecordingTransport):
+    """Refuses messages with "refused" in the subject."""
+    
+    def deliver(self, message):
+        if 'refused' in message.subject:
+            raise MessageFailedException("Refused.")
+        
+        return super(RefusingTransport, self).deliver(message)
+
+
+def spooled_message(subject="Test."):
+    return build_message(subject, plain=lambda: "Hello.")
+
+
+class SpoolTestCase(TestCase):
+    def setUp(self):
+        RefusingTransport.reset()
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'spool')
+    
+    def tearDown(self):
+        shutil.rmtree(self.root)
+    
+    def build_mailer(self, **config):
+        config.update(use='spool', path=self.path)
+        return Mailer(dict(manager=config, transport=dict(use=RefusingTransport)))
+    
+    def spooled(self, folder='new'):
+        return sorted(os.listdir(os.path.join(self.path, folder)))
+
+
+class TestConfiguration(SpoolTestCase):
+    def test_path_required(self):
+        with pytest.raises(MailConfigurationException):
+            SpoolManager(dict(), RefusingTransport)
+    
+    def test_message_pickling(self):
+        message = spooled_message()
+        message.mailer = object()
+        serialized = message.serialized
+        
+        copy = pickle.loads(pickle.dumps(message, 2))
+        
+        assert copy.mailer is None
+        assert copy.plain == "Hello."
+        assert copy.id == message.id
+        assert copy.serialized == serialized
+
+
+class TestDelivery(SpoolTestCase):
+    def test_delivery(self):
+        mailer = self.build_mailer(workers=2).start()
+        message = spooled_message()
+        
+        assert mailer.send(message).result(5) == (message, True)
+        
+        result = mailer.send_many([spooled_message("Bulk %d." % i) for i in range(20)])
+        assert result.wait(5)
+        assert len(result.delivered) == 20
+        
+        mailer.stop()
+        
+        assert len(RefusingTransport.delivered) == 21
+        assert self.spooled() == self.spooled('tmp') == []
+    
+    def test_refused_messages_are_kept(self):
+        mailer = self.build_mailer().start()
+        
+        with pytest.raises(DeliveryFailedException):
+            mailer.send(spooled_message("Please be refused.")).result(5)
+        
+        mailer.stop()
+        
+        assert self.spooled() == []
+        assert len(self.spooled('failed')) == 1
+    
+    def test_recovery(self):
+        self.build_mailer().start().stop()  # Create the spool.
+        
+        messages = [spooled_message("Recovered %d." % i) for i in range(3)]
+        
+        for i, message in enumerate(messages):
+            with open(os.path.join(self.path, 'new', '%d.spooled' % i), 'wb') as fh:
+                pickle.dump(message, fh, 2)
+        
+        with open(os.path.join(self.path, 'new', '9.corrupt'), 'wb') as fh:
+            fh.write(b'garbage')
+        
+        with open(os.path.join(self.path, 'tmp', 'incomplete'), 'wb') as fh:
+            fh.write(b'garbage')
+        
+        mailer = self.build_mailer().start()
+        mailer.stop()
+        
+        assert [i.subject for i in RefusingTransport.delivered] == ["Recovered 0.", "Recovered 1.", "Recovered 2."]
+        assert self.spooled() == self.spooled('tmp') == []
+        assert self.spooled('failed') == ['9.corrupt']
+    
+    def test_send_after_stop(self):
+        mailer = self.build_mailer().start()
+        manager = mailer.manager
+        mailer.stop()
+        
+        with pytest.raises(RuntimeError):
+            manager.deliver(spooled_message())
+        
+        assert self.spooled('tmp') == []
+
+
+class TestBatches(SpoolTestCase):
+    def test_failed_batch_is_not_spooled(self):
+        mailer = self.build_mailer().start()
+        messages = [spooled_message("Bulk %d." % i) for i in range(3)] + [build_message("Empty.", plain=None)]
+        
+        with pytest.raises(ValueError):  # The final message has no body, and can not be rendered.
+            mailer.send_many(messages)
+        
+        mailer.stop()
+        
+        assert self.spooled('tmp') == self.spooled() == []
+        assert RefusingTransport.delivered == []
+    
+    def test_large_batch_holds_no_descriptors(self):
+        resource = pytest.importorskip('resource')
+        
+        if not os.path.isdir('/proc/self/fd'):
+            pytest.skip("Open descriptors can not be counted on this platform.")
+        
+        mailer = self.build_mailer(sync=True).start()
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (len(os.listdir('/proc/self/fd')) + 32, hard))
+        
+        try:
+            result = mailer.send_many([spooled_message("Bulk %d." % i) for i in range(200)], batch=200)
+            assert result.wait(10)
+        
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+        
+        mailer.stop()
+        
+        assert len(result.delivered) == 200
+        assert self.spooled('tmp') == self.spooled() == []
@@ -5,7 +5,8 @@ from __future__ import unicode_literals
 
 import pytest
 
-from marrow.mailer.address import Address, AddressList, AutoConverter
+from marrow.mailer.address import Address, AddressList, CompactAddressList, AutoConverter, ValidationCache, validate, idna, punycode
+from marrow.mailer.validator import EmailValidator
 from marrow.util.compat import bytes, unicode
 
 
@@ -241,3 +242,123 @@ class TestAddressList(object):
 		self.addresses = 'foo@exámple.test'
 		encoded_address = 'foo@xn--exmple-qta.test'
 		assert self.addresses.string_addresses == [encoded_address]
+
+
+class TestCompactAddressList(object):
+	"""Test the slotted, parallel-storage CompactAddressList class."""
+	
+	def test_slots(self):
+		assert not hasattr(Address('foo@example.com'), '__dict__')
+		assert not hasattr(AddressList(), '__dict__')
+		assert not hasattr(CompactAddressList(), '__dict__')
+	
+	def test_init(self):
+		assert CompactAddressList('user1@example.com, user2@example.com') == ['user1@example.com', 'user2@example.com']
+		assert CompactAddressList(('foo', 'foo@example.com')) == [('foo', 'foo@example.com')]
+		assert CompactAddressList(AddressList('foo@example.com')) == ['foo@example.com']
+		assert AddressList(CompactAddressList('foo@example.com')) == ['foo@example.com']
+		
+		with pytest.raises(ValueError):
+			CompactAddressList(2)
+		
+		with pytest.raises(ValueError):
+			CompactAddressList('baduser.example.com')
+	
+	def test_sequence(self):
+		addresses = CompactAddressList([('User 1', 'user1@example.com')])
+		addresses.append('user2@example.com')
+		addresses.insert(0, 'user0@example.com')
+		
+		assert len(addresses) == 3
+		assert isinstance(addresses[1], Address)
+		assert addresses[1] == ('User 1', 'user1@example.com')
+		assert addresses[-1] == 'user2@example.com'
+		assert isinstance(addresses[1:], CompactAddressList)
+		assert addresses[1:] == ['User 1 <user1@example.com>', 'user2@example.com']
+		assert 'user2@example.com' in addresses
+		
+		addresses[0] = 'replaced@example.com'
+		assert addresses[0] == 'replaced@example.com'
+		
+		addresses[1:] = ['user3@example.com']
+		assert addresses == ['replaced@example.com', 'user3@example.com']
+		
+		del addresses[0]
+		assert addresses == ['user3@example.com']
+		assert addresses != []
+	
+	def test_formatting(self):
+		addresses = CompactAddressList([('User1', 'foo@exámple.test'), ('User2', 'foo@exámple.test')])
+		
+		assert bytes(addresses) == b'User1 <foo@xn--exmple-qta.test>, User2 <foo@xn--exmple-qta.test>'
+		assert unicode(addresses) == ', '.join(unicode(i) for i in AddressList([('User1', 'foo@exámple.test'), ('User2', 'foo@exámple.test')]))
+		assert addresses.string_addresses == ['foo@xn--exmple-qta.test'] * 2
+		assert addresses.addresses == CompactAddressList(['foo@exámple.test'] * 2)
+		assert repr(CompactAddressList()) == 'CompactAddressList()'
+	
+	def test_concatenation(self):
+		compact = CompactAddressList('a@example.com')
+		regular = AddressList('b@example.com')
+		
+		assert isinstance(compact + regular, CompactAddressList)
+		assert isinstance(regular + compact, CompactAddressList)
+		assert regular + compact == ['b@example.com', 'a@example.com']
+	
+	def test_message_integration(self):
+		from marrow.mailer import Message
+		
+		message = Message('author@example.com', CompactAddressList(['a@example.com', 'b@example.com']), 'Subject', plain='Body.')
+		message.bcc = 'c@example.com'
+		
+		assert isinstance(message.to, CompactAddressList)
+		assert message.recipients == ['a@example.com', 'b@example.com', 'c@example.com']
+		assert b'To: a@example.com, b@example.com' in bytes(message)
+
+
+class TestValidationCache(object):
+	def test_hits_and_misses(self):
+		cache = ValidationCache(EmailValidator(), size=2)
+		
+		assert cache('foo@example.com') == ('foo@example.com', '')
+		assert cache('foo@example.com') == ('foo@example.com', '')
+		assert (cache.hits, cache.misses) == (1, 1)
+		
+		email, err = cache('bad@@example.com')
+		assert err
+		assert len(cache) == 2
+	
+	def test_eviction(self):
+		cache = ValidationCache(EmailValidator(), size=2)
+		
+		cache('a@example.com')
+		cache('b@example.com')
+		cache('a@example.com')  # Now most recently used.
+		cache('c@example.com')  # Evicts b.
+		
+		assert len(cache) == 2
+		assert 'b@example.com' not in cache._results
+		assert 'a@example.com' in cache._results
+		
+		cache.clear()
+		assert len(cache) == 0
+		assert (cache.hits, cache.misses) == (0, 0)
+	
+	def test_shared_by_address(self):
+		hits = validate.hits
+		
+		Address('shared@example.com')
+		address = Address('shared@example.com')
+		assert address.valid
+		
+		assert validate.hits >= hits + 2
+
+	
+	def test_idna_cache(self):
+		misses = idna.misses
+		
+		assert punycode('foo@exámple.test') == 'foo@xn--exmple-qta.test'
+		assert punycode('bar@exámple.test') == 'bar@xn--exmple-qta.test'
+		assert bytes(Address('Foo', 'baz@exámple.test')) == b'Foo <baz@xn--exmple-qta.test>'
+		
+		assert idna.misses <= misses + 1
+		assert idna.hits >= 2
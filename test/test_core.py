@@ -9,7 +9,7 @@ import pytest
 from unittest import TestCase
 
 from marrow.mailer import Mailer, Delivery, Message
-from marrow.mailer.exc import MailerNotRunning
+from marrow.mailer.exc import MailerNotRunning, MailConfigurationException
 from marrow.mailer.manager.immediate import ImmediateManager
 from marrow.mailer.transport.mock import MockTransport
 
@@ -238,3 +238,120 @@ class TestMethods(TestCase):
 		assert message.author == ["alternate@example.com"]
 		assert message.to == ["recipient@example.com"]
 		assert message.subject == "Test."
+
+	def test_send_many(self):
+		interface = Mailer(dict(base_config, manager=dict(use='immediate', batch=2)))
+		messages = [Bunch(id=str(i)) for i in range(5)]
+
+		with pytest.raises(MailerNotRunning):
+			interface.send_many(messages)
+
+		interface.start()
+
+		result = interface.send_many(iter(messages))
+
+		assert len(result) == 5
+		assert result.wait()
+		assert result.delivered == messages
+		assert result.failed == []
+		assert [outcome for message, outcome, exc in result.outcomes()] == [True] * 5
+
+		failure = Bunch(id='bar', die=True)
+		result = interface.send_many([messages[0], failure, messages[1]])
+
+		assert result.delivered == [messages[0], messages[1]]
+		assert len(result.failed) == 1
+		assert result.failed[0][0] is failure
+		assert isinstance(result.failed[0][1], ZeroDivisionError)
+
+		interface.stop()
+
+	def test_send_many_futures(self):
+		for manager in ('futures', 'dynamic'):
+			interface = Mailer(dict(base_config, manager=dict(use=manager, batch=3))).start()
+			messages = [Bunch(id=str(i)) for i in range(7)]
+
+			result = interface.send_many(messages)
+
+			assert result.wait(5)
+			assert result.delivered == messages
+
+			interface.stop()
+	
+	def test_split(self):
+		delivered = []
+		
+		class RecordingTransport(MockTransport):
+			def deliver(self, message):
+				delivered.append(message.recipients.string_addresses)
+				return True
+		
+		message = Message('author@example.com', ['a@example.com', 'b@example.org', 'c@example.com'], 'Test.', plain='Hello.')
+		
+		single = Message('author@example.com', 'd@example.com', 'Test.', plain='Hello.')
+		
+		interface = Mailer(dict(manager=dict(use='futures', split=True), transport=dict(use=RecordingTransport))).start()
+		
+		assert interface.send(message).result(5) == (message, [True, True])
+		assert interface.send(single).result(5) == (single, True)
+		assert sorted(delivered) == [['a@example.com', 'c@example.com'], ['b@example.org'], ['d@example.com']]
+		
+		del delivered[:]
+		result = interface.send_many([message, single])
+		
+		assert result.wait(5)
+		assert result.delivered == [message, single]
+		assert [outcome for sent, outcome, exc in result.outcomes()] == [[True, True], True]
+		assert len(delivered) == 3
+		
+		interface.stop()
+		
+		interface = Mailer(dict(manager=dict(use='immediate', split=True), transport=dict(use=RecordingTransport))).start()
+		assert interface.send(message) == (message, [True, True])
+		assert interface.send(single) == (single, True)
+		interface.stop()
+		
+		class PartialTransport(RecordingTransport):
+			def deliver(self, message):
+				if 'b@example.org' in message.recipients.string_addresses:
+					raise ZeroDivisionError()
+				
+				return super(PartialTransport, self).deliver(message)
+		
+		del delivered[:]
+		interface = Mailer(dict(manager=dict(use='futures', split=True), transport=dict(use=PartialTransport))).start()
+		
+		self.assertRaises(ZeroDivisionError, interface.send(message).result, 5)
+		assert delivered == [['a@example.com', 'c@example.com']]  # The other domain was still delivered.
+		
+		interface.stop()
+		
+		interface = Mailer(dict(manager=dict(use='immediate'), transport=dict(use=RecordingTransport))).start()
+		assert interface.send(message) == (message, True)  # Disabled by default.
+		interface.stop()
+	
+	def test_render_on_submit(self):
+		class RecordingManager(object):
+			def __init__(self, config, transport):
+				self.rendered = []
+			
+			def startup(self):
+				pass
+			
+			def deliver(self, message):
+				self.rendered.append(message._serialized is not None)
+			
+			def shutdown(self):
+				pass
+		
+		def message():
+			return Message('author@example.com', 'recipient@example.com', 'Test.', plain='Hello.')
+		
+		interface = Mailer(dict(manager=dict(use=RecordingManager, render='submit'), transport=dict(use='mock'))).start()
+		interface.send(message())
+		interface.send_many([message(), message()])
+		
+		self.assertEqual(interface.manager.rendered, [True, True, True])
+		
+		self.assertRaises(MailConfigurationException, Mailer, dict(manager=dict(render='eventually'), transport=dict(use='mock')))
+
@@ -70,6 +70,26 @@ class TestBasicMessage(TestCase):
 		
 		assert msg.id == id_
 	
+	def test_message_id_resolves_domain_once(self):
+		import socket
+		from marrow.mailer import message as module
+		
+		lookups = []
+		original, domain = socket.getfqdn, list(module._domain)
+		socket.getfqdn = lambda: lookups.append(None) or 'mail.example.com'
+		del module._domain[:]
+		
+		try:
+			ids = set(self.build_message().id for i in range(3))
+		
+		finally:
+			socket.getfqdn = original
+			module._domain[:] = domain
+		
+		assert len(ids) == 3
+		assert len(lookups) == 1
+		assert all(id_.endswith('@mail.example.com>') for id_ in ids)
+	
 	def test_missing_author(self):
 		message = self.build_message()
 		message.author = []
@@ -441,3 +461,130 @@ class TestBasicMessage(TestCase):
 		assert 'plain text' in unicode(message)
 		assert 'rich text' in unicode(message)
 
+	
+	def test_serialized_is_cached(self):
+		message = self.build_message()
+		
+		result = message.serialized
+		assert isinstance(result, bytes)
+		assert message.serialized is result
+		assert bytes(message) is result
+		assert unicode(message) == result.decode('ascii')
+		
+		message.subject = "Changed subject."
+		assert message.serialized is not result
+		assert b'Changed subject.' in message.serialized
+	
+	def test_serialized_invalidated_by_mime_rebuild(self):
+		message = self.build_message()
+		result = message.serialized
+		
+		message.plain = "Updated body."
+		message.mime  # Rebuilding the tree directly must not leave stale bytes behind.
+		
+		assert b'Updated body.' in message.serialized
+		assert message.serialized is not result
+	
+	def test_split_single_domain(self):
+		message = self.build_message()
+		message.cc = 'other@example.com'
+		
+		assert message.split() == [message]
+	
+	def test_split_by_domain(self):
+		message = self.build_message()
+		message.to = ['one@example.com', 'one@example.org', 'two@Example.com']
+		message.bcc = 'hidden@example.net'
+		
+		parts = message.split()
+		
+		assert [part.recipients.addresses for part in parts] == [
+				['one@example.com', 'two@Example.com'],
+				['one@example.org'],
+				['hidden@example.net']
+			]
+		
+		assert all(part.serialized is message.serialized for part in parts)
+		assert all(part.id == message.id for part in parts)
+		assert message.recipients.addresses == ['one@example.com', 'one@example.org', 'two@Example.com', 'hidden@example.net']
+	
+	def test_streamed_attachment(self):
+		import os, tempfile
+		
+		content = os.urandom(10000) + b'\n.\n'
+		
+		with tempfile.NamedTemporaryFile(mode='wb', suffix='.bin') as fh:
+			fh.write(content)
+			fh.flush()
+			
+			message = self.build_message()
+			message.attach(fh.name, stream=True)
+			part = message.attachments[0]
+			
+			assert part.source.size == len(content)
+			assert len(part.get_payload()) < 64  # Only a placeholder is held.
+			
+			chunks = list(message.stream(1000))
+			assert all(chunk.endswith(b'\n') for chunk in chunks)
+			assert len(chunks) > 10
+			
+			serialized = b''.join(chunks)
+			assert message.serialized == serialized
+			assert message.size == len(serialized)
+			
+			parsed = email.message_from_string(serialized.decode('ascii'))
+			attachment = parsed.get_payload()[1]
+			
+			assert attachment.get_filename() == os.path.basename(fh.name)
+			assert attachment.get_payload(decode=True) == content
+			assert attachment.get_payload() == base64.encodestring(content).decode('ascii')
+	
+	def test_streamed_attachment_shares_file(self):
+		import pickle, tempfile
+		
+		with tempfile.NamedTemporaryFile(mode='wb') as fh:
+			fh.write(b"foo")
+			fh.flush()
+			
+			message = self.build_message()
+			message.attach(fh.name, stream=True)
+			other = self.build_message()
+			other.attach(fh.name, stream=True)
+			
+			assert other.attachments[0].source is message.attachments[0].source
+			
+			serialized = message.serialized
+			copy = pickle.loads(pickle.dumps(message))
+			
+			assert copy.attachments[0].source is message.attachments[0].source
+			assert copy.serialized == serialized
+			assert b'Zm9v' in copy.serialized
+	
+	def test_attachment_encoded_on_render(self):
+		import os, pickle
+		
+		content = os.urandom(30000)
+		
+		message = self.build_message()
+		message.attach('random.bin', content)
+		part = message.attachments[0]
+		
+		assert part.content is content  # Held raw until rendered...
+		assert len(pickle.dumps(message, -1)) < len(content) * 1.1  # ...and pickled as such.
+		
+		copy = pickle.loads(pickle.dumps(message, -1))
+		
+		for rendered in (message, copy):
+			parsed = email.message_from_string(rendered.serialized.decode('ascii'))
+			attachment = parsed.get_payload()[1]
+			
+			assert attachment.get_payload(decode=True) == content
+			assert attachment.get_payload() == base64.encodestring(content).decode('ascii')
+		
+		assert part.content is None  # Only the encoded form is retained.
+	
+	def test_streamed_attachment_requires_file(self):
+		message = self.build_message()
+		
+		with pytest.raises(TypeError):
+			message.attach('foo.txt', b"foo", stream=True)
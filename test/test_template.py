@@ -0,0 +1,112 @@
+# encoding: utf-8
+"""Test the mail-merge MessageTemplate class."""
+
+from __future__ import unicode_literals
+
+import email
+import pytest
+
+from marrow.mailer import Message, MessageTemplate
+
+
+class TestMessageTemplate(object):
+	def build_template(self, **kw):
+		return MessageTemplate(
+					author=('Author', 'author@example.com'),
+					subject='Test message subject.',
+					plain='Hello $name, this is a test message plain text body.',
+					**kw
+				)
+	
+	def equivalent(self, message):
+		"""Render the same message the slow way and compare the parsed results."""
+		
+		rendered = email.message_from_bytes(message.serialized)
+		
+		message._dirty = True
+		expected = email.message_from_bytes(message.serialized)
+		
+		parts = list(zip(rendered.walk(), expected.walk()))
+		assert len(parts) == len(list(expected.walk()))
+		
+		for a, b in parts:
+			assert a.get_content_type() == b.get_content_type()
+			
+			if a.is_multipart():  # Boundaries are generated randomly.
+				assert [i for i in a.items() if i[0] != 'Content-Type'] == [i for i in b.items() if i[0] != 'Content-Type']
+				continue
+			
+			assert a.items() == b.items()
+			assert a.get_payload(decode=True) == b.get_payload(decode=True)
+	
+	def test_plain(self):
+		template = self.build_template()
+		message = template.render(('Bob Dole', 'bob@example.com'), name="Bob")
+		
+		assert isinstance(message, Message)
+		assert message.to == [('Bob Dole', 'bob@example.com')]
+		assert message.plain == 'Hello Bob, this is a test message plain text body.'
+		assert b'To: Bob Dole <bob@example.com>\n' in message.serialized
+		assert b'Hello Bob,' in message.serialized
+		
+		self.equivalent(message)
+	
+	def test_rich_with_attachments(self):
+		template = self.build_template(rich='<p>Hello $name, über alles.</p>')
+		template.attach('hello.txt', b'Fnord.')
+		
+		first = template.render('first@example.com', name='Fïrst')
+		second = template.render('second@example.com', name='Second')
+		
+		assert b'Rm5vcmQu' in first.serialized
+		assert b'second@example.com' in second.serialized
+		assert b'first@example.com' not in second.serialized
+		
+		self.equivalent(first)
+		self.equivalent(second)
+	
+	def test_streamed_attachments(self, tmpdir):
+		path = tmpdir.join('hello.txt')
+		path.write_binary(b'Fnord.')
+		
+		template = self.build_template()
+		template.attach(str(path), stream=True)
+		
+		message = template.render('first@example.com', name='First')
+		
+		assert len(message.segments) == 3
+		assert message.segments[1] is template.attachments[0]
+		assert b'Rm5vcmQu' in message.serialized
+		
+		self.equivalent(message)
+	
+	def test_instances_are_independent(self):
+		template = self.build_template(cc='cc@example.com')
+		message = template.render('bob@example.com', name='Bob')
+		
+		message.cc.append('other@example.com')
+		assert template.cc == ['cc@example.com']
+		
+		message.subject = "Changed."
+		assert b'Subject: Changed.' in message.serialized
+	
+	def test_template_changes_discard_skeleton(self):
+		template = self.build_template()
+		template.render('bob@example.com', name='Bob')
+		
+		template.subject = "Another subject."
+		message = template.render('bob@example.com', name='Bob')
+		
+		assert b'Subject: Another subject.' in message.serialized
+	
+	def test_failures(self):
+		template = self.build_template()
+		
+		with pytest.raises(KeyError):
+			template.render('bob@example.com')
+		
+		with pytest.raises(ValueError):
+			template.render([], name='Bob')
+		
+		with pytest.raises(ValueError):
+			MessageTemplate(author='author@example.com', plain='Body.').render('bob@example.com')
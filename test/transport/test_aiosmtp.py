@@ -0,0 +1,172 @@
+# encoding: utf-8
+
+from __future__ import unicode_literals
+
+import pytest
+
+asyncio = pytest.importorskip('asyncio')
+aiosmtp = pytest.importorskip('marrow.mailer.transport.aiosmtp')  # Requires Python 3.5 syntax.
+
+from marrow.mailer import Mailer, Message
+from smtplib import SMTPResponseException, SMTPSenderRefused
+
+from marrow.mailer.exc import MessageFailedException, TransportException, TransportExhaustedException, TransportFailedException
+from marrow.mailer.testing import DebuggingSMTPServer
+
+from test.transport.test_smtp_esmtp import ExtendedServer
+from test.transport.test_tls import TLSServer
+
+
+@pytest.fixture(scope='module', params=[DebuggingSMTPServer, ExtendedServer], ids=['lockstep', 'pipelined'])
+def server(request):
+	server = request.param(port=0)
+	server.start()
+	request.addfinalizer(server.stop)
+	return server
+
+
+@pytest.fixture
+def loop(server):
+	server.drain()
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+	yield loop
+	loop.close()
+	asyncio.set_event_loop(None)
+
+
+@pytest.fixture
+def transport(server, loop):
+	transport = aiosmtp.AsyncSMTPTransport(dict(host=server.address[0], port=server.address[1], tls=False, pipeline=100))
+	loop.run_until_complete(transport.startup())
+	yield transport
+	loop.run_until_complete(transport.shutdown())
+
+
+def build_message(to):
+	return Message(author='author@example.com', to=to, subject='Test.', plain='Hello.\n.Dotted line.')
+
+
+def test_extensions(server, transport):
+	assert ('pipelining' in transport.extensions) is isinstance(server, ExtendedServer)
+
+
+def test_delivery(server, loop, transport):
+	recipients = ['user%d@example.com' % i for i in range(3)]
+	
+	assert loop.run_until_complete(transport.deliver(build_message(recipients))) == {}
+	
+	message = server.next()
+	assert message.recipients == recipients
+	assert message.message.get_payload().endswith('.Dotted line.')
+
+
+def test_total_refusal(server, loop, transport):
+	if not isinstance(server, ExtendedServer):
+		pytest.skip("Recipient refusal requires the extended server.")
+	
+	with pytest.raises(MessageFailedException):
+		loop.run_until_complete(transport.deliver(build_message(['refused@example.com'])))
+	
+	result = loop.run_until_complete(transport.deliver(build_message(['user@example.com', 'refused@example.com'])))
+	assert list(result) == ['refused@example.com']
+	assert server.next().recipients == ['user@example.com']
+
+
+def test_refused_after_data(server, loop, transport):
+	if not isinstance(server, ExtendedServer):
+		pytest.skip("Content refusal requires the extended server.")
+	
+	recipients = ['user1@example.com', 'user2@example.com']
+	message = Message(author='author@example.com', to=recipients, subject='Test.', plain='Overloaded.')
+	result = loop.run_until_complete(transport.deliver(message))
+	
+	assert sorted(result.deferred) == recipients
+	assert result['user1@example.com'] == (451, b'Try again later')
+	
+	with pytest.raises(MessageFailedException):
+		message = Message(author='author@example.com', to=recipients, subject='Test.', plain='Spam.')
+		loop.run_until_complete(transport.deliver(message))
+	
+	assert len(server) == 0
+
+
+@pytest.mark.parametrize('error, expected', [
+		(SMTPSenderRefused(451, b'Local error.', 'author@example.com'), TransportFailedException),
+		(SMTPSenderRefused(550, b'No.', 'author@example.com'), MessageFailedException),
+		(SMTPResponseException(452, b'Insufficient storage.'), TransportFailedException),
+		(SMTPResponseException(554, b'Transaction failed.'), MessageFailedException),
+	])
+def test_reply_classes(monkeypatch, loop, transport, error, expected):
+	async def transaction(self, *args):
+		raise error
+	
+	monkeypatch.setattr(aiosmtp.AsyncSMTPTransport, 'transaction', transaction)
+	
+	with pytest.raises(expected):
+		loop.run_until_complete(transport.deliver(build_message(['user@example.com'])))
+
+
+def test_exhaustion(server, loop, transport):
+	transport.pipeline = 1
+	
+	with pytest.raises(TransportExhaustedException):
+		loop.run_until_complete(transport.deliver(build_message(['user@example.com'])))
+	
+	assert len(server) == 1
+
+
+def test_manager(server, loop):
+	mailer = Mailer(dict(
+			manager = dict(use='asyncio', concurrency=5),
+			transport = dict(use='aiosmtp', host=server.address[0], port=server.address[1], tls=False, pipeline=10)
+		)).start()
+	
+	async def main():
+		return await asyncio.gather(*[mailer.deliver(build_message(['user%d@example.com' % i])) for i in range(20)])
+	
+	assert len(loop.run_until_complete(main())) == 20
+	mailer.stop()
+	
+	assert sorted(message.recipients[0] for message in server) == sorted('user%d@example.com' % i for i in range(20))
+
+
+def test_split_delivery(server, loop):
+	mailer = Mailer(dict(
+			manager = dict(use='asyncio', split=True),
+			transport = dict(use='aiosmtp', host=server.address[0], port=server.address[1], tls=False)
+		)).start()
+	
+	message = build_message(['user@example.com', 'user@example.org'])
+	
+	async def main():
+		return await mailer.deliver(message)
+	
+	delivered, result = loop.run_until_complete(main())
+	mailer.stop()
+	
+	assert delivered is message
+	assert sorted(result.accepted) == ['user@example.com', 'user@example.org']
+	assert sorted(message.recipients[0] for message in server) == ['user@example.com', 'user@example.org']
+
+
+def test_starttls_unsupported():
+	if hasattr(asyncio.StreamWriter, 'start_tls'):
+		pytest.skip("Streams may be upgraded to TLS from Python 3.11.")
+	
+	server = TLSServer(None, False)
+	server.start()
+	loop = asyncio.new_event_loop()
+	
+	transport = aiosmtp.AsyncSMTPTransport(dict(host='127.0.0.1', port=server.port, tls='optional', username='user', password='secret'))
+	
+	try:
+		with pytest.raises(TransportException):
+			loop.run_until_complete(transport.startup())
+	
+	finally:
+		loop.close()
+		server.stop()
+	
+	assert not transport.connected
+	assert not any(command.startswith(b'AUTH') for command in server.commands)  # Never sent in the clear.
@@ -0,0 +1,184 @@
+# encoding: utf-8
+
+"""Test direct-to-MX delivery using a stub resolver and a local capturing server."""
+
+from __future__ import unicode_literals
+
+import pytest
+
+from marrow.mailer import Message
+from marrow.mailer.exc import MessageFailedException, TransportFailedException, RecipientsDeferredException
+from marrow.mailer.manager.util import settle
+from marrow.mailer.testing import DebuggingSMTPServer
+from marrow.mailer.transport.mx import MXCache, MXTransport
+from marrow.mailer.transport.smtp import SMTPTransport
+
+
+RECORDS = {
+		'example.com': [(10, 'localhost.'), (5, '127.0.0.2.')],  # The preferred exchanger is unreachable.
+		'example.org': [(10, '127.0.0.1.')],
+		'localhost': [],  # No MX records; the domain itself is used.
+		'example.edu': [(0, '.')],  # Null MX.
+		'broken.example': None,
+	}
+
+lookups = []
+
+
+def resolver(domain):
+	lookups.append(domain)
+	records = RECORDS[domain]
+	
+	if records is None:
+		raise IOError("SERVFAIL")
+	
+	return 60, records
+
+
+@pytest.fixture(scope='module')
+def server(request):
+	server = DebuggingSMTPServer(port=0)
+	server.start()
+	request.addfinalizer(server.stop)
+	return server
+
+
+@pytest.fixture
+def transport(server):
+	server.drain()
+	del lookups[:]
+	
+	transport = MXTransport(dict(resolver=resolver, port=server.address[1], tls=False))
+	transport.cache.clear()
+	transport.startup()
+	
+	yield transport
+	
+	transport.shutdown()
+
+
+def build_message(to):
+	return Message(author='author@example.com', to=to, subject='Test.', plain='Hello.')
+
+
+def test_cache_ttl():
+	clock = [0]
+	cache = MXCache(lambda domain: (clock[0] or 30, [(20, 'b.example.'), (10, 'a.example.')]), size=2)
+	
+	assert cache('example.com') == ['a.example', 'b.example']
+	assert cache('example.org') and cache('example.net')
+	assert len(cache) == 2  # The least recently resolved domain was evicted.
+	
+	cache.entries['example.org'] = (0, cache.entries['example.org'][1])  # Expired.
+	cache('example.com')
+	assert list(cache.entries) == ['example.net', 'example.com']
+
+
+def test_preference_fallback(server, transport):
+	assert transport.deliver(build_message(['one@example.com', 'two@example.com'])) == {}
+	
+	message = server.next()
+	assert message.recipients == ['one@example.com', 'two@example.com']
+	assert list(transport.connections) == ['localhost']
+
+
+def test_per_domain_delivery(server, transport):
+	transport.deliver(build_message(['one@example.com', 'two@example.org', 'three@localhost', 'four@example.com']))
+	transport.deliver(build_message(['five@example.org']))
+	
+	assert len(server) == 4
+	assert sorted(server.next().recipients for i in range(4)) == [
+			['five@example.org'],
+			['one@example.com', 'four@example.com'],
+			['three@localhost'],
+			['two@example.org']
+		]
+	
+	assert sorted(lookups) == ['example.com', 'example.org', 'localhost']  # Cached.
+	assert sorted(transport.connections) == ['127.0.0.1', 'localhost']
+
+
+def test_connection_reuse(server, transport):
+	transport.deliver(build_message(['one@example.org']))
+	connection = transport.connections['127.0.0.1']
+	transport.deliver(build_message(['two@example.org']))
+	
+	assert transport.connections['127.0.0.1'] is connection
+	assert connection.sent == 2  # Both delivered across a single connection.
+
+
+def test_connection_pipeline_limit(server):
+	transport = MXTransport(dict(resolver=resolver, port=server.address[1], tls=False, pipeline=2))
+	transport.cache.clear()
+	
+	transport.deliver(build_message(['one@example.org']))
+	assert '127.0.0.1' in transport.connections
+	
+	transport.deliver(build_message(['two@example.org']))
+	assert '127.0.0.1' not in transport.connections
+	
+	transport.shutdown()
+
+
+def test_connection_idle_limit(server):
+	transport = MXTransport(dict(resolver=resolver, port=server.address[1], tls=False, idle=60))
+	transport.cache.clear()
+	
+	transport.deliver(build_message(['one@example.org']))
+	connection = transport.connections['127.0.0.1']
+	
+	created, used = transport.used['127.0.0.1']
+	transport.used['127.0.0.1'] = (created, used - 60)  # Unused for a minute.
+	transport.alive()
+	
+	assert not transport.connections
+	assert not connection.connected
+	
+	transport.deliver(build_message(['two@example.org']))
+	assert transport.connections['127.0.0.1'] is not connection
+	
+	transport.shutdown()
+
+
+def test_null_mx(server, transport):
+	with pytest.raises(MessageFailedException):
+		transport.deliver(build_message(['user@example.edu']))
+	
+	refused = transport.deliver(build_message(['user@example.edu', 'user@example.org']))
+	assert list(refused) == ['user@example.edu']
+	assert server.next().recipients == ['user@example.org']
+
+
+def test_partial_failure(server, transport):
+	message = build_message(['one@example.org', 'two@broken.example'])
+	result = transport.deliver(message)
+	
+	assert server.next().recipients == ['one@example.org']
+	assert list(result.deferred) == ['two@broken.example']
+	assert len(message.recipients) == 2  # Settling the result is left to the manager.
+	
+	with pytest.raises(RecipientsDeferredException):
+		settle(message, result)
+	
+	assert message.recipients.string_addresses == ['two@broken.example']  # Only these will be retried.
+
+
+def test_swallowed_failure(server, transport, monkeypatch):
+	send = SMTPTransport.send_with_smtp
+	
+	def flaky(self, message):
+		if 'two@example.com' in message.recipients.string_addresses:
+			return None  # As when a failure is logged and the message deferred.
+		
+		return send(self, message)
+	
+	monkeypatch.setattr(SMTPTransport, 'send_with_smtp', flaky)
+	message = build_message(['one@example.org', 'two@example.com'])
+	result = transport.deliver(message)
+	
+	assert server.next().recipients == ['one@example.org']
+	assert list(result.deferred) == ['two@example.com']  # Not mistaken for a successful delivery.
+	assert 'localhost' not in transport.connections
+	
+	with pytest.raises(TransportFailedException):
+		transport.deliver(build_message(['two@example.com']))
@@ -0,0 +1,301 @@
+# encoding: utf-8
+
+"""Test the ESMTP extensions used by the SMTP transport against a local capturing server."""
+
+from __future__ import unicode_literals
+
+import pytest
+
+smtpd = pytest.importorskip('smtpd')
+
+from marrow.mailer import Message
+from marrow.mailer.exc import MessageFailedException, TransportFailedException
+from marrow.mailer.testing import DebuggingSMTPServer
+from marrow.mailer.transport.smtp import SMTPTransport, quote_data
+
+
+class ExtendedChannel(smtpd.SMTPChannel):
+	"""An SMTP channel advertising additional extensions, accepting RFC 3030 BDAT chunks, and refusing
+	some senders and recipients."""
+	
+	chunk = None
+	
+	def smtp_MAIL(self, arg):
+		if arg and 'refused' in arg:
+			self.push('550 Sender rejected')
+			return
+		
+		if arg and 'busy' in arg:
+			self.push('451 Local error in processing')
+			return
+		
+		smtpd.SMTPChannel.smtp_MAIL(self, arg)
+	
+	def push(self, msg):
+		if msg == '250 HELP':  # The final line of the EHLO response.
+			for extension in self.smtp_server.extensions:
+				smtpd.SMTPChannel.push(self, '250-' + extension)
+		
+		smtpd.SMTPChannel.push(self, msg)
+	
+	def smtp_RCPT(self, arg):
+		if arg and 'refused' in arg:
+			self.push('550 No such user here')
+			return
+		
+		if arg and 'busy' in arg:
+			self.push('450 Mailbox busy')
+			return
+		
+		smtpd.SMTPChannel.smtp_RCPT(self, arg)
+	
+	def smtp_BDAT(self, arg):
+		size, _, last = arg.partition(' ')
+		self.chunk = (int(size), last.upper() == 'LAST')
+		self.chunks = getattr(self, 'chunks', [])
+		self.smtp_state = self.DATA
+		
+		if self.chunk[0]:
+			self.set_terminator(self.chunk[0])
+		else:
+			self.found_terminator()
+	
+	def found_terminator(self):
+		if self.chunk is None:
+			return smtpd.SMTPChannel.found_terminator(self)
+		
+		self.chunks.extend(self.received_lines)
+		self.received_lines = []
+		last, self.chunk = self.chunk[1], None
+		
+		if not last:
+			self.smtp_state, self.num_bytes = self.COMMAND, 0
+			self.set_terminator(b'\r\n')
+			self.push('250 Chunk accepted')
+			return
+		
+		data, self.chunks = b''.join(self.chunks).replace(b'\r\n', b'\n'), []
+		self.smtp_server.process_message(self.peer, self.mailfrom, self.rcpttos, data)
+		self._set_post_data_state()
+		self.push('250 OK')
+
+
+class ExtendedServer(DebuggingSMTPServer):
+	channel_class = ExtendedChannel
+	extensions = ('PIPELINING', )
+	
+	def process_message(self, peer, sender, recipients, data, **options):
+		# Refuse messages, rather than recipients, after their content has been received.
+		if b'Overloaded.' in data:
+			return '451 Try again later'
+		
+		if b'Spam.' in data:
+			return '554 Message rejected'
+		
+		return DebuggingSMTPServer.process_message(self, peer, sender, recipients, data, **options)
+
+
+@pytest.fixture(scope='module')
+def server(request):
+	server = ExtendedServer(port=0)
+	server.start()
+	request.addfinalizer(server.stop)
+	return server
+
+
+@pytest.fixture
+def chunking(server):
+	server.extensions = ('PIPELINING', 'CHUNKING')
+	yield server
+	del server.extensions
+
+
+def connect(server, **options):
+	server.drain()
+	
+	transport = SMTPTransport(dict(host=server.address[0], port=server.address[1], tls=False, pipeline=100, **options))
+	transport.startup()
+	
+	sends = transport.connection.sends = []
+	send = transport.connection.send
+	transport.connection.send = lambda data: sends.append(data) or send(data)
+	
+	return transport
+
+
+@pytest.fixture
+def transport(server):
+	transport = connect(server)
+	yield transport
+	transport.shutdown()
+
+
+def build_message(to, **kw):
+	return Message(author='author@example.com', to=to, subject='Test.', plain='Hello.\n.Dotted line.', **kw)
+
+
+def test_quote_data():
+	assert quote_data(b'a\n.b\r\nc') == b'a\r\n..b\r\nc\r\n.\r\n'
+	assert quote_data(b'a\r\n') == b'a\r\n.\r\n'
+
+
+def test_pipelined_delivery(server, transport):
+	recipients = ['user%d@example.com' % i for i in range(5)]
+	
+	assert transport.connection.has_extn('pipelining')
+	assert transport.deliver(build_message(recipients)) == {}
+	assert len(transport.connection.sends) == 2  # Envelope and content.
+	
+	message = server.next()
+	assert message.recipients == recipients
+	assert message.message.get_payload().endswith('.Dotted line.')
+
+
+def test_pipelined_partial_refusal(server, transport):
+	result = transport.deliver(build_message(['user@example.com', 'refused@example.com']))
+	
+	assert list(result) == ['refused@example.com']
+	assert result['refused@example.com'][0] == 550
+	assert server.next().recipients == ['user@example.com']
+
+
+@pytest.mark.parametrize('pipelining', [True, False])
+def test_recipient_outcomes(server, transport, pipelining):
+	if not pipelining:
+		transport.connection.esmtp_features.pop('pipelining')
+	
+	result = transport.deliver(build_message(['user@example.com', 'busy@example.com', 'refused@example.com']))
+	
+	assert list(result.accepted) == ['user@example.com']
+	assert result.accepted['user@example.com'][0] == 250
+	assert list(result.deferred) == ['busy@example.com']
+	assert list(result.rejected) == ['refused@example.com']
+	assert server.next().recipients == ['user@example.com']
+	
+	result = transport.deliver(build_message(['busy@example.com']))  # Not a permanent failure.
+	assert result == {'busy@example.com': (450, b'Mailbox busy')}
+	assert len(server) == 0
+
+
+@pytest.mark.parametrize('pipelining', [True, False])
+def test_message_refused_after_data(server, transport, pipelining):
+	if not pipelining:
+		transport.connection.esmtp_features.pop('pipelining')
+	
+	recipients = ['user1@example.com', 'user2@example.com']
+	result = transport.deliver(Message(author='author@example.com', to=recipients, subject='Test.', plain='Overloaded.'))
+	
+	assert sorted(result.deferred) == recipients  # Retried, rather than reported as delivered.
+	assert not result.accepted
+	assert result['user1@example.com'] == (451, b'Try again later')
+	
+	with pytest.raises(MessageFailedException):
+		transport.deliver(Message(author='author@example.com', to=recipients, subject='Test.', plain='Spam.'))
+	
+	assert len(server) == 0
+	
+	transport.deliver(build_message(['user@example.com']))  # The connection remains usable.
+	assert len(server) == 1
+
+
+@pytest.mark.parametrize('pipelining', [True, False])
+def test_sender_refused(server, transport, pipelining):
+	if not pipelining:
+		transport.connection.esmtp_features.pop('pipelining')
+	
+	with pytest.raises(TransportFailedException):  # Temporarily; retried.
+		transport.deliver(Message(author='busy@example.com', to='user@example.com', subject='Test.', plain='Hello.'))
+	
+	with pytest.raises(MessageFailedException):
+		transport.deliver(Message(author='refused@example.com', to='user@example.com', subject='Test.', plain='Hello.'))
+	
+	assert len(server) == 0
+
+
+def test_pipelined_total_refusal(server, transport):
+	with pytest.raises(MessageFailedException):
+		transport.deliver(build_message(['refused@example.com']))
+	
+	assert len(server) == 0
+	
+	transport.deliver(build_message(['user@example.com']))  # The connection remains usable.
+	assert len(server) == 1
+
+
+def test_lockstep_fallback(server, transport):
+	transport.connection.esmtp_features.pop('pipelining')
+	transport.deliver(build_message(['user1@example.com', 'user2@example.com']))
+	
+	assert len(transport.connection.sends) == 5
+	assert server.next().recipients == ['user1@example.com', 'user2@example.com']
+
+
+@pytest.mark.parametrize('pipelining', [True, False])
+def test_streamed_attachment(server, transport, tmpdir, pipelining):
+	path = tmpdir.join('report.txt')
+	path.write(''.join('.Line %d of the report.\n' % i for i in range(20000)))
+	
+	if not pipelining:
+		transport.connection.esmtp_features.pop('pipelining')
+	
+	message = build_message(['user@example.com'])
+	message.attach(str(path), stream=True)
+	
+	assert transport.deliver(message) == {}
+	assert len(transport.connection.sends) > 4  # Written in chunks.
+	
+	received = server.next().message.get_payload()[1]
+	assert received.get_payload(decode=True) == path.read_binary()
+
+
+@pytest.mark.parametrize('pipelining', [True, False])
+def test_chunked_delivery(chunking, pipelining):
+	transport = connect(chunking, chunking=64)
+	
+	if not pipelining:
+		transport.connection.esmtp_features.pop('pipelining')
+	
+	message = build_message(['user1@example.com', 'user2@example.com'])
+	sends = transport.connection.sends
+	
+	try:
+		assert transport.deliver(message) == {}
+		assert transport.deliver(message) == {}  # The connection remains usable.
+	
+	finally:
+		transport.shutdown()
+	
+	sends = [data for data in sends if isinstance(data, bytes) and data.startswith(b'BDAT')]
+	assert len(sends) > 4
+	assert sends[-1].startswith(b'BDAT %d LAST\r\n' % (len(sends[-1]) - sends[-1].index(b'\n') - 1))
+	assert not any(b'\r\n..' in data for data in sends)  # Not dot-stuffed.
+	
+	for i in range(2):
+		received = chunking.next()
+		assert received.recipients == ['user1@example.com', 'user2@example.com']
+		assert received.message.get_payload().endswith('.Dotted line.')
+
+
+def test_chunked_streamed_attachment(chunking, tmpdir):
+	path = tmpdir.join('report.txt')
+	path.write(''.join('.Line %d of the report.\n' % i for i in range(20000)))
+	
+	transport = connect(chunking)
+	message = build_message(['user@example.com'])
+	message.attach(str(path), stream=True)
+	
+	try:
+		assert transport.deliver(message) == {}
+	
+	finally:
+		transport.shutdown()
+	
+	received = chunking.next().message.get_payload()[1]
+	assert received.get_payload(decode=True) == path.read_binary()
+
+
+def test_alive(server, transport):
+	assert transport.alive()
+	
+	transport.shutdown()
+	assert not transport.alive()
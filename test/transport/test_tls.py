@@ -0,0 +1,165 @@
+# encoding: utf-8
+
+"""Test the shared TLS context and session resumption of the SMTP transport against a minimal local server."""
+
+from __future__ import unicode_literals
+
+import os
+import ssl
+import socket
+import threading
+import subprocess
+
+from collections import OrderedDict
+
+import pytest
+
+from marrow.mailer.transport import tls
+from marrow.mailer.transport.smtp import SMTPTransport
+
+
+class TLSServer(threading.Thread):
+	"""Answers just enough SMTP to greet, negotiate TLS, and part ways, one connection at a time."""
+
+	def __init__(self, context, implicit):
+		super(TLSServer, self).__init__()
+		self.daemon = True
+		self.context = context
+		self.implicit = implicit
+		self.listener = socket.socket()
+		self.listener.bind(('127.0.0.1', 0))
+		self.listener.listen(5)
+		self.port = self.listener.getsockname()[1]
+		self.commands = []
+
+	def run(self):
+		while True:
+			try:
+				sock, peer = self.listener.accept()
+			except socket.error:
+				return
+
+			try:
+				self.converse(sock)
+			except (socket.error, ssl.SSLError):
+				pass
+			finally:
+				sock.close()
+
+	def converse(self, sock):
+		if self.implicit:
+			sock = self.context.wrap_socket(sock, server_side=True)
+
+		secure = self.implicit
+		reader = sock.makefile('rb')
+		sock.sendall(b'220 localhost ESMTP\r\n')
+
+		while True:
+			command = reader.readline().strip().upper()
+			self.commands.append(command)
+
+			if not command:
+				return
+
+			elif command.startswith(b'EHLO'):
+				sock.sendall(b'250-localhost\r\n250 AUTH PLAIN\r\n' if secure else b'250-localhost\r\n250-AUTH PLAIN\r\n250 STARTTLS\r\n')
+
+			elif command == b'STARTTLS':
+				sock.sendall(b'220 Ready to start TLS\r\n')
+				sock = self.context.wrap_socket(sock, server_side=True)
+				reader = sock.makefile('rb')
+				secure = True
+
+			elif command == b'QUIT':
+				sock.sendall(b'221 Bye\r\n')
+				return
+
+			else:
+				sock.sendall(b'250 OK\r\n')
+
+	def stop(self):
+		self.listener.close()
+
+
+@pytest.fixture(scope='module')
+def certificate(tmpdir_factory):
+	path = str(tmpdir_factory.mktemp('tls').join('server.pem'))
+
+	try:
+		subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+				'-subj', '/CN=localhost', '-keyout', path, '-out', path],
+				stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+	except (OSError, subprocess.CalledProcessError):
+		pytest.skip("The openssl command is required to generate a test certificate.")
+
+	return path
+
+
+@pytest.fixture(params=[False, True], ids=['starttls', 'ssl'])
+def server(request, certificate):
+	context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER if hasattr(ssl, 'PROTOCOL_TLS_SERVER') else ssl.PROTOCOL_SSLv23)
+	context.load_cert_chain(certificate)
+
+	server = TLSServer(context, request.param)
+	server.start()
+	yield server
+	server.stop()
+
+
+def test_shared_context(certificate):
+	assert tls.context() is tls.context()
+	assert tls.context(certificate) is tls.context(certificate)
+	assert tls.context(certificate) is not tls.context()
+
+
+def test_sessions_bounded(monkeypatch):
+	class Socket(object):
+		def __init__(self, session):
+			self.session = session
+	
+	monkeypatch.setattr(tls, '_sessions', OrderedDict())
+	monkeypatch.setattr(tls, 'sessions', 3)
+	
+	for port in range(5):
+		tls.remember(Socket(port), 'localhost', port)
+	
+	tls.remember(Socket('again'), 'localhost', 2)  # Refreshed, and so retained the longest.
+	tls.remember(Socket(5), 'localhost', 5)
+	
+	assert [key[1] for key in tls._sessions] == [4, 2, 5]
+	assert tls._sessions[('localhost', 2, None, None)] == 'again'
+	
+	offered = []
+	
+	class Context(object):
+		def wrap_socket(self, sock, server_hostname, session=None):
+			offered.append(session)
+			sock.session_reused = True
+			return sock  # With no new session; as with TLS 1.3, whose tickets arrive later.
+	
+	monkeypatch.setattr(tls, 'context', lambda certfile, keyfile: Context())
+	
+	tls.wrap(Socket(None), 'localhost', 4)
+	assert offered == [4]  # Offered, and so used most recently.
+	tls.remember(Socket(6), 'localhost', 6)
+	
+	assert [key[1] for key in tls._sessions] == [5, 4, 6]
+
+
+def test_session_resumption(server):
+	if not hasattr(ssl.SSLSocket, 'session'):
+		pytest.skip("TLS session resumption requires Python 3.6 or later.")
+
+	before = dict(tls.stats)
+	config = dict(host='127.0.0.1', port=server.port, tls='ssl' if server.implicit else 'required', timeout=5)
+
+	for i in range(3):
+		transport = SMTPTransport(config)
+		transport.startup()
+		assert isinstance(transport.connection.sock, ssl.SSLSocket)
+		transport.shutdown()
+
+	assert tls.stats['handshakes'] - before['handshakes'] == 3
+	assert tls.stats['resumed'] - before['resumed'] == 2
+	assert tls.stats['failed'] == before['failed']
+	assert tls.stats['seconds'] > before['seconds']